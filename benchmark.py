@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from typing import Optional, List
+
+from utils import compress_file, SymmetricEncryption, AsymmetricEncryption, HexEncoding, compress_dict_or_list,\
+                  get_all_files_of_directory, walk_directory, write_archive, Instrumentation, LAYER_PASSWORD, LAYER_PUBLIC_KEY
+
+try:
+    import resource
+except ImportError:
+    resource = None # Peak RSS is not available on Windows
+
+PROFILES = ("tiny", "huge", "incompressible", "deep")
+STAGES = ("compress", "symmetric", "asymmetric", "hex", "index", "pipeline")
+LAYER_ORDERS = {
+    "password": [LAYER_PASSWORD],
+    "public_key": [LAYER_PUBLIC_KEY],
+    "password+public_key": [LAYER_PASSWORD, LAYER_PUBLIC_KEY],
+    "public_key+password": [LAYER_PUBLIC_KEY, LAYER_PASSWORD]
+}
+
+BENCHMARK_PASSWORD = "benchmark password"
+WORDS = ("vault", "archive", "cipher", "stream", "chunk", "layer", "key", "file", "folder", "entry",
+         "index", "data", "backup", "restore", "secure", "random", "block", "nonce", "salt", "hash")
+
+def text_bytes(random_generator: random.Random, size: int) -> bytes:
+    """
+    Returns compressible text made of random words
+
+    :param random_generator: Seeded random generator
+    :param size: Number of bytes
+    """
+
+    words = []
+    length = 0
+    while length < size:
+        word = random_generator.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words).encode("utf-8")[:size]
+
+def generate_tree(directory_path: str, profile: str, scale: float = 1.0, seed: int = 0) -> None:
+    """
+    Generates a synthetic directory tree, the same profile, scale and seed always result in the same tree
+
+    :param directory_path: Directory in which the tree is created, it must not exist
+    :param profile: "tiny" (many tiny text files), "huge" (a few huge text files),
+                    "incompressible" (random data) or "deep" (deeply nested directories)
+    :param scale: Multiplier for the number and size of the files
+    :param seed: Seed of the random generator
+    """
+
+    random_generator = random.Random(seed)
+    os.makedirs(directory_path)
+
+    if profile == "tiny":
+        for i in range(max(1, int(5000 * scale))):
+            sub_directory_path = os.path.join(directory_path, f"d{i % 50}")
+            os.makedirs(sub_directory_path, exist_ok=True)
+            with open(os.path.join(sub_directory_path, f"f{i}.txt"), "wb") as writeable_file:
+                writeable_file.write(text_bytes(random_generator, random_generator.randint(100, 4096)))
+
+    elif profile == "huge":
+        # A 1 MiB block repeated with small changes, so that the data is not repeated within the compression window
+        block = bytearray(text_bytes(random_generator, 1 << 20))
+        for i in range(2):
+            with open(os.path.join(directory_path, f"huge{i}.txt"), "wb") as writeable_file:
+                for _ in range(max(1, int(64 * scale))):
+                    block[random_generator.randrange(len(block))] = random_generator.randrange(97, 123)
+                    writeable_file.write(block)
+
+    elif profile == "incompressible":
+        for i in range(max(1, int(64 * scale))):
+            with open(os.path.join(directory_path, f"random{i}.bin"), "wb") as writeable_file:
+                writeable_file.write(random_generator.randbytes(1 << 20))
+
+    elif profile == "deep":
+        current_path = directory_path
+        for depth in range(max(1, int(64 * scale))):
+            current_path = os.path.join(current_path, f"level{depth}")
+            os.makedirs(current_path)
+            for i in range(4):
+                with open(os.path.join(current_path, f"f{i}.txt"), "wb") as writeable_file:
+                    writeable_file.write(text_bytes(random_generator, 8192))
+
+    else:
+        raise ValueError(f"Unknown profile {profile}.")
+
+def prepare_tree(base_directory: str, profile: str, scale: float, seed: int) -> str:
+    """
+    Returns the path of a generated tree, an existing tree with the same parameters is reused
+
+    :param base_directory: Directory that holds the generated trees
+    :param profile: The tree profile
+    :param scale: Multiplier for the number and size of the files
+    :param seed: Seed of the random generator
+    """
+
+    tree_path = os.path.join(base_directory, f"{profile}-{scale}-{seed}")
+    marker_path = tree_path + ".done"
+
+    if not os.path.isfile(marker_path):
+        shutil.rmtree(tree_path, ignore_errors=True)
+        generate_tree(tree_path, profile, scale, seed)
+        open(marker_path, "w").close()
+    return tree_path
+
+def peak_rss_mib() -> Optional[float]:
+    "Returns the peak resident set size of the current process in MiB"
+
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return round(peak_rss / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def read_tree(tree_path: str) -> List[bytes]:
+    """
+    Reads all files of a tree, so that stages can be measured without disk reads
+
+    :param tree_path: Path of the tree
+    """
+
+    contents = []
+    for file_entry in walk_directory(tree_path):
+        with open(file_entry.path, "rb") as readable_file:
+            contents.append(readable_file.read())
+    return contents
+
+def run_case(case: dict) -> dict:
+    """
+    Runs a single benchmark case and returns its measurements, called in a fresh process
+
+    :param case: Dict with tree, stage and options (codec, workers, layers)
+    """
+
+    tree_path, stage = case["tree"], case["stage"]
+    file_paths = [file_entry.path for file_entry in walk_directory(tree_path)]
+    full_size = sum(os.path.getsize(file_path) for file_path in file_paths)
+    output_size = 0
+    stage_metrics = None
+
+    if stage in ("symmetric", "asymmetric", "hex"):
+        contents = read_tree(tree_path)
+
+        if stage == "symmetric":
+            encryption = SymmetricEncryption(BENCHMARK_PASSWORD)
+        elif stage == "asymmetric":
+            encryption = AsymmetricEncryption().generate_keys()
+        else:
+            encryption = HexEncoding
+
+        start_time = time.perf_counter()
+        for content in contents:
+            output_size += len(encryption.encrypt(content))
+
+    elif stage == "compress":
+        start_time = time.perf_counter()
+        for file_path in file_paths:
+            compressed_bytes = compress_file(file_path, case["codec"])
+            if compressed_bytes is None:
+                raise ValueError(f"The file {file_path} could not be read, the measurement would be incomplete.")
+            output_size += len(compressed_bytes)
+
+    elif stage == "index":
+        start_time = time.perf_counter()
+        structure, _ = get_all_files_of_directory(tree_path)
+        output_size = len(compress_dict_or_list(structure))
+
+    elif stage == "pipeline":
+        encryptions = []
+        for layer in LAYER_ORDERS[case["layers"]]:
+            if layer == LAYER_PASSWORD:
+                encryptions.append(SymmetricEncryption(BENCHMARK_PASSWORD))
+            else:
+                encryptions.append(AsymmetricEncryption().generate_keys())
+        layers = sum(LAYER_ORDERS[case["layers"]])
+
+        instrumentation = Instrumentation()
+        with tempfile.TemporaryFile() as output_file:
+            start_time = time.perf_counter()
+            write_archive(tree_path, output_file, encryptions, layers, case["workers"], codec=case["codec"], instrumentation=instrumentation)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            output_size = output_file.tell()
+        stage_metrics = instrumentation.snapshot()["stages"]
+
+    else:
+        raise ValueError(f"Unknown stage {stage}.")
+
+    seconds = time.perf_counter() - start_time
+
+    return {
+        **case,
+        "files": len(file_paths),
+        "bytes": full_size,
+        "output_bytes": output_size,
+        "seconds": round(seconds, 4),
+        "mb_per_second": round(full_size / seconds / 1e6, 2) if seconds > 0 else None,
+        "files_per_second": round(len(file_paths) / seconds, 1) if seconds > 0 else None,
+        "peak_rss_mib": peak_rss_mib(),
+        "stages": stage_metrics
+    }
+
+def build_cases(tree_paths: dict, stages: List[str], codecs: List[str], workers: List[int], layer_orders: List[str]) -> List[dict]:
+    """
+    Returns all combinations of trees, stages and options
+
+    :param tree_paths: Tree path by profile
+    :param stages: The stages to measure
+    :param codecs: Compression codecs for the compress and pipeline stages
+    :param workers: Worker counts for the pipeline stage
+    :param layer_orders: Keys of LAYER_ORDERS for the pipeline stage
+    """
+
+    cases = []
+    for profile, tree_path in tree_paths.items():
+        for stage in stages:
+            base_case = {"profile": profile, "tree": tree_path, "stage": stage}
+
+            if stage == "compress":
+                cases.extend({**base_case, "codec": codec} for codec in codecs)
+            elif stage == "pipeline":
+                cases.extend(
+                    {**base_case, "codec": codec, "workers": worker_count, "layers": layer_order}
+                    for codec in codecs for worker_count in workers for layer_order in layer_orders
+                )
+            else:
+                cases.append(base_case)
+    return cases
+
+def run_benchmark(cases: List[dict], repeat: int = 1) -> List[dict]:
+    """
+    Runs every case in its own process, so that the peak RSS belongs to the case, and keeps the fastest run
+
+    :param cases: The cases from build_cases
+    :param repeat: Number of runs per case
+    """
+
+    spawn_context = multiprocessing.get_context("spawn")
+    results = []
+
+    for case in cases:
+        runs = []
+        for _ in range(repeat):
+            with spawn_context.Pool(1) as pool:
+                runs.append(pool.apply(run_case, (case,)))
+
+        result = min(runs, key = lambda run: run["seconds"])
+        result["runs"] = [run["seconds"] for run in runs]
+        results.append(result)
+
+        print(f"{result['profile']:>14} {result['stage']:>10} {json.dumps({key: case[key] for key in case if not key in ('profile', 'tree', 'stage')}):<60}"
+              f" {result['seconds']:>9.3f}s {result['mb_per_second'] or 0:>9.1f} MB/s {result['files_per_second'] or 0:>10.1f} files/s", file=sys.stderr)
+    return results
+
+def parse_list(value: str) -> List[str]:
+    """
+    Splits a comma separated command line value
+
+    :param value: The value, e.g. "gzip,lzma"
+    """
+
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Generates the trees, runs the benchmark and writes the JSON report
+
+    :param argv: Command line arguments, defaults to sys.argv
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark of the PyVault compress, encrypt and archive pipeline")
+    parser.add_argument("--directory", help="Directory for the generated trees, reused between runs (default: a temporary directory)")
+    parser.add_argument("--profiles", type=parse_list, default=list(PROFILES), help="Comma separated tree profiles: " + ", ".join(PROFILES))
+    parser.add_argument("--stages", type=parse_list, default=list(STAGES), help="Comma separated stages: " + ", ".join(STAGES))
+    parser.add_argument("--codecs", type=parse_list, default=["gzip"], help="Comma separated codecs for compress and pipeline (raw, gzip, lzma, fast)")
+    parser.add_argument("--workers", type=parse_list, default=["1", str(os.cpu_count() or 1)], help="Comma separated worker counts for the pipeline")
+    parser.add_argument("--layers", type=parse_list, default=["password"], help="Comma separated layer orders for the pipeline: " + ", ".join(LAYER_ORDERS))
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for the number and size of the generated files")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated trees")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case, the fastest run is reported")
+    parser.add_argument("--output", help="Path of the JSON report (default: stdout)")
+    arguments = parser.parse_args(argv)
+
+    for name, values, allowed in (("profile", arguments.profiles, PROFILES), ("stage", arguments.stages, STAGES),
+                                  ("layer order", arguments.layers, LAYER_ORDERS)):
+        unknown_values = [value for value in values if not value in allowed]
+        if unknown_values:
+            parser.error(f"Unknown {name}: {', '.join(unknown_values)}")
+
+    temporary_directory = None
+    base_directory = arguments.directory
+    if base_directory is None:
+        temporary_directory = tempfile.TemporaryDirectory(prefix="pyvault-benchmark-")
+        base_directory = temporary_directory.name
+
+    try:
+        tree_paths = {profile: prepare_tree(base_directory, profile, arguments.scale, arguments.seed) for profile in arguments.profiles}
+        cases = build_cases(tree_paths, arguments.stages, arguments.codecs, [int(worker_count) for worker_count in arguments.workers], arguments.layers)
+        results = run_benchmark(cases, arguments.repeat)
+    finally:
+        if not temporary_directory is None:
+            temporary_directory.cleanup()
+
+    report = json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": arguments.scale,
+        "seed": arguments.seed,
+        "results": results
+    }, indent=2)
+
+    if arguments.output is None:
+        print(report)
+    else:
+        with open(arguments.output, "w") as writeable_file:
+            writeable_file.write(report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
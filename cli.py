@@ -0,0 +1,518 @@
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Optional, List, Tuple, Union
+
+from utils import write_archive, ArchiveReader, restore_archives, shred_path, load_manifest, save_manifest, Instrumentation,\
+                  add_recipients, KeyRing, KeyAgent, AgentClient, default_agent_socket, AGENT_TTL,\
+                  SymmetricEncryption, AsymmetricEncryption, LAYER_PASSWORD, LAYER_PUBLIC_KEY, LAYER_KEY_FILE, SHRED_PASSES, SOLID_FILE_SIZE, KEY_FILE_KDF
+
+PASSWORD_ENVIRONMENT_VARIABLE = "PYVAULT_PASSWORD"
+
+def read_key(key_path: Optional[str]) -> Optional[str]:
+    """
+    Reads a public key, private key or key file
+
+    :param key_path: Path to the key, None if the layer is not used
+    """
+
+    if key_path is None:
+        return None
+
+    with open(key_path, "r") as readable_file:
+        return readable_file.read()
+
+def build_encryptions(password: Optional[str] = None, public_key: Optional[str] = None, private_key: Optional[str] = None,
+                      key_file: Optional[str] = None, recipients: Optional[List[str]] = None) -> Tuple[int, List[Union[SymmetricEncryption, AsymmetricEncryption]]]:
+    """
+    Returns the layers and the encryptions in the same order as the interactive mode: password, public key, key file
+
+    :param password: The password
+    :param public_key: The public key for writing an archive
+    :param private_key: The private key for reading an archive
+    :param key_file: The content of the key file
+    :param recipients: Public keys of further recipients for writing an archive
+    """
+
+    layers = 0
+    encryptions = []
+
+    if not password is None:
+        layers |= LAYER_PASSWORD
+        encryptions.append(SymmetricEncryption(password))
+
+    if not public_key is None or not private_key is None or recipients:
+        layers |= LAYER_PUBLIC_KEY
+        encryptions.append(AsymmetricEncryption(public_key, private_key, recipients))
+
+    if not key_file is None:
+        layers |= LAYER_KEY_FILE
+        encryptions.append(SymmetricEncryption(key_file, kdf=KEY_FILE_KDF))
+
+    return layers, encryptions
+
+def delta_output_path(output_path: str) -> str:
+    """
+    Returns a new path for a delta archive next to the full archive, named after the time of the run,
+    so that the default name of the full archive is never reused for a delta archive
+
+    :param output_path: The default path of the full archive, ending with .pyvault
+    """
+
+    delta_path = output_path[:-len(".pyvault")] + time.strftime(".%Y%m%d-%H%M%S")
+    candidate_path, counter = delta_path + ".pyvault", 1
+    while os.path.exists(candidate_path):
+        candidate_path, counter = f"{delta_path}-{counter}.pyvault", counter + 1
+    return candidate_path
+
+def read_archive_id(archive_path: str) -> Optional[str]:
+    """
+    Returns the ID of an archive, None if the file is not a readable archive
+
+    :param archive_path: Path to the archive
+    """
+
+    try:
+        with open(archive_path, "rb") as readable_file:
+            return ArchiveReader(readable_file).archive_id
+    except Exception:
+        return None
+
+def encrypt(path: str, output_path: Optional[str] = None, password: Optional[str] = None, public_key: Optional[str] = None,
+            key_file: Optional[str] = None, workers: Optional[int] = None, codec: str = "gzip", compression_level: int = 9,
+            manifest_path: Optional[str] = None, deduplicate: bool = False, overwrite: bool = False,
+            metrics_path: Optional[str] = None, io_workers: Optional[int] = None, solid_file_size: int = 0,
+            recipients: Optional[List[str]] = None) -> dict:
+    """
+    Writes a file or directory into an archive and returns a summary. The archive is written under a temporary
+    name and renamed at the end, so an interrupted run never leaves a partial archive behind.
+
+    :param path: Path to the file or directory
+    :param output_path: Path of the archive, defaults to the path with .pyvault appended,
+                        delta archives of a manifest default to a new name with the time of the run
+    :param password: Password for the password layer
+    :param public_key: Public key for the public key layer
+    :param key_file: Content of the key file for the key file layer
+    :param workers: Number of files that are processed in parallel, defaults to the number of CPUs
+    :param codec: The compression codec, "raw", "gzip", "lzma" or "fast"
+    :param compression_level: The compression level from 1 (fast) to 9 (small)
+    :param manifest_path: Path to the manifest of an incremental archive, it is created or updated
+    :param deduplicate: Whether repeated content is stored only once
+    :param overwrite: Whether an existing archive is replaced
+    :param metrics_path: Path to a JSON file for the metrics of the run
+    :param io_workers: Number of concurrent listings, stat calls and reads, for network file systems
+    :param solid_file_size: Files up to this size are packed into solid blocks, 0 disables solid blocks
+    :param recipients: Public keys of further recipients of the public key layer
+    """
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"The path {path} does not exist.")
+
+    manifest = None if manifest_path is None else load_manifest(manifest_path)
+    if output_path is None:
+        output_path = os.path.abspath(path).rstrip(os.sep) + ".pyvault"
+        if not manifest is None and not manifest["archive"] is None:
+            output_path = delta_output_path(output_path)
+    if os.path.exists(output_path):
+        if not overwrite:
+            raise FileExistsError(f"The archive {output_path} already exists.")
+        archive_id = None if manifest is None else read_archive_id(output_path)
+        if not archive_id is None and archive_id in manifest.get("archives", [manifest["archive"]]):
+            raise ValueError(f"The archive {output_path} is part of the incremental chain of the manifest, it cannot be overwritten.")
+
+    layers, encryptions = build_encryptions(password, public_key, None, key_file, recipients)
+
+    errors = []
+    instrumentation = Instrumentation()
+    temporary_path = output_path + ".tmp"
+
+    try:
+        with open(temporary_path, "wb") as writeable_file:
+            file_count, full_size = write_archive(
+                path, writeable_file, encryptions, layers, workers,
+                on_error = lambda error_path, os_error: errors.append({"path": error_path, "error": str(os_error)}),
+                codec = codec, compression_level = compression_level, manifest = manifest,
+                deduplicate = deduplicate, instrumentation = instrumentation, io_workers = io_workers,
+                solid_file_size = solid_file_size
+            )
+            writeable_file.flush()
+            os.fsync(writeable_file.fileno())
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    if not manifest is None:
+        save_manifest(manifest, manifest_path)
+
+    metrics = instrumentation.finish()
+    if not metrics_path is None:
+        instrumentation.write_metrics(metrics_path)
+
+    return {
+        "command": "encrypt",
+        "archive": output_path,
+        "layers": layers,
+        "files": file_count,
+        "bytes": full_size,
+        "archive_bytes": os.path.getsize(output_path),
+        "seconds": metrics["seconds"],
+        "errors": errors
+    }
+
+def restore(archive_paths: List[str], output_directory: str, password: Optional[str] = None, private_key: Optional[str] = None,
+            key_file: Optional[str] = None, paths: Optional[List[str]] = None, metrics_path: Optional[str] = None,
+            agent_client: Optional[AgentClient] = None) -> dict:
+    """
+    Restores an archive, or a full archive followed by its delta archives, and returns a summary
+
+    :param archive_paths: Paths of the archives, starting with the full archive
+    :param output_directory: The directory into which the files are restored
+    :param password: Password for the password layer
+    :param private_key: Private key for the public key layer
+    :param key_file: Content of the key file for the key file layer
+    :param paths: Paths of the files in the archive that are restored, defaults to all files
+    :param metrics_path: Path to a JSON file for the metrics of the run
+    :param agent_client: Key agent that unlocks the archives instead of the credentials
+    """
+
+    instrumentation = Instrumentation()
+    readable_archives = []
+
+    try:
+        archive_readers = []
+        for archive_path in archive_paths:
+            readable_archives.append(open(archive_path, "rb"))
+            archive_reader = ArchiveReader(readable_archives[-1], instrumentation)
+
+            if not agent_client is None:
+                try:
+                    archive_readers.append(archive_reader.unlock_with_agent(agent_client))
+                except ValueError as agent_error:
+                    raise ValueError(f"The key agent could not unlock the archive {archive_path}: {agent_error}") from None
+                continue
+
+            missing_credentials = [
+                name for layer, name, credential in ((LAYER_PASSWORD, "password", password), (LAYER_PUBLIC_KEY, "private key", private_key),
+                                                     (LAYER_KEY_FILE, "key file", key_file))
+                if archive_reader.layers & layer and credential is None
+            ]
+            if missing_credentials:
+                raise ValueError(f"The archive {archive_path} needs the {', '.join(missing_credentials)}.")
+
+            _, encryptions = build_encryptions(
+                password if archive_reader.layers & LAYER_PASSWORD else None,
+                None, private_key if archive_reader.layers & LAYER_PUBLIC_KEY else None,
+                key_file if archive_reader.layers & LAYER_KEY_FILE else None
+            )
+            try:
+                archive_readers.append(archive_reader.unlock(encryptions))
+            except ValueError:
+                raise ValueError(f"The archive {archive_path} could not be unlocked, the credentials are wrong.") from None
+
+        file_count = restore_archives(archive_readers, output_directory, paths)
+    finally:
+        for readable_archive in readable_archives:
+            readable_archive.close()
+
+    metrics = instrumentation.finish()
+    if not metrics_path is None:
+        instrumentation.write_metrics(metrics_path)
+
+    return {
+        "command": "restore",
+        "archives": archive_paths,
+        "output_directory": output_directory,
+        "files": file_count,
+        "bytes": metrics["bytes_in"],
+        "seconds": metrics["seconds"],
+        "errors": []
+    }
+
+def add_recipient(archive_path: str, private_key: str, public_keys: List[str]) -> dict:
+    """
+    Gives further public keys access to an archive, only the index of the archive is rewritten
+
+    :param archive_path: Path to the archive
+    :param private_key: Private key of an existing recipient
+    :param public_keys: Public keys of the new recipients
+    """
+
+    start_time = time.perf_counter()
+    with open(archive_path, "r+b") as archive_file:
+        added_count = add_recipients(archive_file, AsymmetricEncryption(private_key=private_key), public_keys)
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+
+    return {
+        "command": "add-recipient",
+        "archive": archive_path,
+        "recipients": added_count,
+        "seconds": round(time.perf_counter() - start_time, 6),
+        "errors": []
+    }
+
+def read_public_keys(arguments: argparse.Namespace) -> List[str]:
+    """
+    Returns the public keys of --public-key and of the key IDs of --recipient from the key ring
+
+    :param arguments: The parsed arguments
+    """
+
+    public_keys = [read_key(key_path) for key_path in arguments.public_key or []]
+    if arguments.recipients:
+        key_ring_keys = KeyRing(arguments.keyring).public_keys()
+        for key_id in arguments.recipients:
+            if not key_id in key_ring_keys:
+                raise ValueError(f"The key {key_id} is not in the key ring {os.path.abspath(arguments.keyring)}.")
+            public_keys.append(key_ring_keys[key_id])
+    return public_keys
+
+def agent(action: str, socket_path: Optional[str] = None, ttl: Optional[float] = None, detach: bool = False,
+          password: Optional[str] = None, private_key: Optional[str] = None, key_file: Optional[str] = None) -> dict:
+    """
+    Starts, fills, queries or stops the key agent and returns a summary, start runs the agent in the foreground
+    unless detach is set
+
+    :param action: "start", "add", "status", "clear" or "stop"
+    :param socket_path: Path of the socket of the agent, defaults to default_agent_socket()
+    :param ttl: Lifetime of the credentials in seconds, for start the default of the agent
+    :param detach: Whether start runs the agent in a background process
+    :param password: Password that add gives to the agent
+    :param private_key: Private key that add gives to the agent
+    :param key_file: Content of the key file that add gives to the agent
+    """
+
+    start_time = time.perf_counter()
+    socket_path = socket_path or default_agent_socket()
+    summary = {"command": "agent", "action": action, "socket": socket_path}
+
+    if action == "start":
+        if detach:
+            agent_pid = os.fork()
+            if agent_pid > 0:
+                for _ in range(100):
+                    try:
+                        summary.update(AgentClient(socket_path).status())
+                        break
+                    except ValueError:
+                        time.sleep(0.05)
+                else:
+                    raise ValueError(f"The key agent did not start on {socket_path}.")
+                return {**summary, "pid": agent_pid, "seconds": round(time.perf_counter() - start_time, 6), "errors": []}
+
+            # Memory locks are not inherited by forked processes, the agent allocates its memory after the fork
+            os.setsid()
+            with open(os.devnull, "r+b") as null_file:
+                for stream in (sys.stdin, sys.stdout, sys.stderr):
+                    os.dup2(null_file.fileno(), stream.fileno())
+            try:
+                KeyAgent(AGENT_TTL if ttl is None else ttl).serve(socket_path)
+            finally:
+                os._exit(0)
+
+        key_agent = KeyAgent(AGENT_TTL if ttl is None else ttl)
+
+        def on_ready(ready_socket_path: str) -> None:
+            print(json.dumps({**summary, "pid": os.getpid(), "locked_memory": key_agent.memory.locked}), flush=True)
+
+        key_agent.serve(socket_path, on_ready)
+        return {**summary, "stopped": True, "seconds": round(time.perf_counter() - start_time, 6), "errors": []}
+
+    agent_client = AgentClient(socket_path)
+    if action == "add":
+        summary["added"] = [
+            agent_client.add(kind, credential, ttl)
+            for kind, credential in (("password", password), ("private_key", private_key), ("key_file", key_file))
+            if not credential is None
+        ]
+    elif action == "status":
+        summary.update(agent_client.status())
+    elif action == "clear":
+        agent_client.clear()
+    else:
+        agent_client.stop()
+
+    return {**summary, "seconds": round(time.perf_counter() - start_time, 6), "errors": []}
+
+def shred(path: str, passes: List[str] = list(SHRED_PASSES), verify: bool = True, workers_per_device: int = 1,
+          one_file_system: bool = True) -> dict:
+    """
+    Securely deletes a file or directory and returns a summary
+
+    :param path: Path to the file or directory
+    :param passes: Overwrite patterns, each one of "zeros", "ones" or "random"
+    :param verify: Whether the last pass is read back and compared
+    :param workers_per_device: Number of files that are shredded at once on the same device
+    :param one_file_system: Whether mount points below the directory are left alone
+    """
+
+    if not os.path.lexists(path):
+        raise FileNotFoundError(f"The path {path} does not exist.")
+
+    errors = []
+    shred_statistics = shred_path(
+        path, passes, verify, workers_per_device,
+        on_error = lambda error_path, os_error: errors.append({"path": error_path, "error": str(os_error)}),
+        one_file_system = one_file_system
+    )
+
+    return {"command": "shred", "path": path, **shred_statistics, "errors": errors}
+
+def read_password(arguments: argparse.Namespace) -> Optional[str]:
+    """
+    Returns the password from stdin or from an environment variable, never from the command line
+    where it would be visible in the process list
+
+    :param arguments: The parsed arguments
+    """
+
+    if arguments.password_stdin:
+        password = sys.stdin.readline().rstrip("\r\n")
+    elif not arguments.password_env is None:
+        password = os.environ.get(arguments.password_env)
+        if password is None:
+            raise ValueError(f"The environment variable {arguments.password_env} is not set.")
+    else:
+        return None
+
+    if password == "":
+        raise ValueError("The password is empty.")
+    return password
+
+def create_parser() -> argparse.ArgumentParser:
+    "Returns the parser of the command line interface"
+
+    parser = argparse.ArgumentParser(prog="pyvault", description="Non-interactive PyVault: encrypt, restore and securely delete files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_password_arguments(subparser: argparse.ArgumentParser) -> None:
+        password_group = subparser.add_mutually_exclusive_group()
+        password_group.add_argument("--password-stdin", action="store_true", help="Read the password from the first line of stdin")
+        password_group.add_argument("--password-env", nargs="?", const=PASSWORD_ENVIRONMENT_VARIABLE, metavar="VARIABLE",
+                                    help=f"Read the password from an environment variable (default: {PASSWORD_ENVIRONMENT_VARIABLE})")
+        subparser.add_argument("--key-file", metavar="PATH", help="Path to the key file")
+        subparser.add_argument("--metrics", metavar="PATH", help="Write the metrics of the run as JSON to this file")
+
+    def add_recipient_arguments(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument("--public-key", action="append", metavar="PATH", help="Path to the public key of a recipient, can be repeated")
+        subparser.add_argument("--recipient", action="append", dest="recipients", metavar="KEY_ID",
+                               help="ID of a public key in the key ring of a recipient, can be repeated")
+        subparser.add_argument("--keyring", default=".", metavar="DIRECTORY", help="Directory with the ID-publ.key files (default: current directory)")
+
+    encrypt_parser = subparsers.add_parser("encrypt", help="Write a file or directory into an archive")
+    encrypt_parser.add_argument("path", help="File or directory")
+    encrypt_parser.add_argument("-o", "--output", help="Path of the archive (default: PATH.pyvault, delta archives of a manifest: PATH.TIME.pyvault)")
+    add_recipient_arguments(encrypt_parser)
+    add_password_arguments(encrypt_parser)
+    encrypt_parser.add_argument("--workers", type=int, help="Number of files that are processed in parallel (default: number of CPUs)")
+    encrypt_parser.add_argument("--io-workers", type=int, help="Concurrent reads and directory listings, e.g. 32 for network file systems")
+    encrypt_parser.add_argument("--codec", default="gzip", choices=["raw", "gzip", "lzma", "fast"], help="Compression codec (default: gzip)")
+    encrypt_parser.add_argument("--level", type=int, default=9, choices=range(1, 10), metavar="1-9", help="Compression level (default: 9)")
+    encrypt_parser.add_argument("--manifest", metavar="PATH", help="Manifest of an incremental archive, only changes since the last run are stored")
+    encrypt_parser.add_argument("--deduplicate", action="store_true", help="Store repeated content only once")
+    encrypt_parser.add_argument("--solid", type=int, nargs="?", const=SOLID_FILE_SIZE, default=0, metavar="MAX_FILE_SIZE",
+                                help=f"Pack small files into solid blocks that are compressed together (default size limit: {SOLID_FILE_SIZE})")
+    encrypt_parser.add_argument("--overwrite", action="store_true", help="Replace an existing archive")
+
+    restore_parser = subparsers.add_parser("restore", help="Restore an archive or a full archive followed by its delta archives")
+    restore_parser.add_argument("archives", nargs="+", help="Archives, starting with the full archive")
+    restore_parser.add_argument("-o", "--output", default=".", help="Output directory (default: current directory)")
+    restore_parser.add_argument("--private-key", metavar="PATH", help="Path to the private key")
+    add_password_arguments(restore_parser)
+    restore_parser.add_argument("--file", action="append", dest="files", metavar="PATH", help="Restore only this file, can be repeated")
+    restore_parser.add_argument("--agent", nargs="?", const="", metavar="SOCKET",
+                                help="Unlock with the credentials of the key agent (default socket: $PYVAULT_AGENT_SOCKET or the runtime directory)")
+
+    recipient_parser = subparsers.add_parser("add-recipient", help="Give further public keys access to an archive without re-encrypting it")
+    recipient_parser.add_argument("archive", help="The archive")
+    recipient_parser.add_argument("--private-key", metavar="PATH", required=True, help="Path to the private key of an existing recipient")
+    add_recipient_arguments(recipient_parser)
+
+    agent_parser = subparsers.add_parser("agent", help="Key agent that keeps unlocked keys in locked memory across invocations")
+    agent_parser.add_argument("action", choices=["start", "add", "status", "clear", "stop"],
+                              help="start the agent, add credentials, show its status, clear its keys or stop it")
+    agent_parser.add_argument("--socket", metavar="PATH", help="Path of the socket (default: $PYVAULT_AGENT_SOCKET or the runtime directory)")
+    agent_parser.add_argument("--ttl", type=float, metavar="SECONDS", help=f"Lifetime of the credentials (default: {AGENT_TTL})")
+    agent_parser.add_argument("--detach", action="store_true", help="Run the started agent in the background")
+    agent_parser.add_argument("--private-key", metavar="PATH", help="Path to a private key for add")
+    add_password_arguments(agent_parser)
+
+    shred_parser = subparsers.add_parser("shred", help="Securely delete a file or directory")
+    shred_parser.add_argument("path", help="File or directory")
+    shred_parser.add_argument("--passes", default=",".join(SHRED_PASSES), help=f"Comma separated overwrite patterns: zeros, ones, random (default: {','.join(SHRED_PASSES)})")
+    shred_parser.add_argument("--no-verify", action="store_true", help="Do not read back the last pass")
+    shred_parser.add_argument("--workers-per-device", type=int, default=1, help="Files that are shredded at once on the same device")
+    shred_parser.add_argument("--cross-file-systems", action="store_true", help="Shred mount points below the directory as well, each device in parallel")
+    shred_parser.add_argument("--yes", action="store_true", help="Confirm that the data is irrecoverably deleted, required")
+
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Runs a command and prints a JSON summary, returns 0 on success and 1 if the command failed or skipped files
+
+    :param argv: Command line arguments, defaults to sys.argv
+    """
+
+    parser = create_parser()
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "shred" and not arguments.yes:
+        parser.error("shred deletes data irrecoverably, confirm with --yes")
+
+    start_time = time.perf_counter()
+    try:
+        if arguments.command == "encrypt":
+            password = read_password(arguments)
+            public_keys = read_public_keys(arguments)
+            if password is None and not public_keys and arguments.key_file is None:
+                parser.error("encrypt needs at least one of --password-stdin, --password-env, --public-key, --recipient and --key-file")
+
+            summary = encrypt(
+                arguments.path, arguments.output, password, public_keys[0] if public_keys else None, read_key(arguments.key_file),
+                arguments.workers, arguments.codec, arguments.level, arguments.manifest, arguments.deduplicate,
+                arguments.overwrite, arguments.metrics, arguments.io_workers, arguments.solid, public_keys[1:]
+            )
+
+        elif arguments.command == "restore":
+            summary = restore(
+                arguments.archives, arguments.output, read_password(arguments), read_key(arguments.private_key),
+                read_key(arguments.key_file), arguments.files, arguments.metrics,
+                None if arguments.agent is None else AgentClient(arguments.agent or None)
+            )
+
+        elif arguments.command == "add-recipient":
+            public_keys = read_public_keys(arguments)
+            if not public_keys:
+                parser.error("add-recipient needs at least one --public-key or --recipient")
+
+            summary = add_recipient(arguments.archive, read_key(arguments.private_key), public_keys)
+
+        elif arguments.command == "agent":
+            password = read_password(arguments)
+            if arguments.action == "add" and password is None and arguments.private_key is None and arguments.key_file is None:
+                parser.error("agent add needs at least one of --password-stdin, --password-env, --private-key and --key-file")
+
+            summary = agent(
+                arguments.action, arguments.socket, arguments.ttl, arguments.detach, password,
+                read_key(arguments.private_key), read_key(arguments.key_file)
+            )
+
+        else:
+            summary = shred(arguments.path, [name.strip() for name in arguments.passes.split(",")], not arguments.no_verify,
+                            arguments.workers_per_device, not arguments.cross_file_systems)
+
+    except (OSError, ValueError, KeyError) as command_error:
+        error_message = command_error.args[0] if isinstance(command_error, KeyError) and command_error.args else str(command_error)
+        print(json.dumps({"command": arguments.command, "error": error_message, "seconds": round(time.perf_counter() - start_time, 6)}))
+        return 1
+
+    print(json.dumps(summary))
+    return 1 if summary["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,60 @@
-from sys import exit
+from sys import exit, argv
 
 if __name__ != "__main__":
     exit(1)
 
-from utils import clear_console, get_all_files_of_directory, compress_structure, generate_random_string, get_password_strength,\
-                  is_password_safe, directory_load_keys, AsymmetricEncryption, directory_load_key_files, SymmetricEncryption,\
-                  encrypt_structure, HexEncoding, compress_dict_or_list
+if len(argv) > 1:
+    # Arguments select the non-interactive mode, e.g. python main.py encrypt PATH --password-stdin
+    from cli import main
+    exit(main(argv[1:]))
+
+from utils import clear_console, write_archive, generate_random_string, get_password_strength,\
+                  is_password_safe, KeyRing, AsymmetricEncryption, directory_load_key_files, SymmetricEncryption,\
+                  LAYER_PASSWORD, LAYER_PUBLIC_KEY, LAYER_KEY_FILE, ArchiveReader, shred_path, Instrumentation, walk_directory,\
+                  KEY_FILE_KDF
 import os
 from rich.console import Console
+from rich.progress import Progress, TextColumn, BarColumn, DownloadColumn, TransferSpeedColumn, TimeRemainingColumn
 from getpass import getpass
 
 CURRENT_DIR_PATH = os.path.dirname(os.path.abspath(__file__))
 
+# Optional path of a JSON file with the metrics of the last run, e.g. for dashboards
+METRICS_FILE_PATH = os.environ.get("PYVAULT_METRICS_FILE")
+
 CONSOLE = Console()
 
+def create_progress() -> Progress:
+    "Creates a progress bar with bytes, rate, ETA and the number of files"
+
+    return Progress(
+        TextColumn("[green]{task.description}"), BarColumn(), DownloadColumn(), TransferSpeedColumn(),
+        TimeRemainingColumn(), TextColumn("{task.fields[files]} files"), console=CONSOLE
+    )
+
+def create_instrumentation(progress: Progress, description: str, total_size: int, byte_stage: str) -> Instrumentation:
+    """
+    Creates an instrumentation that drives a task of the progress bar
+
+    :param progress: The progress bar
+    :param description: Description of the task
+    :param total_size: Number of bytes that will be processed
+    :param byte_stage: The stage whose bytes advance the progress bar, "read" when writing and "write" when restoring
+    """
+
+    task = progress.add_task(description, total=total_size, files=0)
+    file_count = 0
+
+    def on_event(event: str, data: dict) -> None:
+        nonlocal file_count
+        if event == "stage" and data["stage"] == byte_stage:
+            progress.advance(task, data["bytes"])
+        elif event == "file":
+            file_count += 1
+            progress.update(task, files=file_count)
+
+    return Instrumentation(on_event)
+
 while True:
     mission = None
     options = ["Encrypt file / folder", "Restore data from file", "Secure deletion of files or folders", "Exit"]
@@ -76,6 +117,7 @@ while True:
 
         password = None
         public_key = None
+        recipients = []
 
         if mission in [0, 2]:
             while True:
@@ -86,10 +128,7 @@ while True:
 
                 if inputed_password == "":
                     with CONSOLE.status("[green]Generating a secure password..."):
-                        generated_password = generate_random_string(16)
-                        while not get_password_strength(generated_password) == 100:
-                            print(get_password_strength(generated_password))
-                            generated_password = generate_random_string(16)
+                        generated_password = generate_random_string(16, include_all_classes=True)
                     
                     clear_console()
                     CONSOLE.print("Your generated password is called:", f"[blue]{generated_password}")
@@ -122,7 +161,7 @@ while True:
 
         if mission in [1, 2]:
             with CONSOLE.status("[green]Searching and loading public keys..."):
-                publ_keys, _ = directory_load_keys(CURRENT_DIR_PATH)
+                publ_keys = KeyRing(CURRENT_DIR_PATH).public_keys()
 
             if not len(publ_keys) == 0:
                 mission = None
@@ -163,7 +202,7 @@ while True:
                     if inputed_public_key_path == "":
                         clear_console()
                         with CONSOLE.status("[green]Generate a private and public key pair..."):
-                            asymmetricencryption = AsymmetricEncryption().generate_keys()
+                            asymmetricencryption = AsymmetricEncryption().generate_keys(key_type="x25519")
                             public_key, private_key = asymmetricencryption.public_key, asymmetricencryption.private_key
                         CONSOLE.print("[green]~ Generate a private and public key pair... Done")
 
@@ -186,7 +225,7 @@ while True:
                         break
                     elif os.path.isdir(inputed_public_key_path):
                         with CONSOLE.status("[green]Searching and loading public keys..."):
-                            publ_keys, _ = directory_load_keys(inputed_public_key_path)
+                            publ_keys = KeyRing(inputed_public_key_path).public_keys()
                         
                         if len(publ_keys) == 0:
                             CONSOLE.print("[red][Error] No public or private keys were found")
@@ -219,7 +258,7 @@ while True:
                                         selected_option += 1
                                 else:
                                     if not len(options) == selected_option + 1:
-                                        public_key = publ_keys.values()[selected_option]
+                                        public_key = list(publ_keys.values())[selected_option]
                                     break
                     else:
                         CONSOLE.print("[red][Error] The given path does not exist")
@@ -227,6 +266,25 @@ while True:
                             
                     if not public_key is None:
                         break
+
+            with CONSOLE.status("[green]Searching and loading public keys..."):
+                further_keys = {key_id: key for key_id, key in KeyRing(CURRENT_DIR_PATH).public_keys().items() if key != public_key}
+
+            while len(further_keys) > 0:
+                clear_console()
+                print(f"Enter the file or folder path: {path}")
+                print("Using", encryption_method+"\n")
+                print("Further recipients can decrypt the archive with their own private key:", ", ".join(further_keys))
+
+                inputed_key_ids = [key_id.strip() for key_id in input("\nEnter the IDs of further recipients separated by commas (empty for none): ").split(",") if key_id.strip()]
+                unknown_key_ids = [key_id for key_id in inputed_key_ids if not key_id in further_keys]
+                if unknown_key_ids:
+                    CONSOLE.print(f"[red][Error] Unknown key IDs: {', '.join(unknown_key_ids)}")
+                    input("Enter: ")
+                    continue
+
+                recipients = [further_keys[key_id] for key_id in dict.fromkeys(inputed_key_ids)]
+                break
         
         key_file = None
 
@@ -372,42 +430,292 @@ while True:
         print("Using", encryption_method+"\n")
         CONSOLE.print("[green]~ Encryption credentials added")
 
-        with CONSOLE.status("[green]Exploring the file structure..."):
-            if os.path.isfile(path):
-                full_size = os.path.getsize(path)
-                structure = {path: {"size": full_size, "content": None}}
-            else:
-                structure, full_size = get_all_files_of_directory(path)
-        
-        CONSOLE.print("[green]~ Exploring the file structure... Done")
+        layers = 0
+        encryptions = []
 
-        with CONSOLE.status("[green]Compression of all files..."):
-            structure = compress_structure(structure)
-        
         if not password is None:
-            with CONSOLE.status("[green]Encrypt the file structure with password..."):
-                symmetric_encryption = SymmetricEncryption(password)
-                structure = encrypt_structure(structure, symmetric_encryption)
-            CONSOLE.print("[green]~ Encrypt the file structure with password... Done")
-            
+            layers |= LAYER_PASSWORD
+            encryptions.append(SymmetricEncryption(password))
+
         if not public_key is None:
-            with CONSOLE.status("[green]Encrypt the file structure with public key..."):
-                asymmetric_encryption = AsymmetricEncryption(public_key)
-                structure = encrypt_structure(structure, asymmetric_encryption)
-            CONSOLE.print("[green]~ Encrypt the file structure with public key... Done")
+            layers |= LAYER_PUBLIC_KEY
+            encryptions.append(AsymmetricEncryption(public_key, recipients=recipients))
 
         if not key_file is None:
-            with CONSOLE.status("[green]Encrypt the file structure with key file..."):
-                symmetric_encryption = SymmetricEncryption(key_file)
-                structure = encrypt_structure(structure, symmetric_encryption)
-            CONSOLE.print("[green]~ Encrypt the file structure with key file... Done")
-
-        with CONSOLE.status("[green]Converting bytes to hex..."):
-            structure = encrypt_structure(structure, HexEncoding)
-        CONSOLE.print("[green]~ Converting bytes to hex... Done")
-        
-        with CONSOLE.status("[green]Minimization of the file structure..."):
-            structure_data = compress_dict_or_list(structure)
-        CONSOLE.print("[green]~ Minimization of the file structure... Done")
-                                
-        continue
\ No newline at end of file
+            layers |= LAYER_KEY_FILE
+            encryptions.append(SymmetricEncryption(key_file, kdf=KEY_FILE_KDF))
+
+        archive_path = os.path.abspath(path).rstrip(os.sep) + ".pyvault"
+        archive_errors = []
+
+        with CONSOLE.status("[green]Scanning all files..."):
+            if os.path.isdir(path):
+                total_size = sum(file_entry.size for file_entry in walk_directory(path, on_error=lambda error_path, os_error: None))
+            else:
+                total_size = os.path.getsize(path)
+
+        with create_progress() as progress:
+            instrumentation = create_instrumentation(progress, "Compression and encryption of all files", total_size, "read")
+            # Written under a temporary name, an interrupted run keeps a previous archive and leaves no partial one
+            temporary_path = archive_path + ".tmp"
+            try:
+                with open(temporary_path, "wb") as writeable_file:
+                    file_count, full_size = write_archive(
+                        path, writeable_file, encryptions, layers,
+                        on_error = lambda error_path, os_error: archive_errors.append((error_path, os_error)),
+                        instrumentation = instrumentation
+                    )
+                    writeable_file.flush()
+                    os.fsync(writeable_file.fileno())
+                os.replace(temporary_path, archive_path)
+            except BaseException:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                raise
+        CONSOLE.print("[green]~ Compression and encryption of all files... Done")
+
+        if not METRICS_FILE_PATH is None:
+            instrumentation.write_metrics(METRICS_FILE_PATH)
+
+        for error_path, os_error in archive_errors:
+            CONSOLE.print(f"[yellow][Warning] Skipped {error_path}: {os_error.strerror}")
+
+        CONSOLE.print(f"[green]{file_count} files ({full_size} bytes) were saved in {archive_path}")
+        input("Enter: ")
+
+        continue
+
+    if mission == 1:
+        clear_console()
+
+        archive_path = input("Enter the path of the archive: ")
+
+        try:
+            readable_archive = open(archive_path, "rb")
+            archive_reader = ArchiveReader(readable_archive)
+        except (OSError, ValueError) as archive_error:
+            CONSOLE.print(f"[red][Error] The archive could not be opened: {archive_error}")
+            input("Enter: ")
+            continue
+
+        encryptions = []
+
+        if archive_reader.layers & LAYER_PASSWORD:
+            clear_console()
+            print(f"Enter the path of the archive: {archive_path}\n")
+            encryptions.append(SymmetricEncryption(getpass("Please enter the password: ")))
+
+        if archive_reader.layers & LAYER_PUBLIC_KEY:
+            with CONSOLE.status("[green]Searching and loading private keys..."):
+                key_ring = KeyRing(CURRENT_DIR_PATH)
+                priv_key_ids = key_ring.private_key_ids()
+
+            private_key = None
+            if not len(priv_key_ids) == 0:
+                options = [key_id + " (Private Key)" for key_id in priv_key_ids]
+                options.append("Enter own path")
+                selected_option = 0
+
+                while True:
+                    clear_console()
+                    print(f"Enter the path of the archive: {archive_path}\n")
+
+                    for i, option in enumerate(options):
+                        if i == selected_option:
+                            print(f"[>] {option}")
+                        else:
+                            print(f"[ ] {option}")
+
+                    key = input("\nChoose a Priv Key (c to confirm): ")
+
+                    if not key.lower() in ["c", "confirm"]:
+                        if len(options) < selected_option + 2:
+                            selected_option = 0
+                        else:
+                            selected_option += 1
+                    else:
+                        if not len(options) == selected_option + 1:
+                            private_key = key_ring.load_private_key(priv_key_ids[selected_option])
+                        break
+
+            while private_key is None:
+                clear_console()
+                print(f"Enter the path of the archive: {archive_path}\n")
+
+                inputed_private_key_path = input("Please enter the path to the private key file: ")
+                if os.path.isfile(inputed_private_key_path):
+                    with open(inputed_private_key_path, "r") as readable_file:
+                        private_key = readable_file.read()
+                else:
+                    CONSOLE.print("[red][Error] The given path does not exist")
+                    input("Enter: ")
+
+            encryptions.append(AsymmetricEncryption(private_key=private_key))
+
+        if archive_reader.layers & LAYER_KEY_FILE:
+            with CONSOLE.status("[green]Searching and loading key files..."):
+                key_files = directory_load_key_files(CURRENT_DIR_PATH)
+
+            key_file = None
+            if not len(key_files) == 0:
+                options = [key_file_id + " (Keyfile)" for key_file_id in key_files.keys()]
+                options.append("Enter own path")
+                selected_option = 0
+
+                while True:
+                    clear_console()
+                    print(f"Enter the path of the archive: {archive_path}\n")
+
+                    for i, option in enumerate(options):
+                        if i == selected_option:
+                            print(f"[>] {option}")
+                        else:
+                            print(f"[ ] {option}")
+
+                    key = input("\nChoose a Key File (c to confirm): ")
+
+                    if not key.lower() in ["c", "confirm"]:
+                        if len(options) < selected_option + 2:
+                            selected_option = 0
+                        else:
+                            selected_option += 1
+                    else:
+                        if not len(options) == selected_option + 1:
+                            key_file = list(key_files.values())[selected_option]
+                        break
+
+            while key_file is None:
+                clear_console()
+                print(f"Enter the path of the archive: {archive_path}\n")
+
+                inputed_key_file_path = input("Please enter the path to the key file: ")
+                if os.path.isfile(inputed_key_file_path):
+                    with open(inputed_key_file_path, "r") as readable_file:
+                        key_file = readable_file.read()
+                else:
+                    CONSOLE.print("[red][Error] The given path does not exist")
+                    input("Enter: ")
+
+            encryptions.append(SymmetricEncryption(key_file, kdf=KEY_FILE_KDF))
+
+        clear_console()
+        print(f"Enter the path of the archive: {archive_path}\n")
+
+        try:
+            with CONSOLE.status("[green]Unlocking the archive..."):
+                archive_reader.unlock(encryptions)
+        except ValueError:
+            CONSOLE.print("[red][Error] The archive could not be unlocked, the credentials are wrong")
+            readable_archive.close()
+            input("Enter: ")
+            continue
+        CONSOLE.print("[green]~ Unlocking the archive... Done")
+
+        default_output_directory = os.path.dirname(os.path.abspath(archive_path))
+        output_directory = input(f"Enter the output folder (Enter for {default_output_directory}): ")
+        if output_directory == "":
+            output_directory = default_output_directory
+
+        archive_files = archive_reader.list()
+        options = ["Restore all " + str(len(archive_files)) + " files"] + [archive_file_path + f" ({archive_file_size} bytes)" for archive_file_path, archive_file_size in archive_files]
+        selected_option = 0
+
+        while True:
+            clear_console()
+            print(f"Enter the path of the archive: {archive_path}")
+            print(f"Enter the output folder: {output_directory}\n")
+
+            for i, option in enumerate(options):
+                if i == selected_option:
+                    print(f"[>] {option}")
+                else:
+                    print(f"[ ] {option}")
+
+            key = input("\nChoose what should be restored (c to confirm): ")
+
+            if not key.lower() in ["c", "confirm"]:
+                if len(options) < selected_option + 2:
+                    selected_option = 0
+                else:
+                    selected_option += 1
+            else:
+                break
+
+        if selected_option == 0:
+            total_size = sum(archive_file_size for _, archive_file_size in archive_files)
+        else:
+            total_size = archive_files[selected_option - 1][1]
+
+        try:
+            with create_progress() as progress:
+                archive_reader.instrumentation = create_instrumentation(progress, "Restoring files", total_size, "write")
+                if selected_option == 0:
+                    archive_reader.extract_all(output_directory)
+                else:
+                    archive_reader.extract(archive_files[selected_option - 1][0], output_directory)
+            CONSOLE.print("[green]~ Restoring files... Done")
+
+            if not METRICS_FILE_PATH is None:
+                archive_reader.instrumentation.write_metrics(METRICS_FILE_PATH)
+        except (OSError, ValueError) as restore_error:
+            CONSOLE.print(f"[red][Error] The files could not be restored: {restore_error}")
+        finally:
+            readable_archive.close()
+
+        input("Enter: ")
+        continue
+
+    if mission == 2:
+        clear_console()
+
+        path = input("Enter the file or folder path: ")
+        if not os.path.lexists(path):
+            CONSOLE.print("[red][Error] The given path does not exist")
+            input("Enter: ")
+            continue
+
+        options = ["Random data, zeros (2 passes)", "Zeros (1 pass, fastest)", "Random data, random data, zeros (3 passes)", "Back"]
+        shred_passes = [["random", "zeros"], ["zeros"], ["random", "random", "zeros"]]
+        selected_option = 0
+
+        while True:
+            clear_console()
+            print(f"Enter the file or folder path: {path}\n")
+
+            for i, option in enumerate(options):
+                if i == selected_option:
+                    print(f"[>] {option}")
+                else:
+                    print(f"[ ] {option}")
+
+            key = input("\nChoose how the data should be overwritten (c to confirm): ")
+
+            if not key.lower() in ["c", "confirm"]:
+                if len(options) < selected_option + 2:
+                    selected_option = 0
+                else:
+                    selected_option += 1
+            else:
+                break
+
+        if selected_option == len(options) - 1:
+            continue
+
+        CONSOLE.print(f"[red]All data in {path} will be irrecoverably deleted.")
+        if not input("Type 'delete' to continue: ").lower() == "delete":
+            continue
+
+        shred_errors = []
+        with CONSOLE.status("[green]Overwriting and deleting all files..."):
+            shred_statistics = shred_path(
+                path, shred_passes[selected_option],
+                on_error = lambda error_path, os_error: shred_errors.append((error_path, os_error))
+            )
+        CONSOLE.print("[green]~ Overwriting and deleting all files... Done")
+
+        for error_path, os_error in shred_errors:
+            CONSOLE.print(f"[yellow][Warning] Could not delete {error_path}: {os_error}")
+
+        CONSOLE.print(f"[green]{shred_statistics['files']} files deleted, {shred_statistics['bytes'] / 1048576:.1f} MB written in {shred_statistics['seconds']:.1f}s ({shred_statistics['throughput'] / 1048576:.1f} MB/s)")
+        input("Enter: ")
+        continue
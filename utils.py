@@ -4,19 +4,51 @@ if __name__ == "__main__":
     exit(1)
 
 import os
-from typing import Tuple, Optional, Union
+import sys
+from typing import Tuple, Optional, Union, Iterable, Iterator, BinaryIO, Callable, Any, List, NamedTuple
 import gzip
 import secrets
 import re
 import hashlib
+import hmac
+import io
+import struct
+import threading
+import queue
+import zlib
+import lzma
+import mmap
+import math
+import socket
+import tempfile
+import ctypes
+import ctypes.util
+from itertools import chain
+import time
+import shutil
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib import request, error
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding as symmetric_padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag, InvalidSignature, UnsupportedAlgorithm
+
+try:
+    from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+except ImportError:
+    Argon2id = None # Argon2id needs cryptography 44 or newer, scrypt is used instead
+
+try:
+    import resource
+except ImportError:
+    resource = None # Core dumps of the key agent cannot be disabled on Windows
 import base64
-from cryptography.hazmat.primitives.asymmetric import rsa, padding as asymmetric_padding
+from cryptography.hazmat.primitives.asymmetric import rsa, x25519, ed25519, padding as asymmetric_padding
 import json
 
 LOGO = """
@@ -26,103 +58,618 @@ LOGO = """
 """
 
 def clear_console():
-    "Deletes all elements in the console and sends the logo"
+    "Deletes all elements in the console and sends the logo, without starting a shell on terminals that understand ANSI codes"
 
-    os.system('cls' if os.name == 'nt' else 'clear')
+    if os.name == 'nt':
+        os.system('cls')
+    elif sys.stdout.isatty():
+        sys.stdout.write("\033[H\033[2J\033[3J")
     print(LOGO)
 
-def get_all_files_of_directory(directory_path: str) -> Tuple[dict, int]:
+class FileEntry(NamedTuple):
+    "A file or directory found by walk_directory, the values come from a single stat call"
+
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+    is_directory: bool
+
+def _inspect_directory_entry(directory_entry: os.DirEntry, follow_symlinks: bool) -> Optional[Tuple[bool, os.stat_result]]:
     """
-    Returns the contents of a directory recursively as a list
+    Returns whether an entry is a directory and its stat, None for entries that are skipped (symbolic links
+    that are not followed, sockets, devices), raises OSError if the entry cannot be read
+
+    :param directory_entry: Entry returned by os.scandir
+    :param follow_symlinks: Whether symbolic links are followed
+    """
+
+    if directory_entry.is_symlink() and not follow_symlinks:
+        return None
+
+    is_directory = directory_entry.is_dir(follow_symlinks=follow_symlinks)
+    if not is_directory and not directory_entry.is_file(follow_symlinks=follow_symlinks):
+        return None
+
+    return is_directory, directory_entry.stat(follow_symlinks=follow_symlinks)
+
+def _list_directory(directory_path: str) -> List[os.DirEntry]:
+    """
+    Returns all entries of a directory, used by the concurrent walk
 
     :param directory_path: Path to directory
     """
 
-    structure = {}
-    full_size = 0
+    with os.scandir(directory_path) as directory_entries:
+        return list(directory_entries)
+
+def _inspect_directory_entries(directory_entries: List[os.DirEntry], follow_symlinks: bool) -> List[Tuple[os.DirEntry, Union[Tuple[bool, os.stat_result], OSError, None]]]:
+    """
+    Inspects a batch of entries, used by the concurrent walk so that the stat calls of a large directory are spread
+
+    :param directory_entries: Entries returned by os.scandir
+    :param follow_symlinks: Whether symbolic links are followed
+    """
+
+    inspected_entries = []
+    for directory_entry in directory_entries:
+        try:
+            inspected_entries.append((directory_entry, _inspect_directory_entry(directory_entry, follow_symlinks)))
+        except OSError as os_error:
+            inspected_entries.append((directory_entry, os_error))
+    return inspected_entries
+
+WALK_STAT_BATCH_SIZE = 256
+
+def walk_directory(directory_path: str, follow_symlinks: bool = False, one_file_system: bool = False,
+                   include_directories: bool = False, on_error: Optional[Callable[[str, OSError], None]] = None,
+                   io_workers: int = 1) -> Iterator[FileEntry]:
+    """
+    Walks through a directory recursively and returns the entries lazily, os.scandir is used so that
+    each entry costs at most one stat call and no list of all files has to be built
+
+    With more than one I/O worker, directory listings and stat calls run concurrently in a thread pool, which hides
+    the round trip of every call on network file systems (NFS, SMB). Entries are then returned in the order
+    in which they are found, a directory is still returned before its contents.
+
+    :param directory_path: Path to directory
+    :param follow_symlinks: Whether symbolic links are followed, otherwise they are skipped
+    :param one_file_system: Whether directories on other file systems (mount points) are skipped
+    :param include_directories: Whether directories are returned as well, before their contents
+    :param on_error: Function that is called with the path and the OSError of entries that cannot be read,
+                     if None the error is raised
+    :param io_workers: Number of directory listings and stat batches that are in flight at once
+    """
+
+    def handle_error(path: str, os_error: OSError) -> None:
+        if on_error is None:
+            raise os_error
+        on_error(path, os_error)
+
     try:
-        for file_or_directory in os.listdir(directory_path):
+        root_stat = os.stat(directory_path)
+    except OSError as os_error:
+        handle_error(directory_path, os_error)
+        return
+
+    visited_directories = {(root_stat.st_dev, root_stat.st_ino)}
+    pending_directories = deque([directory_path])
+
+    def accept_entry(directory_entry: os.DirEntry, is_directory: bool, entry_stat: os.stat_result) -> Optional[FileEntry]:
+        "Queues new directories and returns the file entry that is yielded, if any"
+
+        if is_directory:
+            if one_file_system and entry_stat.st_dev != root_stat.st_dev:
+                return None
+
+            directory_id = (entry_stat.st_dev, entry_stat.st_ino)
+            if directory_id in visited_directories:
+                return None # Symlink loop
+            visited_directories.add(directory_id)
+            pending_directories.append(directory_entry.path)
+
+            if not include_directories:
+                return None
+
+        return FileEntry(
+            directory_entry.path, 0 if is_directory else entry_stat.st_size, entry_stat.st_mtime_ns,
+            entry_stat.st_ino, entry_stat.st_dev, is_directory
+        )
+
+    if io_workers <= 1:
+        while pending_directories:
+            current_directory = pending_directories.pop()
+
             try:
-                full_path = os.path.join(directory_path, file_or_directory)
-                if os.path.isfile(full_path):
-                    add_to_full_size = os.path.getsize(full_path)
-                    structure[full_path] = {"size": add_to_full_size, "content": None}
+                with os.scandir(current_directory) as directory_entries:
+                    for directory_entry in directory_entries:
+                        try:
+                            inspected_entry = _inspect_directory_entry(directory_entry, follow_symlinks)
+                        except OSError as os_error:
+                            handle_error(directory_entry.path, os_error)
+                            continue
+
+                        if not inspected_entry is None:
+                            file_entry = accept_entry(directory_entry, *inspected_entry)
+                            if not file_entry is None:
+                                yield file_entry
+            except OSError as os_error:
+                handle_error(current_directory, os_error)
+        return
+
+    pending_batches = deque()
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        futures = {}
+        while pending_directories or pending_batches or futures:
+            # Stat batches go first, so that entries are returned early and memory stays low
+            while len(futures) < io_workers * 2 and (pending_batches or pending_directories):
+                if pending_batches:
+                    futures[executor.submit(_inspect_directory_entries, pending_batches.popleft(), follow_symlinks)] = None
                 else:
-                    structure[full_path], add_to_full_size = get_all_files_of_directory(full_path)
-                full_size += add_to_full_size
-            except:
-                continue # FIXME: Error Handling
-    except:
-        pass # FIXME: Error Handling
+                    current_directory = pending_directories.popleft()
+                    futures[executor.submit(_list_directory, current_directory)] = current_directory
+
+            done_futures, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                current_directory = futures.pop(future)
+
+                if not current_directory is None:
+                    try:
+                        directory_entries = future.result()
+                    except OSError as os_error:
+                        handle_error(current_directory, os_error)
+                        continue
+
+                    for i in range(0, len(directory_entries), WALK_STAT_BATCH_SIZE):
+                        pending_batches.append(directory_entries[i:i + WALK_STAT_BATCH_SIZE])
+                    continue
+
+                for directory_entry, inspected_entry in future.result():
+                    if isinstance(inspected_entry, OSError):
+                        handle_error(directory_entry.path, inspected_entry)
+                    elif not inspected_entry is None:
+                        file_entry = accept_entry(directory_entry, *inspected_entry)
+                        if not file_entry is None:
+                            yield file_entry
+
+def get_all_files_of_directory(directory_path: str, on_error: Optional[Callable[[str, OSError], None]] = None) -> Tuple[dict, int]:
+    """
+    Returns the contents of a directory recursively as a list
+
+    :param directory_path: Path to directory
+    :param on_error: Function that is called with the path and the OSError of entries that cannot be read,
+                     if None the error is raised
+    """
+
+    # Without a trailing separator the parents of all paths lead back to the root key
+    directory_path = os.path.normpath(directory_path)
+    structure = {}
+    full_size = 0
+    directories = {directory_path: structure}
+
+    def get_directory(path: str) -> dict:
+        directory = directories.get(path)
+        if directory is None:
+            parent_path = os.path.dirname(path)
+            if len(parent_path) < len(directory_path) or parent_path == path:
+                return structure # Not below the root, only possible for paths that were not created by the walk
+            directory = get_directory(parent_path).setdefault(path, {})
+            directories[path] = directory
+        return directory
+
+    for file_entry in walk_directory(directory_path, include_directories=True, on_error=on_error):
+        if file_entry.is_directory:
+            get_directory(file_entry.path)
+            continue
+
+        get_directory(os.path.dirname(file_entry.path))[file_entry.path] = {"size": file_entry.size, "content": None}
+        full_size += file_entry.size
     return structure, full_size
 
-def compress_file(file_path: str) -> bytes:
+COMPRESSION_CODECS = ("raw", "gzip", "lzma")
+COMPRESSION_SAMPLE_SIZE = 4096
+INCOMPRESSIBLE_ENTROPY = 7.5
+
+def resolve_codec(codec: str, level: int = 9) -> Tuple[str, int]:
+    """
+    Returns the stored codec name and level, "fast" is the fastest tier (gzip with level 1)
+
+    :param codec: "raw", "gzip", "lzma" or "fast"
+    :param level: The compression level from 1 (fast) to 9 (small)
+    """
+
+    if codec == "fast":
+        return "gzip", 1
+    if not codec in COMPRESSION_CODECS:
+        raise ValueError(f"Unknown compression codec {codec}, use one of {', '.join(COMPRESSION_CODECS)} or fast.")
+    return codec, level
+
+def estimate_entropy(sample: bytes) -> float:
+    """
+    Returns the Shannon entropy of a sample in bits per byte, values near 8 mean compressed or encrypted data
+
+    :param sample: A few KB of the data
+    """
+
+    if not sample:
+        return 0.0
+
+    entropy = 0.0
+    for count in Counter(sample).values():
+        probability = count / len(sample)
+        entropy -= probability * math.log2(probability)
+    return entropy
+
+def choose_codec(sample: bytes, codec: str = "gzip") -> str:
+    """
+    Returns "raw" if the sample looks incompressible, otherwise the given codec
+
+    :param sample: The first bytes of a file
+    :param codec: The codec used for compressible data
+    """
+
+    if estimate_entropy(sample[:COMPRESSION_SAMPLE_SIZE]) >= INCOMPRESSIBLE_ENTROPY:
+        return "raw"
+    return codec
+
+def compress_chunks(plain_chunks: Iterable[bytes], codec: str = "gzip", level: int = 9) -> Iterator[bytes]:
+    """
+    Compresses a stream of chunks, gzip output is in the same format as compress_file
+
+    :param plain_chunks: Iterable of plain bytes
+    :param codec: "raw", "gzip" or "lzma"
+    :param level: The compression level from 1 (fast) to 9 (small)
+    """
+
+    if codec == "raw":
+        yield from plain_chunks
+        return
+
+    if codec == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    elif codec == "lzma":
+        compressor = lzma.LZMACompressor(preset=level)
+    else:
+        raise ValueError(f"Unknown compression codec {codec}.")
+
+    for chunk in plain_chunks:
+        compressed_chunk = compressor.compress(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+    yield compressor.flush()
+
+def decompress_chunks(compressed_chunks: Iterable[bytes], codec: str = "gzip") -> Iterator[bytes]:
+    """
+    Decompresses a stream of chunks
+
+    :param compressed_chunks: Iterable of compressed bytes
+    :param codec: "raw", "gzip" or "lzma"
+    """
+
+    if codec == "raw":
+        yield from compressed_chunks
+        return
+
+    if codec == "gzip":
+        decompressor = zlib.decompressobj(31)
+    elif codec == "lzma":
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unknown compression codec {codec}.")
+
+    for chunk in compressed_chunks:
+        plain_chunk = decompressor.decompress(chunk)
+        if plain_chunk:
+            yield plain_chunk
+
+    if codec == "gzip":
+        yield decompressor.flush()
+
+def compress_file(file_path: str, codec: str = "gzip", level: int = 9) -> bytes:
     """
     Compresses a file
 
     :param file_path: Path to file
+    :param codec: "raw", "gzip", "lzma" or "fast"
+    :param level: The compression level from 1 (fast) to 9 (small)
     """
 
+    codec, level = resolve_codec(codec, level)
+
     try:
         with open(file_path, 'rb') as readable_file:
-            file_bytes = readable_file.read()
+            return b"".join(compress_chunks(read_file_chunks(readable_file), codec, level))
     except:
         return None # FIXME: Error Handling
-    try:
-        compressed_bytes = gzip.compress(file_bytes)
-
-        return compressed_bytes
-    except:
-        return file_bytes # FIXME: Error Handling
 
-def decompress_file(file_bytes: bytes) -> bytes:
+def decompress_file(file_bytes: bytes, codec: str = "gzip") -> bytes:
     """
     Decompresses a file
 
     :param file_bytes: compressed file bytes
+    :param codec: "raw", "gzip" or "lzma"
     """
 
     try:
-        decompressed_bytes = gzip.decompress(file_bytes)
+        decompressed_bytes = b"".join(decompress_chunks([file_bytes], codec))
 
         return decompressed_bytes
-    except:
+    except (zlib.error, lzma.LZMAError):
         return None # FIXME: Error Handling
 
-def compress_structure(structure: dict) -> dict:
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVERAGE_SIZE = 64 * 1024
+CDC_MAX_SIZE = 256 * 1024
+
+# Gear hash: each byte shifts the fingerprint by one bit, so it only depends on the last 64 bytes
+_CDC_GEAR_TABLE = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256))
+_CDC_MASK_SMALL = ((1 << 18) - 1) << 46
+_CDC_MASK_LARGE = ((1 << 14) - 1) << 50
+
+def _find_chunk_boundary(data: Union[bytes, bytearray]) -> int:
     """
-    Loads all files of a given file structure, compresses them and inserts them into the structure
+    Returns the length of the first content-defined chunk of data (FastCDC with normalized chunk sizes),
+    the same content always produces the same boundaries, no matter where it is located in a file
+
+    :param data: The data, should contain at least CDC_MAX_SIZE bytes unless it is the end of a file
+    """
+
+    length = len(data)
+    if length <= CDC_MIN_SIZE:
+        return length
+
+    gear_table = _CDC_GEAR_TABLE
+    normal_size = min(length, CDC_AVERAGE_SIZE)
+    max_size = min(length, CDC_MAX_SIZE)
+
+    fingerprint = 0
+    for byte in data[CDC_MIN_SIZE - 64:CDC_MIN_SIZE]:
+        fingerprint = ((fingerprint << 1) + gear_table[byte]) & 0xFFFFFFFFFFFFFFFF
+
+    # Boundaries are harder to find below the average size and easier above it
+    position = CDC_MIN_SIZE
+    for byte in data[CDC_MIN_SIZE:normal_size]:
+        fingerprint = ((fingerprint << 1) + gear_table[byte]) & 0xFFFFFFFFFFFFFFFF
+        position += 1
+        if not fingerprint & _CDC_MASK_SMALL:
+            return position
+
+    for byte in data[normal_size:max_size]:
+        fingerprint = ((fingerprint << 1) + gear_table[byte]) & 0xFFFFFFFFFFFFFFFF
+        position += 1
+        if not fingerprint & _CDC_MASK_LARGE:
+            return position
+
+    return max_size
+
+def split_content_defined(plain_chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Splits a stream into content-defined chunks between CDC_MIN_SIZE and CDC_MAX_SIZE bytes, an insertion
+    into a file only changes the chunks around it so that unchanged parts can be deduplicated
+
+    :param plain_chunks: Iterable of plain bytes
+    """
+
+    buffer = bytearray()
+    for chunk in plain_chunks:
+        buffer += chunk
+        while len(buffer) >= CDC_MAX_SIZE:
+            boundary = _find_chunk_boundary(buffer)
+            yield bytes(buffer[:boundary])
+            del buffer[:boundary]
+
+    while buffer:
+        boundary = _find_chunk_boundary(buffer)
+        yield bytes(buffer[:boundary])
+        del buffer[:boundary]
+
+def parallel_map(function: Callable[[Any], Any], items: Iterable[Any], workers: Optional[int] = None, max_in_flight: Optional[int] = None) -> Iterator[Any]:
+    """
+    Applies a function to all items in a thread pool and returns the results in the order of the items,
+    gzip, hashlib and OpenSSL release the GIL so the work is spread over all cores
+
+    :param function: Function that is called with each item
+    :param items: Iterable of items, it is consumed lazily
+    :param workers: Number of threads, defaults to the number of CPUs, 1 disables the thread pool
+    :param max_in_flight: Maximum number of items that are processed or waiting to be returned at once,
+                          limits the memory usage, defaults to twice the number of workers
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1:
+        yield from map(function, items)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = deque()
+        for item in items:
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+            futures.append(executor.submit(function, item))
+
+        while futures:
+            yield futures.popleft().result()
+
+def prefetch_items(items: Iterable[Any], depth: int) -> Iterator[Any]:
+    """
+    Produces items in a background thread up to depth items ahead of the consumer, so that slow reads
+    (e.g. from a network file system) overlap with the processing of the previous items.
+    Errors of the producer are raised in the consumer.
+
+    :param items: Iterable of items, it is consumed in the background thread
+    :param depth: Maximum number of items that are produced ahead
+    """
+
+    item_queue = queue.Queue(maxsize=depth)
+    stop_event = threading.Event()
+    end_marker = object()
+
+    def put(item: Any) -> bool:
+        while not stop_event.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((end_marker, error))
+            return
+        put((end_marker, None))
+
+    producer_thread = threading.Thread(target=produce, daemon=True)
+    producer_thread.start()
+
+    try:
+        while True:
+            item, error = item_queue.get()
+            if item is end_marker:
+                if not error is None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop_event.set()
+        producer_thread.join()
+
+def iter_structure_files(structure: dict) -> Iterator[Tuple[str, dict]]:
+    """
+    Returns the path and information of all files in a file structure, directories are walked recursively
 
     :param structure: file structure generated by get_all_files_of_directory(directory_path)
     """
 
-    for path, object in structure.items():
-        if isinstance(object, dict):
-            object["content"] = compress_file(path)
-            structure[path] = object
+    for path, information in structure.items():
+        if not isinstance(information, dict):
+            continue
+
+        if "content" in information:
+            yield path, information
         else:
-            structure[path] = compress_structure(object)
+            yield from iter_structure_files(information)
+
+def compress_structure(structure: dict, workers: Optional[int] = None, max_in_flight: Optional[int] = None) -> dict:
+    """
+    Loads all files of a given file structure, compresses them and inserts them into the structure
+
+    :param structure: file structure generated by get_all_files_of_directory(directory_path)
+    :param workers: Number of files that are compressed in parallel, defaults to the number of CPUs
+    :param max_in_flight: Maximum number of files that are loaded at once
+    """
+
+    files = list(iter_structure_files(structure))
+    compressed_contents = parallel_map(compress_file, (path for path, _ in files), workers, max_in_flight)
+
+    for (_, information), compressed_content in zip(files, compressed_contents):
+        information["content"] = compressed_content
     return structure
 
-def generate_random_string(length: int, with_punctuation: bool = True, with_letters: bool = True) -> str:
+DIGIT_CHARACTERS = "0123456789"
+LOWERCASE_CHARACTERS = "abcdefghijklmnopqrstuvwxyz"
+UPPERCASE_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+PUNCTUATION_CHARACTERS = r"!\"#$%&'()*+,-.:;<=>?@[\]^_`{|}~"
+
+# Special characters that are counted by get_password_strength
+SPECIAL_CHARACTERS = "!@#$%^&*()_+{}[]:;<>,.?~\\"
+
+# Alphabet: translation table and rejected bytes for _sample_characters
+_SAMPLING_TABLES = {}
+
+def _sample_characters(alphabet: str, count: int) -> str:
     """
-    Generates a random string
+    Samples characters uniformly from an ASCII alphabet with bulk random bytes, bytes that would bias the
+    result (the remainder of 256 divided by the alphabet size) are rejected without a Python loop
 
-    :param length: The length of the string
+    :param alphabet: The characters to choose from, at most 256
+    :param count: Number of characters
+    """
+
+    if not alphabet in _SAMPLING_TABLES:
+        limit = 256 - 256 % len(alphabet)
+        _SAMPLING_TABLES[alphabet] = (
+            bytes(ord(alphabet[byte % len(alphabet)]) if byte < limit else 0 for byte in range(256)),
+            bytes(range(limit, 256))
+        )
+    translation_table, rejected_bytes = _SAMPLING_TABLES[alphabet]
+
+    sampled_characters = b""
+    while len(sampled_characters) < count:
+        missing_count = count - len(sampled_characters)
+        random_bytes = secrets.token_bytes(missing_count + missing_count // 4 + 16)
+        sampled_characters += random_bytes.translate(translation_table, rejected_bytes)
+
+    return sampled_characters[:count].decode("ascii")
+
+def generate_random_strings(count: int, length: int, with_punctuation: bool = True, with_letters: bool = True,
+                            include_all_classes: bool = False) -> List[str]:
+    """
+    Generates many random strings at once, e.g. passwords or key files, from a single stream of random bytes
+
+    :param count: Number of strings
+    :param length: The length of every string
     :param with_punctuation: Whether to include special characters
     :param with_letters: Whether letters should be included
+    :param include_all_classes: Whether every string contains at least one digit, lower and upper case letter and
+                                special character, so that generated passwords reach full strength without retries
     """
 
-    characters = "0123456789"
+    character_classes = [DIGIT_CHARACTERS]
 
     if with_punctuation:
-        characters += r"!\"#$%&'()*+,-.:;<=>?@[\]^_`{|}~"
+        character_classes.append(SPECIAL_CHARACTERS if include_all_classes else PUNCTUATION_CHARACTERS)
 
     if with_letters:
-        characters += "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        character_classes.extend([LOWERCASE_CHARACTERS, UPPERCASE_CHARACTERS])
+
+    characters = DIGIT_CHARACTERS + (PUNCTUATION_CHARACTERS if with_punctuation else "") \
+                 + (LOWERCASE_CHARACTERS + UPPERCASE_CHARACTERS if with_letters else "")
+
+    if include_all_classes and length < len(character_classes):
+        raise ValueError(f"A string with all character classes needs at least {len(character_classes)} characters.")
+
+    sampled_characters = _sample_characters(characters, count * length)
+    random_strings = [sampled_characters[i * length:(i + 1) * length] for i in range(count)]
+
+    if not include_all_classes:
+        return random_strings
+
+    # One character of every class is placed at distinct random positions
+    class_characters = [_sample_characters(character_class, count) for character_class in character_classes]
+    system_random = secrets.SystemRandom()
+
+    for i, random_string in enumerate(random_strings):
+        string_characters = list(random_string)
+        positions = system_random.sample(range(length), len(character_classes))
+        for position, sampled_class_characters in zip(positions, class_characters):
+            string_characters[position] = sampled_class_characters[i]
+        random_strings[i] = "".join(string_characters)
 
-    random_string = ''.join(secrets.choice(characters) for _ in range(length))
-    return random_string
+    return random_strings
+
+def generate_random_string(length: int, with_punctuation: bool = True, with_letters: bool = True,
+                           include_all_classes: bool = False) -> str:
+    """
+    Generates a random string
+
+    :param length: The length of the string
+    :param with_punctuation: Whether to include special characters
+    :param with_letters: Whether letters should be included
+    :param include_all_classes: Whether the string contains at least one character of every class
+    """
+
+    return generate_random_strings(1, length, with_punctuation, with_letters, include_all_classes)[0]
 
 def get_password_strength(password: str) -> int:
     """
@@ -139,37 +686,186 @@ def get_password_strength(password: str) -> int:
         strength += 12.6
     if re.search(r'[a-z]', password):
         strength += 12.6
-    if re.search(r'[!@#$%^&*()_+{}\[\]:;<>,.?~\\]', password):
+    if re.search("[" + re.escape(SPECIAL_CHARACTERS) + "]", password):
         strength += 12.6
     
     if strength > 100:
         strength = 100
     return round(strength)
 
-def is_password_safe(password: str) -> bool:
+PWNED_PASSWORDS_URL = "https://api.pwnedpasswords.com/range/"
+
+class OnlineBreachCheck:
+    "Checks SHA-1 hashes against the pwnedpasswords.com range API, range responses are kept in an LRU cache"
+
+    def __init__(self, timeout: float = 5.0, cache_size: int = 256, url: str = PWNED_PASSWORDS_URL):
+        """
+        :param timeout: Seconds after which a request is given up
+        :param cache_size: Number of range responses that are kept
+        :param url: URL of the range API, the 5 character hash prefix is appended
+        """
+
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.url = url
+
+        self.ranges = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _load_range(self, hash_prefix: str) -> frozenset:
+        """
+        Returns the hash suffixes of a range, from the cache or from the API
+
+        :param hash_prefix: The first 5 characters of the SHA-1 hash
+        """
+
+        with self.lock:
+            if hash_prefix in self.ranges:
+                self.ranges.move_to_end(hash_prefix)
+                return self.ranges[hash_prefix]
+
+        with request.urlopen(self.url + hash_prefix, timeout = self.timeout) as response:
+            response_content = response.read().decode('utf-8')
+
+        hash_suffixes = frozenset(line.split(":")[0].strip().upper() for line in response_content.splitlines())
+
+        with self.lock:
+            self.ranges[hash_prefix] = hash_suffixes
+            while len(self.ranges) > self.cache_size:
+                self.ranges.popitem(last = False)
+        return hash_suffixes
+
+    def is_breached(self, password_sha1: str) -> bool:
+        """
+        Returns whether the hash is in a data leak, raises OSError if the API cannot be reached
+
+        :param password_sha1: SHA-1 hash of the password as upper case hex
+        """
+
+        return password_sha1[5:] in self._load_range(password_sha1[:5])
+
+class LocalBreachCheck:
+    """
+    Checks SHA-1 hashes against a downloaded Pwned Passwords dataset without any network access.
+    The dataset is either a single file ordered by hash with HASH:COUNT lines or a directory of
+    range files named PREFIX.txt with SUFFIX:COUNT lines. Files are memory-mapped and binary searched,
+    so a check reads only a few pages of the file.
     """
-    Ask pwnedpasswords.com if password is available in data leak
 
-    :param password: Password to check against
+    def __init__(self, dataset_path: str):
+        """
+        :param dataset_path: Path to the ordered hash file or the directory of range files
+        """
+
+        if not os.path.exists(dataset_path):
+            raise ValueError(f"The breach dataset {dataset_path} does not exist.")
+
+        self.dataset_path = dataset_path
+        self.is_range_directory = os.path.isdir(dataset_path)
+
+        self.file_maps = {}
+        self.lock = threading.Lock()
+
+    def _file_map(self, file_path: str) -> Optional[mmap.mmap]:
+        """
+        Returns the memory map of a dataset file, None if the file does not exist or is empty
+
+        :param file_path: Path to the dataset file
+        """
+
+        with self.lock:
+            if not file_path in self.file_maps:
+                try:
+                    with open(file_path, "rb") as readable_file:
+                        self.file_maps[file_path] = mmap.mmap(readable_file.fileno(), 0, access = mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    self.file_maps[file_path] = None
+            return self.file_maps[file_path]
+
+    @staticmethod
+    def _search(file_map: mmap.mmap, target: bytes) -> bool:
+        """
+        Binary search for a hash in the sorted lines of a memory map
+
+        :param file_map: Memory map of lines in the form HASH:COUNT, sorted by hash
+        :param target: The upper case hex hash or suffix
+        """
+
+        low, high = 0, len(file_map)
+        while low < high:
+            middle = (low + high) // 2
+            line_start = file_map.rfind(b"\n", 0, middle) + 1
+            line_end = file_map.find(b"\n", line_start)
+            if line_end == -1:
+                line_end = len(file_map)
+
+            line_hash = file_map[line_start:line_end].split(b":")[0].strip().upper()
+            if line_hash == target:
+                return True
+            if line_hash < target:
+                low = line_end + 1
+            else:
+                high = line_start
+        return False
+
+    def is_breached(self, password_sha1: str) -> bool:
+        """
+        Returns whether the hash is in the dataset
+
+        :param password_sha1: SHA-1 hash of the password as upper case hex
+        """
+
+        if self.is_range_directory:
+            file_map = self._file_map(os.path.join(self.dataset_path, password_sha1[:5] + ".txt"))
+            target = password_sha1[5:]
+        else:
+            file_map = self._file_map(self.dataset_path)
+            target = password_sha1
+
+        return not file_map is None and self._search(file_map, target.encode("ascii"))
+
+    def close(self) -> None:
+        "Closes all memory maps"
+
+        with self.lock:
+            for file_map in self.file_maps.values():
+                if not file_map is None:
+                    file_map.close()
+            self.file_maps.clear()
+
+_DEFAULT_BREACH_CHECK = None
+
+def default_breach_check() -> Union[OnlineBreachCheck, LocalBreachCheck]:
+    """
+    Returns the shared breach check: a LocalBreachCheck if the environment variable PYVAULT_BREACH_DATASET
+    points to a dataset, otherwise an OnlineBreachCheck
     """
 
-    password_sha1_hash = hashlib.sha1(password.encode()).hexdigest()
-    hash_prefix = password_sha1_hash[:5]
+    global _DEFAULT_BREACH_CHECK
 
-    try:
-        url = f"https://api.pwnedpasswords.com/range/{hash_prefix}"
-        with request.urlopen(url) as response:
-            if response.status == 200:
-                response_content = response.read().decode('utf-8')
+    if _DEFAULT_BREACH_CHECK is None:
+        dataset_path = os.environ.get("PYVAULT_BREACH_DATASET")
+        _DEFAULT_BREACH_CHECK = OnlineBreachCheck() if not dataset_path else LocalBreachCheck(dataset_path)
+    return _DEFAULT_BREACH_CHECK
+
+def is_password_safe(password: str, breach_check: Optional[Union[OnlineBreachCheck, LocalBreachCheck]] = None) -> bool:
+    """
+    Checks whether the password is in a data leak, if the breach check cannot answer (e.g. no network)
+    the password is considered safe
+
+    :param password: Password to check against
+    :param breach_check: OnlineBreachCheck, LocalBreachCheck or any object with is_breached, defaults to default_breach_check()
+    """
 
-                for sha1_hash in response_content.split("\n"):
-                    sha1_hash = sha1_hash.split(":")[0]
-                    if sha1_hash == password_sha1_hash:
-                        return False
-    except error.URLError as e:
-        pass  # FIXME: Error Handling
+    if breach_check is None:
+        breach_check = default_breach_check()
 
-    return True
+    password_sha1_hash = hashlib.sha1(password.encode()).hexdigest().upper()
+
+    try:
+        return not breach_check.is_breached(password_sha1_hash)
+    except OSError:
+        return True # FIXME: Error Handling
 
 def compress_dict_or_list(object: Union[dict, list]) -> bytes:
     """
@@ -197,112 +893,566 @@ def decompress_bytes_to_dict_or_list(compressed_data: bytes) -> Union[dict, list
         return json.loads(decoded_json_str)
     raise ValueError("Invalid JSON data.")
 
-class SymmetricEncryption:
-    "Implementation of symmetric encryption with AES"
+STREAM_CHUNK_SIZE = 65536
+STREAM_MAX_CHUNK_SIZE = 16 * STREAM_CHUNK_SIZE # Larger chunk sizes in a stream header are refused, they could be forged
 
-    def __init__(self, password: Union[str, bytes], salt_length: int = 32):
-        """
-        :param password: A secure encryption password, should be at least 32 characters long
-        :param salt_length: The length of the salt, should be at least 16
-        """
-        
-        if isinstance(password, str):
-            password = password.encode()
+def read_file_chunks(readable_file: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Reads a file-like object lazily in chunks
 
-        self.password = password
-        self.salt_length = salt_length
+    :param readable_file: A file-like object opened in binary mode
+    :param chunk_size: Maximum number of bytes per chunk
+    """
 
-    def encrypt(self, plain_data: bytes) -> bytes:
-        """
-        Encrypts data with the specified password
+    while True:
+        chunk = readable_file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
 
-        :param plain_data: The plain data in bytes
-        """
+def readinto_file_chunks(readable_file: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[memoryview]:
+    """
+    Reads a file-like object in chunks into one reused buffer, so that no bytes object is allocated per chunk.
+    Every chunk is overwritten by the next one, only use this for consumers that are done with a chunk before
+    they ask for the next, like a hash. Files are read and not memory-mapped, a file of the tree that is truncated
+    while it is read only returns fewer bytes, a mapped one would kill the process with SIGBUS.
 
-        salt = secrets.token_bytes(self.salt_length)
+    :param readable_file: A file-like object opened in binary mode
+    :param chunk_size: Maximum number of bytes per chunk
+    """
 
-        kdf_ = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-            backend=default_backend()
-        )
-        key = kdf_.derive(self.password)
+    buffer = bytearray(chunk_size)
+    with memoryview(buffer) as buffer_view:
+        while True:
+            length = readable_file.readinto(buffer_view)
+            if not length:
+                return
+            yield buffer_view[:length]
 
-        iv = secrets.token_bytes(16)
+def _hash_chunks(chunks: Iterable[bytes], content_hash: Any) -> Iterator[bytes]:
+    """
+    Passes chunks through unchanged and updates a hashlib object with them
 
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-        encryptor = cipher.encryptor()
-        padder = symmetric_padding.PKCS7(algorithms.AES.block_size).padder()
-        padded_data = padder.update(plain_data) + padder.finalize()
-        cipher_data = encryptor.update(padded_data) + encryptor.finalize()
+    :param chunks: Iterable of bytes
+    :param content_hash: A hashlib object
+    """
 
-        return compress_dict_or_list([salt.hex(), iv.hex(), cipher_data.hex()])
+    for chunk in chunks:
+        content_hash.update(chunk)
+        yield chunk
 
-    def decrypt(self, compressed_data: bytes) -> bytes:
-        """
-        Decrypts data with the specified password
+def _rechunk(chunks: Iterable[bytes], chunk_size: int) -> Iterator[bytes]:
+    """
+    Regroups chunks of arbitrary size into chunks of exactly chunk_size bytes, only the last one may be shorter
 
-        :param compressed_data: All data required for decryption
+    :param chunks: Iterable of bytes
+    :param chunk_size: The size of the returned chunks
+    """
+
+    buffer = bytearray()
+    for chunk in chunks:
+        if not buffer and len(chunk) == chunk_size:
+            yield chunk
+            continue
+
+        buffer += chunk
+        while len(buffer) >= chunk_size:
+            with memoryview(buffer) as buffer_view:
+                regrouped_chunk = bytes(buffer_view[:chunk_size])
+            del buffer[:chunk_size]
+            yield regrouped_chunk
+
+    if buffer:
+        yield bytes(buffer)
+
+class StreamEncryption:
+    "Implementation of chunked authenticated encryption with AES-GCM for data of any size"
+
+    NONCE_PREFIX_LENGTH = 7
+    TAG_LENGTH = 16
+    HEADER_LENGTH = NONCE_PREFIX_LENGTH + 4
+
+    def __init__(self, key: bytes, chunk_size: int = STREAM_CHUNK_SIZE):
+        """
+        :param key: A random or derived key with 32 bytes
+        :param chunk_size: Number of plain bytes that are authenticated together
         """
 
-        decompressed_data = decompress_bytes_to_dict_or_list(compressed_data)
-        salt, iv, cipher_data = bytes.fromhex(decompressed_data[0]), bytes.fromhex(decompressed_data[1]), bytes.fromhex(decompressed_data[2])
+        if len(key) != 32:
+            raise ValueError("The key for StreamEncryption must be exactly 32 bytes long.")
+        if not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE:
+            raise ValueError(f"The chunk size must be between 1 and {STREAM_MAX_CHUNK_SIZE} bytes.")
 
-        kdf_ = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-            backend=default_backend()
-        )
-        key = kdf_.derive(self.password)
+        self.aead = AESGCM(key)
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def _chunk_nonce(nonce_prefix: bytes, counter: int, is_last_chunk: bool) -> bytes:
+        """
+        Builds the nonce of a chunk: random prefix, chunk counter and a flag for the last chunk
+
+        :param nonce_prefix: Random prefix of the stream
+        :param counter: Position of the chunk in the stream
+        :param is_last_chunk: Whether the chunk is the last one, so that cutting off the stream is detected
+        """
+
+        if counter > 0xFFFFFFFF:
+            raise ValueError("The stream has too many chunks, use a larger chunk size.")
+
+        return nonce_prefix + struct.pack(">I?", counter, is_last_chunk)
+
+    def encrypt_chunks(self, plain_chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Encrypts a stream of plain chunks, the result is a header followed by the authenticated chunks
+
+        :param plain_chunks: Iterable of plain bytes of any size
+        """
+
+        nonce_prefix = secrets.token_bytes(self.NONCE_PREFIX_LENGTH)
+        yield nonce_prefix + struct.pack(">I", self.chunk_size)
+
+        counter = 0
+        pending_chunk = b""
+        for i, chunk in enumerate(_rechunk(plain_chunks, self.chunk_size)):
+            if i > 0:
+                yield self.aead.encrypt(self._chunk_nonce(nonce_prefix, counter, False), pending_chunk, None)
+                counter += 1
+            pending_chunk = chunk
+
+        yield self.aead.encrypt(self._chunk_nonce(nonce_prefix, counter, True), pending_chunk, None)
+
+    def decrypt_chunks(self, cipher_chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Decrypts a stream created by encrypt_chunks, every chunk is verified before it is returned
+
+        :param cipher_chunks: Iterable of encrypted bytes of any size
+        """
+
+        cipher_chunks = iter(cipher_chunks)
+        buffer = bytearray()
+
+        def fill_buffer(length: int) -> bool:
+            while len(buffer) < length:
+                chunk = next(cipher_chunks, None)
+                if chunk is None:
+                    return False
+                buffer.extend(chunk)
+            return True
+
+        if not fill_buffer(self.HEADER_LENGTH):
+            raise ValueError("The encrypted stream is incomplete.")
+
+        nonce_prefix = bytes(buffer[:self.NONCE_PREFIX_LENGTH])
+        chunk_size = struct.unpack(">I", buffer[self.NONCE_PREFIX_LENGTH:self.HEADER_LENGTH])[0]
+        if not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE:
+            raise ValueError(f"The chunk size {chunk_size} of the encrypted stream is not valid, the data was manipulated.")
+        del buffer[:self.HEADER_LENGTH]
+
+        cipher_chunk_size = chunk_size + self.TAG_LENGTH
+        counter = 0
+        while True:
+            # One byte of lookahead decides whether this is the last chunk
+            is_last_chunk = not fill_buffer(cipher_chunk_size + 1)
+            with memoryview(buffer) as buffer_view:
+                cipher_chunk = bytes(buffer_view[:cipher_chunk_size])
+            del buffer[:cipher_chunk_size]
+
+            try:
+                yield self.aead.decrypt(self._chunk_nonce(nonce_prefix, counter, is_last_chunk), cipher_chunk, None)
+            except InvalidTag:
+                raise ValueError(f"Chunk {counter} of the encrypted stream could not be authenticated, the data was manipulated or the key is wrong.") from None
+
+            if is_last_chunk:
+                return
+            counter += 1
+
+    def encrypt(self, input_file: BinaryIO, output_file: BinaryIO) -> None:
+        """
+        Encrypts a file-like object into another one, memory usage is independent of the file size
+
+        :param input_file: Readable file-like object with the plain data
+        :param output_file: Writeable file-like object for the encrypted data
+        """
+
+        for cipher_chunk in self.encrypt_chunks(read_file_chunks(input_file, self.chunk_size)):
+            output_file.write(cipher_chunk)
+
+    def decrypt(self, input_file: BinaryIO, output_file: BinaryIO) -> None:
+        """
+        Decrypts a file-like object into another one, memory usage is independent of the file size
+
+        :param input_file: Readable file-like object with the encrypted data
+        :param output_file: Writeable file-like object for the plain data
+        """
+
+        for plain_chunk in self.decrypt_chunks(read_file_chunks(input_file, self.chunk_size + self.TAG_LENGTH)):
+            output_file.write(plain_chunk)
+
+def derive_subkey(master_key: bytes, nonce: bytes, info: bytes = b"PyVault file key") -> bytes:
+    """
+    Derives a key for a single file from a master key, this is cheap compared to a password KDF
+
+    :param master_key: A derived or random key with full entropy
+    :param nonce: Random bytes or an ID that is unique for each file
+    :param info: Context of the key so that keys for different purposes never collide
+    """
+
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=nonce,
+        info=info,
+        backend=default_backend()
+    )
+    return hkdf.derive(master_key)
+
+LEGACY_KDF = {"algorithm": "pbkdf2-sha256", "iterations": 100000}
+KEY_FILE_KDF = {"algorithm": "hkdf-sha256"} # Key files have full entropy and need no stretching
+KDF_TARGET_SECONDS = 0.5
+KDF_MEMORY_BUDGET = 64 * 1024 * 1024
+# The parameters in an archive header are not authenticated before they are used, parameters above these limits
+# are refused so that a forged archive cannot exhaust the memory or stall the reader or the key agent
+KDF_MAX_MEMORY = 1024 * 1024 * 1024
+KDF_MAX_WORK = 16 * 1024 * 1024 * 1024 # Memory times passes, 64 times the default calibration, about half a minute
+KDF_MAX_PBKDF2_ITERATIONS = 100 * LEGACY_KDF["iterations"]
+KDF_MAX_LANES = 64
+
+_CALIBRATED_KDFS = {}
+_CALIBRATION_LOCK = threading.Lock()
+
+def kdf_memory(kdf: dict) -> int:
+    """
+    Returns the memory in bytes that a key derivation needs
+
+    :param kdf: Parameters of the key derivation
+    """
+
+    if kdf["algorithm"] == "scrypt":
+        return 128 * kdf["r"] * (kdf["n"] + kdf["p"])
+    if kdf["algorithm"] == "argon2id":
+        return kdf["memory_cost"] * 1024
+    return 0
+
+def kdf_work(kdf: dict) -> int:
+    """
+    Returns the work of a memory-hard key derivation in bytes: the memory that is filled times the number of passes
+
+    :param kdf: Parameters of the key derivation
+    """
+
+    if kdf["algorithm"] == "scrypt":
+        return 128 * kdf["r"] * kdf["n"] * kdf["p"]
+    if kdf["algorithm"] == "argon2id":
+        return kdf["memory_cost"] * 1024 * kdf["iterations"]
+    return 0
+
+def _check_kdf(kdf: Any) -> None:
+    """
+    Raises a ValueError if key derivation parameters are malformed or exceed the memory and time limits,
+    called before parameters from an archive are used
+
+    :param kdf: Parameters of the key derivation
+    """
+
+    parameter_names = {
+        "pbkdf2-sha256": ("iterations",), "scrypt": ("n", "r", "p"),
+        "argon2id": ("iterations", "lanes", "memory_cost"), "hkdf-sha256": ()
+    }
+
+    if not isinstance(kdf, dict) or not kdf.get("algorithm") in parameter_names:
+        raise ValueError(f"The key derivation {kdf.get('algorithm') if isinstance(kdf, dict) else kdf} is not supported.")
+    for name in parameter_names[kdf["algorithm"]]:
+        if not isinstance(kdf.get(name), int) or isinstance(kdf[name], bool) or kdf[name] < 1:
+            raise ValueError(f"The key derivation parameter {name} is missing or not a positive integer.")
+
+    if kdf["algorithm"] == "pbkdf2-sha256" and kdf["iterations"] > KDF_MAX_PBKDF2_ITERATIONS:
+        raise ValueError(f"The key derivation needs more than {KDF_MAX_PBKDF2_ITERATIONS} iterations.")
+    if kdf["algorithm"] == "scrypt" and (kdf["n"] < 2 or kdf["n"] & (kdf["n"] - 1)):
+        raise ValueError("The scrypt parameter n has to be a power of 2.")
+    if kdf["algorithm"] == "argon2id" and (kdf["lanes"] > KDF_MAX_LANES or kdf["memory_cost"] < 8 * kdf["lanes"]):
+        raise ValueError(f"The Argon2id parameters need 1 to {KDF_MAX_LANES} lanes and at least 8 KiB of memory per lane.")
+    if kdf_memory(kdf) > KDF_MAX_MEMORY:
+        raise ValueError(f"The key derivation needs more than {KDF_MAX_MEMORY} bytes of memory.")
+    if kdf_work(kdf) > KDF_MAX_WORK:
+        raise ValueError(f"The key derivation needs more than {KDF_MAX_WORK} bytes of work.")
+
+def derive_password_key(password: bytes, salt: bytes, kdf: dict) -> bytes:
+    """
+    Derives a 32 byte key from a password or key file with the given parameters
+
+    :param password: The password or the content of a key file
+    :param salt: Random salt stored with the encrypted data
+    :param kdf: Parameters of the key derivation, e.g. from calibrate_kdf, LEGACY_KDF or KEY_FILE_KDF
+    """
+
+    _check_kdf(kdf)
+    algorithm = kdf["algorithm"]
+
+    if algorithm == "pbkdf2-sha256":
+        kdf_ = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=kdf["iterations"], backend=default_backend())
+    elif algorithm == "scrypt":
+        kdf_ = Scrypt(salt=salt, length=32, n=kdf["n"], r=kdf["r"], p=kdf["p"], backend=default_backend())
+    elif algorithm == "argon2id":
+        if Argon2id is None:
+            raise ValueError("Argon2id is not supported by the installed cryptography version.")
+        kdf_ = Argon2id(salt=salt, length=32, iterations=kdf["iterations"], lanes=kdf["lanes"], memory_cost=kdf["memory_cost"])
+    elif algorithm == "hkdf-sha256":
+        kdf_ = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b"PyVault key file", backend=default_backend())
+    else:
+        raise ValueError(f"The key derivation {algorithm} is not supported.")
+
+    return kdf_.derive(password)
+
+def _time_kdf(kdf: dict) -> float:
+    "Returns the seconds a single key derivation takes on this host, the best of two runs"
+
+    seconds = []
+    for _ in range(2):
+        start_time = time.perf_counter()
+        derive_password_key(b"calibration", bytes(16), kdf)
+        seconds.append(time.perf_counter() - start_time)
+    return min(seconds)
+
+def calibrate_kdf(target_seconds: float = KDF_TARGET_SECONDS, memory_budget: int = KDF_MEMORY_BUDGET, algorithm: Optional[str] = None) -> dict:
+    """
+    Returns memory-hard key derivation parameters for passwords that take about target_seconds on this host
+    and stay within memory_budget. The host is measured once per process and setting, a small probe is
+    extrapolated because the cost grows linearly with memory and iterations.
+
+    :param target_seconds: The intended unlock latency of a password layer
+    :param memory_budget: Maximum memory of the key derivation in bytes
+    :param algorithm: "argon2id" or "scrypt", defaults to Argon2id if it is available
+    """
+
+    if algorithm is None:
+        algorithm = "scrypt"
+        if not Argon2id is None:
+            try:
+                _time_kdf({"algorithm": "argon2id", "iterations": 1, "lanes": 4, "memory_cost": 32})
+                algorithm = "argon2id"
+            except UnsupportedAlgorithm:
+                pass
+
+    with _CALIBRATION_LOCK:
+        kdf = _CALIBRATED_KDFS.get((algorithm, target_seconds, memory_budget))
+        if kdf is None:
+            if algorithm == "argon2id":
+                lanes = 4
+                memory_cost = max(8 * lanes, memory_budget // 1024)
+                seconds = _time_kdf({"algorithm": "argon2id", "iterations": 1, "lanes": lanes, "memory_cost": max(8 * lanes, memory_cost // 4)}) * 4
+
+                # On slow hosts the memory is reduced so that a single pass still meets the target
+                if seconds > target_seconds:
+                    memory_cost = max(8 * lanes, int(memory_cost * target_seconds / seconds))
+                    seconds = target_seconds
+                iterations = min(max(1, round(target_seconds / seconds)), max(1, KDF_MAX_WORK // (memory_cost * 1024)))
+                kdf = {"algorithm": "argon2id", "iterations": iterations, "lanes": lanes, "memory_cost": memory_cost}
+
+            elif algorithm == "scrypt":
+                r = 8
+                max_n = max(2, 2 ** int(math.log2(max(2, memory_budget // (128 * r)))))
+                probe_n = min(max_n, 2 ** 12)
+                seconds = _time_kdf({"algorithm": "scrypt", "n": probe_n, "r": r, "p": 1})
+
+                # n is bounded by the memory budget, the remaining time goes into p which needs no extra memory
+                n = probe_n
+                while n * 2 <= max_n and seconds * n * 2 / probe_n <= target_seconds:
+                    n *= 2
+                p = min(max(1, round(target_seconds / (seconds * n / probe_n))), max(1, KDF_MAX_WORK // (128 * r * n)))
+                kdf = {"algorithm": "scrypt", "n": n, "r": r, "p": p}
+
+            else:
+                raise ValueError(f"The key derivation {algorithm} cannot be calibrated.")
+
+            _CALIBRATED_KDFS[(algorithm, target_seconds, memory_budget)] = kdf
+    return dict(kdf)
+
+class SymmetricEncryption:
+    "Implementation of symmetric encryption with AES"
+
+    FILE_NONCE_LENGTH = 16
+
+    def __init__(self, password: Union[str, bytes], salt_length: int = 32, kdf: Optional[dict] = None):
+        """
+        :param password: A secure encryption password, should be at least 32 characters long
+        :param salt_length: The length of the salt, should be at least 16
+        :param kdf: Parameters of the key derivation, KEY_FILE_KDF for key files. If None, archives calibrate
+                    the parameters with calibrate_kdf and other data uses LEGACY_KDF.
+        """
+        
+        if isinstance(password, str):
+            password = password.encode()
+
+        self.password = password
+        self.salt_length = salt_length
+        self.kdf = kdf
+
+        # The slow password KDF runs once per instance (one archive), every file gets its own subkey
+        self.salt = secrets.token_bytes(salt_length)
+        self.master_keys = {}
+        self.lock = threading.Lock()
+
+    def _derive_key(self, salt: bytes, kdf: Optional[dict] = None) -> bytes:
+        """
+        Derives the master key from the password, the result is cached per salt and parameters
+
+        :param salt: Random salt stored with the encrypted data
+        :param kdf: Parameters of the key derivation, defaults to the parameters of the instance
+        """
+
+        kdf = kdf or self.kdf or LEGACY_KDF
+        cache_key = (salt, json.dumps(kdf, sort_keys=True))
+
+        with self.lock:
+            master_key = self.master_keys.get(cache_key)
+            if master_key is None:
+                master_key = derive_password_key(self.password, salt, kdf)
+                self.master_keys[cache_key] = master_key
+        return master_key
+
+    def encrypt_stream(self, input_file: BinaryIO, output_file: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE, kdf: Optional[dict] = None) -> None:
+        """
+        Encrypts a file-like object with the specified password in authenticated chunks
+
+        :param input_file: Readable file-like object with the plain data
+        :param output_file: Writeable file-like object for the encrypted data
+        :param chunk_size: Number of plain bytes that are authenticated together
+        :param kdf: Parameters of the key derivation, they are not stored and have to be passed to decrypt_stream
+        """
+
+        file_nonce = secrets.token_bytes(self.FILE_NONCE_LENGTH)
+        output_file.write(self.salt + file_nonce)
+
+        file_key = derive_subkey(self._derive_key(self.salt, kdf), file_nonce)
+        StreamEncryption(file_key, chunk_size).encrypt(input_file, output_file)
+
+    def decrypt_stream(self, input_file: BinaryIO, output_file: BinaryIO, kdf: Optional[dict] = None) -> None:
+        """
+        Decrypts a file-like object with the specified password, each chunk is verified before it is written
+
+        :param input_file: Readable file-like object with the encrypted data
+        :param output_file: Writeable file-like object for the plain data
+        :param kdf: Parameters of the key derivation that were used by encrypt_stream
+        """
+
+        header_length = self.salt_length + self.FILE_NONCE_LENGTH
+        header = input_file.read(header_length)
+        if len(header) != header_length:
+            raise ValueError("The encrypted stream is incomplete.")
+        salt, file_nonce = header[:self.salt_length], header[self.salt_length:]
+
+        file_key = derive_subkey(self._derive_key(salt, kdf), file_nonce)
+        StreamEncryption(file_key).decrypt(input_file, output_file)
+
+    def encrypt(self, plain_data: bytes, kdf: Optional[dict] = None) -> bytes:
+        """
+        Encrypts data with the specified password
 
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-        decryptor = cipher.decryptor()
-        unpadder = symmetric_padding.PKCS7(algorithms.AES.block_size).unpadder()
-        decrypted_data = decryptor.update(cipher_data) + decryptor.finalize()
-        plain_data = unpadder.update(decrypted_data) + unpadder.finalize()
+        :param plain_data: The plain data in bytes
+        :param kdf: Parameters of the key derivation, defaults to the parameters of the instance
+        """
+
+        output_file = io.BytesIO()
+        self.encrypt_stream(io.BytesIO(plain_data), output_file, kdf=kdf)
+        return output_file.getvalue()
+
+    def decrypt(self, compressed_data: bytes, kdf: Optional[dict] = None) -> bytes:
+        """
+        Decrypts data with the specified password
+
+        :param compressed_data: All data required for decryption
+        :param kdf: Parameters of the key derivation that were used by encrypt
+        """
+
+        output_file = io.BytesIO()
+        self.decrypt_stream(io.BytesIO(compressed_data), output_file, kdf)
+        return output_file.getvalue()
 
-        return plain_data
+KEY_TYPES = ("rsa", "x25519", "ed25519")
+X25519_WRAP_INFO = b"PyVault X25519 key wrap"
 
 class AsymmetricEncryption:
-    "Implementation of secure asymmetric encryption with RSA"
+    """
+    Implementation of secure asymmetric encryption and signatures, the key type is detected from the DER keys:
+    RSA encrypts and signs, X25519 encrypts with an ephemeral key agreement and Ed25519 signs
+    """
 
-    def __init__(self, public_key: Optional[str] = None, private_key: Optional[str] = None):
+    FILE_NONCE_LENGTH = 16
+
+    def __init__(self, public_key: Optional[str] = None, private_key: Optional[str] = None, recipients: Optional[List[str]] = None):
         """
         :param public_key: The public key to encrypt a message / to verify a signature
         :param private_key: The private key to decrypt a message / to create a signature
+        :param recipients: Public keys of further recipients, archives wrap their key for each of them
         """
         
         self.public_key, self.private_key = public_key, private_key
+        self.recipients = [] if recipients is None else list(recipients)
 
         if not public_key is None:
             public_key_bytes = base64.b64decode(public_key.encode('utf-8'))
-            self.publ_key = serialization.load_der_public_key(public_key_bytes, backend=default_backend())
+            self.publ_key = self._check_key_type(serialization.load_der_public_key(public_key_bytes, backend=default_backend()))
         else:
             self.publ_key = None
 
         if not private_key is None:
             private_key_bytes = base64.b64decode(private_key.encode('utf-8'))
-            self.priv_key = serialization.load_der_private_key(private_key_bytes, password=None, backend=default_backend())
+            self.priv_key = self._check_key_type(serialization.load_der_private_key(private_key_bytes, password=None, backend=default_backend()))
         else:
             self.priv_key = None
 
-    def generate_keys(self, key_size: int = 2048) -> "AsymmetricEncryption":
+        # Hybrid encryption: one random data key per instance (archive) is wrapped with RSA once
+        self.data_key, self.wrapped_data_key = None, None
+        self.unwrapped_data_keys = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _check_key_type(key: Any) -> Any:
+        """
+        Returns the key if its type is supported, raises a ValueError otherwise
+
+        :param key: A loaded public or private key
+        """
+
+        if not isinstance(key, (rsa.RSAPublicKey, rsa.RSAPrivateKey, x25519.X25519PublicKey, x25519.X25519PrivateKey,
+                                ed25519.Ed25519PublicKey, ed25519.Ed25519PrivateKey)):
+            raise ValueError(f"The key type {type(key).__name__} is not supported, use one of {', '.join(KEY_TYPES)}.")
+        return key
+
+    @property
+    def key_type(self) -> Optional[str]:
+        "The type of the loaded keys: rsa, x25519 or ed25519, None if no key is loaded"
+
+        key = self.publ_key if self.priv_key is None else self.priv_key
+        if isinstance(key, (rsa.RSAPublicKey, rsa.RSAPrivateKey)):
+            return "rsa"
+        if isinstance(key, (x25519.X25519PublicKey, x25519.X25519PrivateKey)):
+            return "x25519"
+        if isinstance(key, (ed25519.Ed25519PublicKey, ed25519.Ed25519PrivateKey)):
+            return "ed25519"
+        return None
+
+    def generate_keys(self, key_size: int = 2048, key_type: str = "rsa") -> "AsymmetricEncryption":
         """
         Generates private and public key
 
-        :param key_size: The key size of the private key
+        :param key_size: The key size of the private key, only used for RSA
+        :param key_type: rsa, x25519 (encryption, fast) or ed25519 (signatures, fast)
         """
 
         if self.priv_key is None:
-            self.priv_key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=key_size,
-                backend=default_backend()
-            )
+            if key_type == "rsa":
+                self.priv_key = rsa.generate_private_key(
+                    public_exponent=65537,
+                    key_size=key_size,
+                    backend=default_backend()
+                )
+            elif key_type == "x25519":
+                self.priv_key = x25519.X25519PrivateKey.generate()
+            elif key_type == "ed25519":
+                self.priv_key = ed25519.Ed25519PrivateKey.generate()
+            else:
+                raise ValueError(f"The key type {key_type} is not supported, use one of {', '.join(KEY_TYPES)}.")
             private_key_bytes = self.priv_key.private_bytes(
                 encoding=serialization.Encoding.DER,
                 format=serialization.PrivateFormat.PKCS8,
@@ -320,184 +1470,2802 @@ class AsymmetricEncryption:
 
         return self
 
-    def encrypt(self, plain_data: bytes) -> Tuple[bytes]:
+    @staticmethod
+    def _oaep_padding() -> asymmetric_padding.OAEP:
+        "Returns the padding used to wrap data keys"
+
+        return asymmetric_padding.OAEP(
+            mgf = asymmetric_padding.MGF1(
+                algorithm = hashes.SHA256()
+            ),
+            algorithm = hashes.SHA256(),
+            label = None
+        )
+
+    @classmethod
+    def _wrap_with_public_key(cls, publ_key: Any, key: bytes) -> bytes:
         """
-        Encrypts data with public key
+        Encrypts a key with a loaded public key: RSA-OAEP, or for X25519 an ephemeral key agreement whose
+        shared secret is turned into a wrapping key with HKDF, the ephemeral public key is prepended
 
-        :param plain_data: The plain data in bytes
+        :param publ_key: The loaded public key
+        :param key: The key
         """
 
-        if self.publ_key is None:
-            raise ValueError("The public key cannot be None in encode, this error occurs because no public key was specified when initializing the AsymmetricCrypto function and none was generated with generate_keys.")
+        if isinstance(publ_key, x25519.X25519PublicKey):
+            ephemeral_key = x25519.X25519PrivateKey.generate()
+            ephemeral_public_bytes = ephemeral_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+            recipient_public_bytes = publ_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+            wrapping_key = HKDF(
+                algorithm=hashes.SHA256(), length=32, salt=ephemeral_public_bytes + recipient_public_bytes,
+                info=X25519_WRAP_INFO, backend=default_backend()
+            ).derive(ephemeral_key.exchange(publ_key))
+            # The wrapping key is used only once, a constant nonce is safe
+            return ephemeral_public_bytes + AESGCM(wrapping_key).encrypt(bytes(12), key, None)
 
-        symmetric_key = secrets.token_bytes(64)
+        if isinstance(publ_key, ed25519.Ed25519PublicKey):
+            raise ValueError("Ed25519 keys can only sign, use an RSA or X25519 key for encryption.")
+        return publ_key.encrypt(key, cls._oaep_padding())
 
-        symmetric_compressed_data = SymmetricEncryption(symmetric_key).encrypt(plain_data)
+    @classmethod
+    def _unwrap_with_private_key(cls, priv_key: Any, wrapped_key: bytes) -> bytes:
+        """
+        Decrypts a key that was encrypted with _wrap_with_public_key
 
-        cipher_symmetric_key = self.publ_key.encrypt(
-            symmetric_key,
-            asymmetric_padding.OAEP(
-                mgf = asymmetric_padding.MGF1(
-                    algorithm = hashes.SHA256()
-                ),
-                algorithm = hashes.SHA256(),
-                label = None
-            )
-        )
+        :param priv_key: The loaded private key
+        :param wrapped_key: The encrypted key
+        """
 
-        compressed_data = compress_dict_or_list([symmetric_compressed_data.hex(), cipher_symmetric_key.hex()])
-        return compressed_data
+        if isinstance(priv_key, x25519.X25519PrivateKey):
+            if len(wrapped_key) < 32:
+                raise ValueError("The wrapped key is incomplete.")
+            ephemeral_public_bytes, encrypted_key = wrapped_key[:32], wrapped_key[32:]
+            recipient_public_bytes = priv_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+            wrapping_key = HKDF(
+                algorithm=hashes.SHA256(), length=32, salt=ephemeral_public_bytes + recipient_public_bytes,
+                info=X25519_WRAP_INFO, backend=default_backend()
+            ).derive(priv_key.exchange(x25519.X25519PublicKey.from_public_bytes(ephemeral_public_bytes)))
+            try:
+                return AESGCM(wrapping_key).decrypt(bytes(12), encrypted_key, None)
+            except InvalidTag:
+                raise ValueError("The wrapped key could not be decrypted, the private key is wrong.") from None
 
-    def decrypt(self, compressed_data: bytes) -> bytes:
-        """
-        Decrypts data with private key
+        if isinstance(priv_key, ed25519.Ed25519PrivateKey):
+            raise ValueError("Ed25519 keys can only sign, use an RSA or X25519 key for encryption.")
+        return priv_key.decrypt(wrapped_key, cls._oaep_padding())
 
-        :param compressed_data: All data required for decryption
+    def sign(self, data: bytes) -> bytes:
         """
+        Signs data with the private key: Ed25519, or RSA-PSS with SHA-256
 
-        decompressed_list = decompress_bytes_to_dict_or_list(compressed_data)
-        symmetric_compressed_data, cipher_symmetric_key = bytes.fromhex(decompressed_list[0]), bytes.fromhex(decompressed_list[1])
+        :param data: The data
+        """
 
         if self.priv_key is None:
-            raise ValueError("The private key cannot be None in decode, this error occurs because no private key was specified when initializing the AsymmetricCrypto function and none was generated with generate_keys.")
+            raise ValueError("A private key is required to create a signature.")
+        if isinstance(self.priv_key, ed25519.Ed25519PrivateKey):
+            return self.priv_key.sign(data)
+        if isinstance(self.priv_key, rsa.RSAPrivateKey):
+            return self.priv_key.sign(data, self._pss_padding(), hashes.SHA256())
+        raise ValueError("X25519 keys can only encrypt, use an RSA or Ed25519 key for signatures.")
 
-        symmetric_key = self.priv_key.decrypt(
-            cipher_symmetric_key, 
-            asymmetric_padding.OAEP(
-                mgf = asymmetric_padding.MGF1(
-                    algorithm=hashes.SHA256()
-                ),
-                algorithm = hashes.SHA256(),
-                label = None
-            )
-        )
+    def verify(self, data: bytes, signature: bytes) -> bool:
+        """
+        Returns whether a signature of sign is valid for the data, the public key is derived from the private key if necessary
 
-        plain_text = SymmetricEncryption(symmetric_key).decrypt(symmetric_compressed_data)
+        :param data: The data
+        :param signature: The signature
+        """
 
-        return plain_text
+        publ_key = self.publ_key
+        if publ_key is None:
+            if self.priv_key is None:
+                raise ValueError("A public or private key is required to verify a signature.")
+            publ_key = self.priv_key.public_key()
 
-def directory_load_keys(directory_path: str) -> Tuple[dict, dict]:
-    """
-    Function to get all keys (public and private) that are stored in a dict as a file (not recursive)
+        try:
+            if isinstance(publ_key, ed25519.Ed25519PublicKey):
+                publ_key.verify(signature, data)
+            elif isinstance(publ_key, rsa.RSAPublicKey):
+                publ_key.verify(signature, data, self._pss_padding(), hashes.SHA256())
+            else:
+                raise ValueError("X25519 keys can only encrypt, use an RSA or Ed25519 key for signatures.")
+        except InvalidSignature:
+            return False
+        return True
 
-    :param directory_path: Path to directory  
-    """
-    
-    publ_key_files = {}
-    priv_key_files = {}
+    @staticmethod
+    def _pss_padding() -> asymmetric_padding.PSS:
+        "Returns the padding used for RSA signatures"
 
-    for file_or_directory in os.listdir(directory_path):
-        full_path = os.path.join(directory_path, file_or_directory)
+        return asymmetric_padding.PSS(
+            mgf = asymmetric_padding.MGF1(hashes.SHA256()),
+            salt_length = asymmetric_padding.PSS.MAX_LENGTH
+        )
 
-        if os.path.isfile(full_path):
-            if file_or_directory.endswith(("-priv.key", "-publ.key")):
-                file_id = file_or_directory.replace("-priv.key", "").replace("-publ.key", "")
-                is_private_key = file_or_directory.endswith("-priv.key")
+    def _get_data_key(self) -> bytes:
+        "Returns the random data key of this instance, it is created once"
 
-                with open(full_path, "r") as readable_file:
-                    key = readable_file.read()
+        with self.lock:
+            if self.data_key is None:
+                self.data_key = secrets.token_bytes(32)
+        return self.data_key
 
-                try:
-                    file_public_key = AsymmetricEncryption(private_key=key).generate_keys().public_key if is_private_key else key # FIXME: Validating publ key / loading it
-                except:
-                    continue # FIXME: Error Handling
+    def _wrapped_data_key(self) -> Tuple[bytes, bytes]:
+        """
+        Returns the random data key of this instance and the data key encrypted with the public key,
+        both are created once so that every file only costs a cheap HKDF instead of a public key operation
+        """
+
+        if self.publ_key is None:
+            raise ValueError("The public key cannot be None in encode, this error occurs because no public key was specified when initializing the AsymmetricCrypto function and none was generated with generate_keys.")
 
-                publ_key_files[file_id] = file_public_key
+        data_key = self._get_data_key()
+        with self.lock:
+            if self.wrapped_data_key is None:
+                self.wrapped_data_key = self._wrap_with_public_key(self.publ_key, data_key)
 
-                if is_private_key:
-                    priv_key_files[file_id] = key
-    
-    return publ_key_files, priv_key_files
+        return data_key, self.wrapped_data_key
 
-def directory_load_key_files(directory_path: str) -> dict:
-    """
-    Function for retrieving all key files that are saved as a file in a dict (not recursive)
+    @classmethod
+    def wrap_key(cls, key: bytes, public_key: str) -> str:
+        """
+        Encrypts a key with a public key and returns it base64 encoded
 
-    :param directory_path: Path to directory
-    """
+        :param key: The key
+        :param public_key: The base64 encoded public key
+        """
 
-    key_files = {}
+        publ_key = cls._check_key_type(serialization.load_der_public_key(base64.b64decode(public_key.encode("utf-8")), backend=default_backend()))
+        return base64.b64encode(cls._wrap_with_public_key(publ_key, key)).decode("utf-8")
 
-    for file_or_directory in os.listdir(directory_path):
-        full_path = os.path.join(directory_path, file_or_directory)
+    def fingerprint(self) -> str:
+        "Returns the fingerprint of the public key as computed by KeyRing.fingerprint, it is derived from the private key if necessary"
 
-        if os.path.isfile(full_path):
-            if file_or_directory.endswith(".keyfile"):
-                file_id = file_or_directory.replace(".keyfile", "")
+        publ_key = self.publ_key
+        if publ_key is None:
+            if self.priv_key is None:
+                raise ValueError("A public or private key is required for the fingerprint.")
+            publ_key = self.priv_key.public_key()
 
-                with open(full_path, "r") as readable_file:
-                    key = readable_file.read()
+        return hashlib.sha256(publ_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )).hexdigest()
 
-                key_files[file_id] = key
-    
-    return key_files
+    def recipient_keys(self) -> dict:
+        """
+        Returns the data key of this instance wrapped for the public key and every recipient, keyed by fingerprint.
+        Data that is encrypted with detached=True can be decrypted with the private key of any of them.
+        """
 
-class HexEncoding:
-    "Implementation of hex encoding"
+        public_keys = ([] if self.public_key is None else [self.public_key]) + self.recipients
+        if len(public_keys) == 0:
+            raise ValueError("At least one public key or recipient is required.")
 
-    @staticmethod
-    def encrypt(plain_data: bytes) -> str:
+        data_key = self._get_data_key()
+        return {KeyRing.fingerprint(public_key): self.wrap_key(data_key, public_key) for public_key in public_keys}
+
+    def unwrap_recipient_key(self, recipient_keys: dict) -> bytes:
         """
-        Encodes bytes to string
+        Returns the data key from a table of recipient_keys with the private key
 
-        :param plain_data: The plain data in bytes
+        :param recipient_keys: Wrapped data keys keyed by fingerprint
         """
 
-        return plain_data.hex()
+        wrapped_data_key = recipient_keys.get(self.fingerprint())
+        if wrapped_data_key is None:
+            raise ValueError("The private key is not one of the recipients.")
+        return self._unwrap_data_key(base64.b64decode(wrapped_data_key))
 
-    @staticmethod
-    def decrypt(encoded_data: str) -> bytes:
+    def _unwrap_data_key(self, wrapped_data_key: bytes) -> bytes:
         """
-        Decodes bytes to string
+        Decrypts a data key with the private key, the result is cached per wrapped key
 
-        :param encoded_data: The data encoded to string
+        :param wrapped_data_key: The data key encrypted with the public key
         """
 
-        return bytes.fromhex(encoded_data)
-        
+        if self.priv_key is None:
+            raise ValueError("The private key cannot be None in decode, this error occurs because no private key was specified when initializing the AsymmetricCrypto function and none was generated with generate_keys.")
 
-def encrypt_structure(structure: dict, encryption: Optional[Union[SymmetricEncryption, AsymmetricEncryption, HexEncoding]] = None) -> dict:
-    """
-    Encrypts a file structure
+        with self.lock:
+            data_key = self.unwrapped_data_keys.get(wrapped_data_key)
+            if data_key is None:
+                data_key = self._unwrap_with_private_key(self.priv_key, wrapped_data_key)
+                self.unwrapped_data_keys[wrapped_data_key] = data_key
+        return data_key
 
-    :param structure: The file structure
-    :param encryption: The encryption class used for encryption
-    """
+    def encrypt_stream(self, input_file: BinaryIO, output_file: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE, detached: bool = False) -> None:
+        """
+        Encrypts a file-like object with public key in authenticated chunks
 
-    if encryption is None:
-        return structure
+        :param input_file: Readable file-like object with the plain data
+        :param output_file: Writeable file-like object for the encrypted data
+        :param chunk_size: Number of plain bytes that are authenticated together
+        :param detached: Whether the wrapped data key is left out, the caller then stores recipient_keys
+        """
+
+        if detached:
+            data_key, wrapped_data_key = self._get_data_key(), b""
+        else:
+            data_key, wrapped_data_key = self._wrapped_data_key()
+        file_nonce = secrets.token_bytes(self.FILE_NONCE_LENGTH)
+        output_file.write(struct.pack(">H", len(wrapped_data_key)) + wrapped_data_key + file_nonce)
 
-    new_structure = {}
+        StreamEncryption(derive_subkey(data_key, file_nonce), chunk_size).encrypt(input_file, output_file)
 
-    for file_or_directory, information in structure.items():
-        if isinstance(information, dict):
-            if information.get("content") is None:
-                new_structure[file_or_directory] = encrypt_structure(information, encryption)
-            else:
-                information["content"] = encryption.encrypt(information["content"])
-                new_structure[file_or_directory] = information
-    
-    return new_structure
+    def decrypt_stream(self, input_file: BinaryIO, output_file: BinaryIO, recipient_keys: Optional[dict] = None) -> None:
+        """
+        Decrypts a file-like object with private key, each chunk is verified before it is written
 
-def decrypt_structure(structure: dict, encryption: Optional[Union[SymmetricEncryption, AsymmetricEncryption, HexEncoding]] = None) -> dict:
-    """
-    Decrypts a file structure
+        :param input_file: Readable file-like object with the encrypted data
+        :param output_file: Writeable file-like object for the plain data
+        :param recipient_keys: The recipient_keys of the encrypting instance, required if it was encrypted with detached=True
+        """
 
-    :param structure: The file structure
-    :param encryption: The encryption class used for decryption
-    """
+        length_bytes = input_file.read(2)
+        if len(length_bytes) != 2:
+            raise ValueError("The encrypted stream is incomplete.")
 
-    if encryption is None:
-        return structure
+        header_length = struct.unpack(">H", length_bytes)[0] + self.FILE_NONCE_LENGTH
+        header = input_file.read(header_length)
+        if len(header) != header_length:
+            raise ValueError("The encrypted stream is incomplete.")
+        wrapped_data_key, file_nonce = header[:-self.FILE_NONCE_LENGTH], header[-self.FILE_NONCE_LENGTH:]
 
-    new_structure = {}
+        if len(wrapped_data_key) == 0:
+            if recipient_keys is None:
+                raise ValueError("The data key is stored in a table of recipients, e.g. in the index of an archive.")
+            data_key = self.unwrap_recipient_key(recipient_keys)
+        else:
+            data_key = self._unwrap_data_key(wrapped_data_key)
+        StreamEncryption(derive_subkey(data_key, file_nonce)).decrypt(input_file, output_file)
 
-    for file_or_directory, information in structure.items():
-        if isinstance(information, dict):
-            if information.get("content") is None:
-                new_structure[file_or_directory] = decrypt_structure(information, encryption)
-            else:
-                information["content"] = encryption.decrypt(information["content"])
-                new_structure[file_or_directory] = information
-    
-    return new_structure
\ No newline at end of file
+    def encrypt(self, plain_data: bytes, detached: bool = False) -> bytes:
+        """
+        Encrypts data with public key
+
+        :param plain_data: The plain data in bytes
+        :param detached: Whether the wrapped data key is left out, the caller then stores recipient_keys
+        """
+
+        output_file = io.BytesIO()
+        self.encrypt_stream(io.BytesIO(plain_data), output_file, detached=detached)
+        return output_file.getvalue()
+
+    def decrypt(self, compressed_data: bytes, recipient_keys: Optional[dict] = None) -> bytes:
+        """
+        Decrypts data with private key
+
+        :param compressed_data: All data required for decryption
+        :param recipient_keys: The recipient_keys of the encrypting instance, required if it was encrypted with detached=True
+        """
+
+        output_file = io.BytesIO()
+        self.decrypt_stream(io.BytesIO(compressed_data), output_file, recipient_keys)
+        return output_file.getvalue()
+
+KEYRING_INDEX_NAME = ".pyvault-keyring"
+KEYRING_INDEX_VERSION = 1
+
+class KeyRing:
+    """
+    Cached view of the keys stored in a directory as ID-publ.key and ID-priv.key files (not recursive).
+
+    The fingerprint and public key of every key file are kept in an index file in the directory,
+    keyed by file name, mtime and size, so listing the keys only needs a stat per file. A private key
+    is only parsed when it is new or changed, and only read when it is selected with load_private_key.
+    """
+
+    def __init__(self, directory_path: str):
+        """
+        :param directory_path: Path to directory
+        """
+
+        self.directory_path = directory_path
+        self.index_path = os.path.join(directory_path, KEYRING_INDEX_NAME)
+
+        # File name: [mtime_ns, size, fingerprint, public key], fingerprint and public key are None for invalid files
+        self.files = {}
+        try:
+            with open(self.index_path, "rb") as readable_file:
+                index = decompress_bytes_to_dict_or_list(readable_file.read())
+            if index.get("version") == KEYRING_INDEX_VERSION:
+                self.files = index["files"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass # A missing or broken index is rebuilt
+
+        self.refresh()
+
+    @staticmethod
+    def fingerprint(public_key: str) -> str:
+        """
+        Returns the SHA-256 fingerprint of a base64 encoded public key as hex, computed from the DER encoding
+        of the parsed key, so that whitespace around the base64 text (e.g. the newline of a key file) does not change it
+
+        :param public_key: The public key as returned by AsymmetricEncryption.generate_keys
+        """
+
+        return AsymmetricEncryption(public_key=public_key).fingerprint()
+
+    def _inspect_key_file(self, file_path: str, is_private_key: bool) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Returns the fingerprint and public key of a key file, None for both if the file is not a valid key
+
+        :param file_path: Path to the key file
+        :param is_private_key: Whether the file is a private key, its public key then has to be derived
+        """
+
+        try:
+            with open(file_path, "r") as readable_file:
+                key = readable_file.read()
+            public_key = AsymmetricEncryption(private_key=key).generate_keys().public_key if is_private_key else key.strip()
+            return self.fingerprint(public_key), public_key
+        except Exception:
+            return None, None
+
+    def refresh(self) -> None:
+        "Updates the index with new, changed and deleted key files and saves it if anything changed"
+
+        files = {}
+        changed = False
+
+        with os.scandir(self.directory_path) as directory_entries:
+            for directory_entry in directory_entries:
+                if not directory_entry.name.endswith(("-priv.key", "-publ.key")) or not directory_entry.is_file():
+                    continue
+
+                file_stat = directory_entry.stat()
+                cached_file = self.files.get(directory_entry.name)
+                if not cached_file is None and cached_file[:2] == [file_stat.st_mtime_ns, file_stat.st_size]:
+                    files[directory_entry.name] = cached_file
+                    continue
+
+                fingerprint, public_key = self._inspect_key_file(directory_entry.path, directory_entry.name.endswith("-priv.key"))
+                files[directory_entry.name] = [file_stat.st_mtime_ns, file_stat.st_size, fingerprint, public_key]
+                changed = True
+
+        changed = changed or files.keys() != self.files.keys()
+        self.files = files
+        if changed:
+            self._save_index()
+
+    def _save_index(self) -> None:
+        "Writes the index atomically, a directory that is not writeable is simply not cached"
+
+        temporary_path = self.index_path + ".tmp"
+        try:
+            with open(temporary_path, "wb") as writeable_file:
+                writeable_file.write(compress_dict_or_list({"version": KEYRING_INDEX_VERSION, "files": self.files}))
+            os.replace(temporary_path, self.index_path)
+        except OSError:
+            pass
+
+    def _valid_files(self, suffix: str) -> Iterator[Tuple[str, list]]:
+        """
+        Returns the key ID and index record of all valid key files with the suffix, sorted by file name
+
+        :param suffix: "-priv.key" or "-publ.key"
+        """
+
+        for file_name in sorted(self.files):
+            if file_name.endswith(suffix) and not self.files[file_name][2] is None:
+                yield file_name[:-len(suffix)], self.files[file_name]
+
+    def _public_records(self) -> dict:
+        "Returns the index records of all key pairs and public key files by key ID, a public key file wins over a pair"
+
+        public_records = dict(self._valid_files("-priv.key"))
+        public_records.update(self._valid_files("-publ.key"))
+        return public_records
+
+    def public_keys(self) -> dict:
+        "Returns the public keys by key ID, without any cryptography"
+
+        return {key_id: record[3] for key_id, record in self._public_records().items()}
+
+    def fingerprints(self) -> dict:
+        "Returns the fingerprints of the public keys by key ID"
+
+        return {key_id: record[2] for key_id, record in self._public_records().items()}
+
+    def private_key_ids(self) -> List[str]:
+        "Returns the IDs of all valid private keys"
+
+        return [key_id for key_id, _ in self._valid_files("-priv.key")]
+
+    def load_private_key(self, key_id: str) -> str:
+        """
+        Reads a private key from its file, only the selected key is read
+
+        :param key_id: The ID of the key, the file name without -priv.key
+        """
+
+        with open(os.path.join(self.directory_path, key_id + "-priv.key"), "r") as readable_file:
+            return readable_file.read()
+
+def directory_load_keys(directory_path: str) -> Tuple[dict, dict]:
+    """
+    Function to get all keys (public and private) that are stored in a dict as a file (not recursive),
+    public keys come from the KeyRing index, private keys are read but not parsed
+
+    :param directory_path: Path to directory  
+    """
+
+    key_ring = KeyRing(directory_path)
+    return key_ring.public_keys(), {key_id: key_ring.load_private_key(key_id) for key_id in key_ring.private_key_ids()}
+
+def directory_load_key_files(directory_path: str) -> dict:
+    """
+    Function for retrieving all key files that are saved as a file in a dict (not recursive)
+
+    :param directory_path: Path to directory
+    """
+
+    key_files = {}
+
+    for file_or_directory in os.listdir(directory_path):
+        full_path = os.path.join(directory_path, file_or_directory)
+
+        if os.path.isfile(full_path):
+            if file_or_directory.endswith(".keyfile"):
+                file_id = file_or_directory.replace(".keyfile", "")
+
+                with open(full_path, "r") as readable_file:
+                    key = readable_file.read()
+
+                key_files[file_id] = key
+    
+    return key_files
+
+class HexEncoding:
+    "Implementation of hex encoding"
+
+    @staticmethod
+    def encrypt(plain_data: bytes) -> str:
+        """
+        Encodes bytes to string
+
+        :param plain_data: The plain data in bytes
+        """
+
+        return plain_data.hex()
+
+    @staticmethod
+    def decrypt(encoded_data: str) -> bytes:
+        """
+        Decodes bytes to string
+
+        :param encoded_data: The data encoded to string
+        """
+
+        return bytes.fromhex(encoded_data)
+        
+
+def _transform_structure(structure: dict, function: Callable[[bytes], bytes], workers: Optional[int] = None, max_in_flight: Optional[int] = None) -> dict:
+    """
+    Replaces the content of all files in a file structure with the result of function(content)
+
+    :param structure: The file structure
+    :param function: Function that is applied to each content
+    :param workers: Number of files that are processed in parallel, defaults to the number of CPUs
+    :param max_in_flight: Maximum number of files that are processed at once
+    """
+
+    files = [information for _, information in iter_structure_files(structure) if not information["content"] is None]
+    new_contents = parallel_map(function, (information["content"] for information in files), workers, max_in_flight)
+
+    for information, new_content in zip(files, new_contents):
+        information["content"] = new_content
+    return structure
+
+def encrypt_structure(structure: dict, encryption: Optional[Union[SymmetricEncryption, AsymmetricEncryption, HexEncoding]] = None,
+                      workers: Optional[int] = None, max_in_flight: Optional[int] = None) -> dict:
+    """
+    Encrypts a file structure
+
+    :param structure: The file structure
+    :param encryption: The encryption class used for encryption
+    :param workers: Number of files that are encrypted in parallel, defaults to the number of CPUs
+    :param max_in_flight: Maximum number of files that are encrypted at once
+    """
+
+    if encryption is None:
+        return structure
+
+    return _transform_structure(structure, encryption.encrypt, workers, max_in_flight)
+
+def decrypt_structure(structure: dict, encryption: Optional[Union[SymmetricEncryption, AsymmetricEncryption, HexEncoding]] = None,
+                      workers: Optional[int] = None, max_in_flight: Optional[int] = None) -> dict:
+    """
+    Decrypts a file structure
+
+    :param structure: The file structure
+    :param encryption: The encryption class used for decryption
+    :param workers: Number of files that are decrypted in parallel, defaults to the number of CPUs
+    :param max_in_flight: Maximum number of files that are decrypted at once
+    """
+
+    if encryption is None:
+        return structure
+
+    return _transform_structure(structure, encryption.decrypt, workers, max_in_flight)
+
+def compress_and_encrypt_structure(structure: dict, encryptions: List[Union[SymmetricEncryption, AsymmetricEncryption]],
+                                   workers: Optional[int] = None, max_in_flight: Optional[int] = None) -> dict:
+    """
+    Loads, compresses and encrypts all files of a file structure in one pass, each file is handled
+    completely by one worker so that only max_in_flight files are held in intermediate form at once
+
+    :param structure: file structure generated by get_all_files_of_directory(directory_path)
+    :param encryptions: The encryption layers in the order in which they are applied
+    :param workers: Number of files that are processed in parallel, defaults to the number of CPUs
+    :param max_in_flight: Maximum number of files that are processed at once
+    """
+
+    def process_file(path: str) -> Optional[bytes]:
+        content = compress_file(path)
+        if content is None:
+            return None
+
+        for encryption in encryptions:
+            content = encryption.encrypt(content)
+        return content
+
+    files = list(iter_structure_files(structure))
+    contents = parallel_map(process_file, (path for path, _ in files), workers, max_in_flight)
+
+    for (_, information), content in zip(files, contents):
+        information["content"] = content
+    return structure
+
+ARCHIVE_MAGIC = b"PYVAULT\x00"
+ARCHIVE_VERSION = 3
+SUPPORTED_ARCHIVE_VERSIONS = (1, 2, 3)
+# From version 3 on the index is authenticated and the data key has 64 bytes: an archive whose version was lowered
+# to skip the index check unwraps to a data key of the wrong size and is rejected
+DATA_KEY_SIZES = {1: 32, 2: 32, 3: 64}
+INDEX_TAG_SIZE = 32
+
+LAYER_PASSWORD = 1
+LAYER_PUBLIC_KEY = 2
+LAYER_KEY_FILE = 4
+
+_ARCHIVE_HEADER = struct.Struct(">8sBB")
+_ENTRY_HEADER = struct.Struct(">BQQ")
+_ARCHIVE_FOOTER = struct.Struct(">Q8s")
+
+ENTRY_KEY_INFO = b"PyVault entry key"
+CHUNK_KEY_INFO = b"PyVault chunk key"
+BLOCK_KEY_INFO = b"PyVault block key"
+INDEX_KEY_INFO = b"PyVault index key"
+ARCHIVE_BUFFER_SIZE = 64 * 1024 * 1024
+SMALL_FILE_SIZE = 1024 * 1024
+WRITE_READ_AHEAD = 16 # Chunks of large files that are read ahead when io_workers is given
+SOLID_FILE_SIZE = 64 * 1024
+SOLID_BLOCK_SIZE = 4 * 1024 * 1024
+
+class Instrumentation:
+    """
+    Collects file counts, bytes, latency histograms and throughput per stage of the archive pipeline
+    (walk, read, hash, chunking, compress, encrypt, write, key wrapping and the index), can be used from several threads.
+
+    Stages that pull from each other (e.g. encrypt pulls from compress, which pulls from read) are measured
+    exclusively, the time of a stage does not contain the time of the stages it pulls from.
+    """
+
+    def __init__(self, callback: Optional[Callable[[str, dict], None]] = None):
+        """
+        :param callback: Function that is called with the event name and its data: "stage" after every measurement
+                         with stage, seconds and bytes, "file" after every file with path, size and bytes_out
+                         and "finish" with the snapshot at the end
+        """
+
+        self.callback = callback
+        self.start_time = time.perf_counter()
+
+        self.files = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stages = {}
+
+        self.lock = threading.Lock()
+        self.frames = threading.local()
+
+    def record(self, stage: str, seconds: float, byte_count: int = 0) -> None:
+        """
+        Adds a measurement to a stage, the latency histogram counts calls per power of two microseconds
+
+        :param stage: Name of the stage
+        :param seconds: Duration of the call
+        :param byte_count: Number of bytes produced by the call
+        """
+
+        bucket = 1 << max(0, math.ceil(math.log2(max(seconds * 1e6, 1))))
+
+        with self.lock:
+            stage_metrics = self.stages.get(stage)
+            if stage_metrics is None:
+                stage_metrics = self.stages[stage] = {"calls": 0, "seconds": 0.0, "bytes": 0, "histogram_us": {}}
+
+            stage_metrics["calls"] += 1
+            stage_metrics["seconds"] += seconds
+            stage_metrics["bytes"] += byte_count
+            stage_metrics["histogram_us"][bucket] = stage_metrics["histogram_us"].get(bucket, 0) + 1
+
+        if not self.callback is None:
+            self.callback("stage", {"stage": stage, "seconds": seconds, "bytes": byte_count})
+
+    def _enter(self) -> float:
+        "Opens a measurement frame on the current thread and returns its start time"
+
+        if not hasattr(self.frames, "stack"):
+            self.frames.stack = []
+        self.frames.stack.append(0.0)
+        return time.perf_counter()
+
+    def _exit(self, stage: str, start_time: float, byte_count: int = 0) -> None:
+        """
+        Closes the current measurement frame, the time of nested frames is subtracted and added to the parent frame
+
+        :param stage: Name of the stage
+        :param start_time: The return value of _enter
+        :param byte_count: Number of bytes produced
+        """
+
+        elapsed_time = time.perf_counter() - start_time
+        nested_time = self.frames.stack.pop()
+        if self.frames.stack:
+            self.frames.stack[-1] += elapsed_time
+        self.record(stage, elapsed_time - nested_time, byte_count)
+
+    def time_call(self, stage: str, function: Callable[..., Any], *arguments: Any, byte_count: Optional[int] = None) -> Any:
+        """
+        Calls a function and records its duration, the length of a bytes result is recorded as bytes
+
+        :param stage: Name of the stage
+        :param function: The function to call
+        :param byte_count: Number of bytes processed by the call if it does not return them, e.g. for writes
+        """
+
+        start_time = self._enter()
+        result = None
+        try:
+            result = function(*arguments)
+            return result
+        finally:
+            if byte_count is None:
+                byte_count = len(result) if isinstance(result, (bytes, bytearray, memoryview)) else 0
+            self._exit(stage, start_time, byte_count)
+
+    def time_items(self, stage: str, items: Iterable[Any], measure: Callable[[Any], int] = len) -> Iterator[Any]:
+        """
+        Passes items through and records the time it takes to produce each one
+
+        :param stage: Name of the stage
+        :param items: Iterable, usually of chunks
+        :param measure: Function that returns the number of bytes of an item
+        """
+
+        items = iter(items)
+        while True:
+            start_time = self._enter()
+            item, is_finished = None, False
+            try:
+                item = next(items)
+            except StopIteration:
+                is_finished = True
+            finally:
+                self._exit(stage, start_time, 0 if item is None else measure(item))
+
+            if is_finished:
+                return
+            yield item
+
+    def file_done(self, path: str, size: int, bytes_out: int) -> None:
+        """
+        Counts a processed file and calls the callback
+
+        :param path: The path of the file in the archive
+        :param size: The size of the plain file
+        :param bytes_out: Number of bytes written for the file
+        """
+
+        with self.lock:
+            self.files += 1
+            self.bytes_in += size
+            self.bytes_out += bytes_out
+
+        if not self.callback is None:
+            self.callback("file", {"path": path, "size": size, "bytes_out": bytes_out})
+
+    def snapshot(self) -> dict:
+        "Returns the current metrics as a JSON serializable dict"
+
+        elapsed_time = time.perf_counter() - self.start_time
+
+        with self.lock:
+            stages = {}
+            for stage, stage_metrics in self.stages.items():
+                stages[stage] = {
+                    "calls": stage_metrics["calls"],
+                    "seconds": round(stage_metrics["seconds"], 6),
+                    "bytes": stage_metrics["bytes"],
+                    "mb_per_second": round(stage_metrics["bytes"] / stage_metrics["seconds"] / 1e6, 2) if stage_metrics["seconds"] > 0 else None,
+                    "histogram_us": {str(bucket): count for bucket, count in sorted(stage_metrics["histogram_us"].items())}
+                }
+
+            return {
+                "seconds": round(elapsed_time, 6),
+                "files": self.files,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "files_per_second": round(self.files / elapsed_time, 2) if elapsed_time > 0 else None,
+                "mb_per_second": round(self.bytes_in / elapsed_time / 1e6, 2) if elapsed_time > 0 else None,
+                "stages": stages
+            }
+
+    def finish(self) -> dict:
+        "Calls the callback with the final snapshot and returns it"
+
+        metrics = self.snapshot()
+        if not self.callback is None:
+            self.callback("finish", metrics)
+        return metrics
+
+    def write_metrics(self, metrics_path: str) -> None:
+        """
+        Writes the snapshot as JSON for dashboards, atomically so that a reader never sees a partial file
+
+        :param metrics_path: Path to the metrics file
+        """
+
+        temporary_path = metrics_path + ".tmp"
+        with open(temporary_path, "w") as writeable_file:
+            json.dump(self.snapshot(), writeable_file, indent = 2)
+        os.replace(temporary_path, metrics_path)
+
+def _time_call(instrumentation: Optional[Instrumentation], stage: str, function: Callable[..., Any], *arguments: Any,
+               byte_count: Optional[int] = None) -> Any:
+    """
+    Calls a function, measured if instrumentation is given
+
+    :param instrumentation: Instrumentation or None
+    :param stage: Name of the stage
+    :param function: The function to call
+    :param byte_count: Number of bytes processed by the call if it does not return them
+    """
+
+    if instrumentation is None:
+        return function(*arguments)
+    return instrumentation.time_call(stage, function, *arguments, byte_count = byte_count)
+
+def _time_items(instrumentation: Optional[Instrumentation], stage: str, items: Iterable[Any], measure: Callable[[Any], int] = len) -> Iterable[Any]:
+    """
+    Returns the items, measured if instrumentation is given
+
+    :param instrumentation: Instrumentation or None
+    :param stage: Name of the stage
+    :param items: Iterable, usually of chunks
+    :param measure: Function that returns the number of bytes of an item
+    """
+
+    if instrumentation is None:
+        return items
+    return instrumentation.time_items(stage, items, measure)
+
+def _wrap_data_key(data_key: bytes, encryptions: List[Union[SymmetricEncryption, AsymmetricEncryption]]) -> Tuple[bytes, List[Optional[dict]], List[Optional[dict]]]:
+    """
+    Encrypts the data key of an archive with all layers, each layer adds a constant number of bytes.
+    Returns the key block, the key derivation parameters of each layer (None for public key layers),
+    password layers without parameters are calibrated for this host, and the recipient keys of each layer
+    (None for password and key file layers): the key of a public key layer is not stored in the key block
+    but wrapped for every recipient, so that recipients can be added later without touching the key block.
+
+    :param data_key: The random data key of the archive
+    :param encryptions: The encryption layers in the order in which they are applied
+    """
+
+    key_block = data_key
+    kdfs, recipients = [], []
+    for encryption in encryptions:
+        if isinstance(encryption, SymmetricEncryption):
+            kdf = encryption.kdf or calibrate_kdf()
+            key_block = encryption.encrypt(key_block, kdf)
+            kdfs.append(kdf)
+            recipients.append(None)
+        else:
+            key_block = encryption.encrypt(key_block, detached=True)
+            kdfs.append(None)
+            recipients.append(encryption.recipient_keys())
+    return key_block, kdfs, recipients
+
+def _unwrap_data_key(key_block: bytes, encryptions: List[Union[SymmetricEncryption, AsymmetricEncryption]], kdfs: Optional[List[Optional[dict]]] = None,
+                     recipients: Optional[List[Optional[dict]]] = None) -> bytes:
+    """
+    Decrypts the data key of an archive, the layers are removed in reverse order
+
+    :param key_block: The encrypted data key stored in the archive header
+    :param encryptions: The encryption layers in the order in which they were applied
+    :param kdfs: The key derivation parameters of each layer from the archive header,
+                 None for archives of version 1 that used LEGACY_KDF
+    :param recipients: The recipient keys of each layer from the archive index, None for archives whose
+                       public key layer stores its wrapped key in the key block
+    """
+
+    if kdfs is None:
+        kdfs = [LEGACY_KDF] * len(encryptions)
+    if recipients is None:
+        recipients = [None] * len(encryptions)
+    if len(kdfs) != len(encryptions) or len(recipients) != len(encryptions):
+        raise ValueError(f"The archive has {len(kdfs)} encryption layers, {len(encryptions)} were given.")
+
+    data_key = key_block
+    for encryption, kdf, recipient_keys in zip(reversed(encryptions), reversed(kdfs), reversed(recipients)):
+        if isinstance(encryption, SymmetricEncryption):
+            if kdf is None:
+                raise ValueError("The encryption layers are not in the order in which they were applied.")
+            data_key = encryption.decrypt(data_key, kdf)
+        else:
+            data_key = encryption.decrypt(data_key, recipient_keys)
+    return data_key
+
+def _pack_archive_header(layers: int, key_block: bytes, kdfs: List[Optional[dict]]) -> bytes:
+    """
+    Returns the archive header: magic, version, layers, parameters length, key derivation parameters of each layer
+    as JSON, key block length, key block
+
+    :param layers: Combination of LAYER_PASSWORD, LAYER_PUBLIC_KEY and LAYER_KEY_FILE
+    :param key_block: The encrypted data key
+    :param kdfs: The key derivation parameters of each layer
+    """
+
+    kdf_bytes = json.dumps(kdfs, separators=(",", ":")).encode("utf-8")
+    return (
+        _ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, layers) + struct.pack(">H", len(kdf_bytes)) + kdf_bytes
+        + struct.pack(">I", len(key_block)) + key_block
+    )
+
+def _read_archive_header(read_exact: Callable[[int], bytes]) -> Tuple[int, int, bytes, Optional[List[Optional[dict]]]]:
+    """
+    Reads the archive header and returns the version, the layers, the key block and the key derivation parameters,
+    archives of version 1 have no parameters
+
+    :param read_exact: Function that reads exactly the given number of bytes from the start of the archive
+    """
+
+    magic, version, layers = _ARCHIVE_HEADER.unpack(read_exact(_ARCHIVE_HEADER.size))
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError("The file is not a PyVault archive.")
+    if not version in SUPPORTED_ARCHIVE_VERSIONS:
+        raise ValueError(f"The archive version {version} is not supported.")
+
+    kdfs = None
+    if version >= 2:
+        kdfs = json.loads(read_exact(struct.unpack(">H", read_exact(2))[0]).decode("utf-8"))
+        if not isinstance(kdfs, list):
+            raise ValueError("The key derivation parameters of the archive are damaged.")
+        for kdf in kdfs:
+            if not kdf is None:
+                _check_kdf(kdf)
+
+    key_block = read_exact(struct.unpack(">I", read_exact(4))[0])
+    return version, layers, key_block, kdfs
+
+def _index_hash(header: bytes, index: dict) -> bytes:
+    """
+    Returns the SHA-256 hash of the archive header and the index without the recipients. The recipients are left out
+    so that add_recipients can rewrite them without the data key, a changed recipient key cannot open the key block.
+
+    :param header: The archive header up to the end of the key block
+    :param index: The index of the archive
+    """
+
+    index_bytes = json.dumps({key: value for key, value in index.items() if key != "recipients"}, separators=(",", ":"), sort_keys=True)
+    return hashlib.sha256(header + index_bytes.encode("utf-8")).digest()
+
+def _index_tag(index_hash: bytes, index_key: Optional[bytes]) -> bytes:
+    """
+    Returns the tag that is stored after the index: an HMAC with the index key for encrypted archives,
+    the plain hash for archives without encryption, which detects damage but not modification
+
+    :param index_hash: The hash returned by _index_hash
+    :param index_key: Key derived from the data key with INDEX_KEY_INFO, None without encryption
+    """
+
+    if index_key is None:
+        return index_hash
+    return hmac.new(index_key, index_hash, hashlib.sha256).digest()
+
+def _encode_path(path: str) -> bytes:
+    """
+    Returns the bytes of an archive path for its record and its subkey. File names that are not valid UTF-8 come from
+    os.scandir with surrogate escapes and get their original bytes back, the JSON index stores them escaped.
+
+    :param path: The path in the archive
+    """
+
+    return path.encode("utf-8", "surrogateescape")
+
+def _decode_path(path_bytes: bytes) -> str:
+    """
+    Returns the archive path of the bytes of a record, the inverse of _encode_path
+
+    :param path_bytes: The path bytes of a record
+    """
+
+    return path_bytes.decode("utf-8", "surrogateescape")
+
+class ArchiveWriter:
+    """
+    Writes a PyVault archive entry by entry, so that neither the file structure nor the archive has to fit into memory
+
+    Layout: magic, version, layers, parameters length, key derivation parameters, key block length, key block |
+            per file or chunk: path length, path, codec, size, content length, content | path length 0 |
+            index (compressed archive ID, base archive ID, deleted paths, chunks, blocks, recipients and list of
+            path, size, content offset, content length, codec, chunk IDs) | index tag | index offset, magic
+
+    If encryptions are given, a random data key is encrypted once with all layers and stored as key block,
+    every content is then encrypted a single time with a key derived from the data key and its path.
+    The index tag is an HMAC of the header and the index with a key derived from the data key,
+    readers check it when the archive is unlocked, before any entry is used.
+    The key derivation parameters of the password and key file layers are stored in the header,
+    so that they are decrypted with exactly the cost that was chosen when the archive was written.
+    The key of a public key layer is wrapped for each recipient and stored in the index (recipients),
+    add_recipients gives further public keys access by rewriting only the index.
+
+    With deduplication files are split into content-defined chunks that are stored once per ID and
+    files refer to their list of chunk IDs, chunk records have a path that starts with a null byte
+
+    Solid blocks hold the contents of many small files that are compressed and encrypted as one unit,
+    block records have a path that starts with the byte 1 and the offset table of each block is kept in the index:
+    files refer to their block ID and their offset in the plain block (index: blocks and a 7th entry field)
+    """
+
+    def __init__(self, output_file: BinaryIO, encryptions: Optional[List[Union[SymmetricEncryption, AsymmetricEncryption]]] = None,
+                 layers: int = 0, codec: str = "gzip", compression_level: int = 9, detect_incompressible: bool = True,
+                 base_archive_id: Optional[str] = None, deduplicate: bool = False, chunk_key: Optional[bytes] = None,
+                 known_chunk_ids: Optional[Union[set, "KnownChunkIds"]] = None, instrumentation: Optional[Instrumentation] = None):
+        """
+        :param output_file: Writeable and seekable file-like object
+        :param encryptions: The encryption layers in the order in which they are applied
+        :param layers: Combination of LAYER_PASSWORD, LAYER_PUBLIC_KEY and LAYER_KEY_FILE
+        :param codec: The compression codec used by add_file, "raw", "gzip", "lzma" or "fast"
+        :param compression_level: The compression level from 1 (fast) to 9 (small)
+        :param detect_incompressible: Whether files that look incompressible (media, archives, encrypted data) are stored raw
+        :param base_archive_id: ID of the archive this delta archive is layered over on restore
+        :param deduplicate: Whether files are split into content-defined chunks that are stored only once
+        :param chunk_key: Secret key for the chunk IDs so that they reveal nothing about the content,
+                          has to be the same for all archives that share chunks
+        :param known_chunk_ids: IDs of chunks that are already stored in the base archives
+        :param instrumentation: Instrumentation that measures the stages of the archive
+        """
+
+        self.output_file = output_file
+        self.instrumentation = instrumentation
+        self.codec, self.compression_level = resolve_codec(codec, compression_level)
+        self.detect_incompressible = detect_incompressible
+
+        self.data_key, self.index_key, key_block, kdfs, self.recipients = None, None, b"", [], []
+        if encryptions:
+            self.data_key = secrets.token_bytes(DATA_KEY_SIZES[ARCHIVE_VERSION])
+            self.index_key = derive_subkey(self.data_key, b"", INDEX_KEY_INFO)
+            key_block, kdfs, self.recipients = _time_call(instrumentation, "key_wrap", _wrap_data_key, self.data_key, encryptions)
+
+        self.header = _pack_archive_header(layers, key_block, kdfs)
+        output_file.write(self.header)
+        self.index = []
+        self.deleted_paths = []
+        self.archive_id = secrets.token_hex(16)
+        self.base_archive_id = base_archive_id
+
+        self.deduplicate = deduplicate
+        self.chunk_key = secrets.token_bytes(32) if chunk_key is None else chunk_key
+        self.known_chunk_ids = set() if known_chunk_ids is None else known_chunk_ids
+        self.chunk_index = {}
+        self.block_index = {}
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback) -> None:
+        if exception_type is None:
+            self.close()
+
+    def process_chunks(self, path: str, plain_chunks: Iterable[bytes]) -> Tuple[str, Iterator[bytes]]:
+        """
+        Compresses and encrypts the content of a file for this archive, returns the chosen codec and the content chunks.
+        The codec is chosen from the first chunk, can be called from several threads.
+
+        :param path: The path under which the content is stored
+        :param plain_chunks: Iterable of plain bytes
+        """
+
+        return self._encode_chunks(_encode_path(path), ENTRY_KEY_INFO, plain_chunks)
+
+    def _encode_chunks(self, key_nonce: bytes, key_info: bytes, plain_chunks: Iterable[bytes]) -> Tuple[str, Iterator[bytes]]:
+        """
+        Compresses and encrypts content with a key derived from the data key
+
+        :param key_nonce: The path of a file or the ID of a chunk
+        :param key_info: ENTRY_KEY_INFO or CHUNK_KEY_INFO
+        :param plain_chunks: Iterable of plain bytes
+        """
+
+        plain_chunks = iter(plain_chunks)
+        first_chunk = next(plain_chunks, b"")
+
+        codec = self.codec
+        if self.detect_incompressible and codec != "raw":
+            codec = choose_codec(first_chunk, codec)
+
+        chunks = _time_items(self.instrumentation, "compress", compress_chunks(chain([first_chunk], plain_chunks), codec, self.compression_level))
+        if self.data_key is None:
+            return codec, chunks
+
+        entry_key = derive_subkey(self.data_key, key_nonce, key_info)
+        return codec, _time_items(self.instrumentation, "encrypt", StreamEncryption(entry_key).encrypt_chunks(chunks))
+
+    def chunk_id(self, chunk: bytes) -> str:
+        """
+        Returns the ID of a chunk, a keyed hash so that equal chunks are found without revealing plain hashes
+
+        :param chunk: The plain chunk
+        """
+
+        return hmac.new(self.chunk_key, chunk, hashlib.sha256).hexdigest()[:32]
+
+    def process_deduplicated_chunks(self, plain_chunks: Iterable[bytes]) -> Iterator[Tuple[str, int, Optional[str], Optional[bytes]]]:
+        """
+        Splits the content of a file into content-defined chunks and compresses and encrypts the chunks that are
+        not stored yet, returns the ID, size, codec and content of each chunk. Can be called from several threads.
+
+        :param plain_chunks: Iterable of plain bytes
+        """
+
+        for chunk in _time_items(self.instrumentation, "chunking", split_content_defined(plain_chunks)):
+            chunk_id = _time_call(self.instrumentation, "hash", self.chunk_id, chunk)
+            if chunk_id in self.chunk_index or chunk_id in self.known_chunk_ids:
+                yield chunk_id, len(chunk), None, None
+                continue
+
+            codec, content_chunks = self._encode_chunks(chunk_id.encode("utf-8"), CHUNK_KEY_INFO, [chunk])
+            yield chunk_id, len(chunk), codec, b"".join(content_chunks)
+
+    def add_deduplicated_entry(self, path: str, size: int, processed_chunks: Iterable[Tuple[str, int, Optional[str], Optional[bytes]]]) -> None:
+        """
+        Appends a file as a list of chunks, only chunks that are not stored yet are written
+
+        :param path: The path under which the file is stored
+        :param size: The size of the plain file
+        :param processed_chunks: The result of process_deduplicated_chunks
+        """
+
+        chunk_ids = []
+        bytes_out = 0
+        for chunk_id, chunk_size, codec, content in processed_chunks:
+            if not content is None and not chunk_id in self.chunk_index and not chunk_id in self.known_chunk_ids:
+                content_offset, content_length = self._write_record(b"\x00" + chunk_id.encode("utf-8"), chunk_size, [content], codec)
+                self.chunk_index[chunk_id] = [content_offset, content_length, codec]
+                bytes_out += content_length
+            chunk_ids.append(chunk_id)
+
+        self.index.append([path, size, None, None, None, chunk_ids])
+        if not self.instrumentation is None:
+            self.instrumentation.file_done(path, size, bytes_out)
+
+    def process_block(self, plain_contents: List[bytes]) -> Tuple[str, str, bytes]:
+        """
+        Compresses and encrypts the contents of several small files as one solid block, so that fixed costs
+        are paid once per block and the compression sees the files together. Returns the ID, codec and content
+        of the block. Can be called from several threads.
+
+        :param plain_contents: The plain contents of the files in the order in which they are added
+        """
+
+        block_id = secrets.token_hex(16)
+        codec, content_chunks = self._encode_chunks(block_id.encode("utf-8"), BLOCK_KEY_INFO, [b"".join(plain_contents)])
+        return block_id, codec, b"".join(content_chunks)
+
+    def add_block(self, block_id: str, files: List[Tuple[str, int]], codec: str, content: bytes) -> None:
+        """
+        Appends a solid block and an entry for each of its files
+
+        :param block_id: The ID of the block from process_block
+        :param files: Path and plain size of each file in the order of their contents in the block
+        :param codec: The compression codec of the block
+        :param content: The content of the block from process_block
+        """
+
+        block_size = sum(size for _, size in files)
+        content_offset, content_length = self._write_record(b"\x01" + block_id.encode("utf-8"), block_size, [content], codec)
+        self.block_index[block_id] = [content_offset, content_length, codec]
+
+        block_offset = 0
+        for path, size in files:
+            self.index.append([path, size, None, None, None, None, [block_id, block_offset]])
+            if not self.instrumentation is None:
+                # The written bytes are shared by the files of the block in proportion to their size
+                bytes_out = content_length * (block_offset + size) // max(1, block_size) - content_length * block_offset // max(1, block_size)
+                self.instrumentation.file_done(path, size, bytes_out)
+            block_offset += size
+
+    def add_entry(self, path: str, size: int, content_chunks: Iterable[bytes], codec: str = "gzip") -> None:
+        """
+        Appends an entry whose content is already compressed and encrypted, chunks are written as they arrive
+
+        :param path: The path under which the content is stored
+        :param size: The size of the plain file
+        :param content_chunks: Iterable of the final content bytes
+        :param codec: The compression codec of the content
+        """
+
+        content_offset, content_length = self._write_record(_encode_path(path), size, content_chunks, codec)
+        self.index.append([path, size, content_offset, content_length, codec, None])
+        if not self.instrumentation is None:
+            self.instrumentation.file_done(path, size, content_length)
+
+    def _write_record(self, path_bytes: bytes, size: int, content_chunks: Iterable[bytes], codec: str) -> Tuple[int, int]:
+        """
+        Writes a record and returns the offset and length of its content, a failed record is removed again
+
+        :param path_bytes: The encoded path of a file or the marked ID of a chunk
+        :param size: The size of the plain content
+        :param content_chunks: Iterable of the final content bytes
+        :param codec: The compression codec of the content
+        """
+
+        entry_offset = self.output_file.tell()
+        self.output_file.write(struct.pack(">H", len(path_bytes)) + path_bytes + _ENTRY_HEADER.pack(COMPRESSION_CODECS.index(codec), size, 0))
+        content_offset = self.output_file.tell()
+
+        try:
+            for chunk in content_chunks:
+                _time_call(self.instrumentation, "write", self.output_file.write, chunk, byte_count = len(chunk))
+        except BaseException:
+            self.output_file.seek(entry_offset)
+            self.output_file.truncate()
+            raise
+
+        content_length = self.output_file.tell() - content_offset
+
+        # The content length is only known at the end, it is written into the reserved field
+        self.output_file.seek(content_offset - 8)
+        self.output_file.write(struct.pack(">Q", content_length))
+        self.output_file.seek(0, os.SEEK_END)
+
+        return content_offset, content_length
+
+    def add_file(self, file_path: str, path: Optional[str] = None, content_hash: Optional[Any] = None, read_ahead: int = 0) -> None:
+        """
+        Reads, compresses and encrypts a file chunk by chunk and appends it, memory usage is independent of the file size
+
+        :param file_path: Path to file
+        :param path: The path under which the content is stored, defaults to file_path
+        :param content_hash: A hashlib object that is updated with the plain content
+        :param read_ahead: Number of chunks that are read ahead in a background thread, for storage with high latency
+        """
+
+        with open(file_path, "rb") as readable_file:
+            size = os.fstat(readable_file.fileno()).st_size
+            if read_ahead > 0:
+                plain_chunks = prefetch_items(read_file_chunks(readable_file), read_ahead)
+            else:
+                plain_chunks = read_file_chunks(readable_file) # Chunks are kept by the cipher, a buffer cannot be reused
+            plain_chunks = _time_items(self.instrumentation, "read", plain_chunks)
+            if not content_hash is None:
+                plain_chunks = _time_items(self.instrumentation, "hash", _hash_chunks(plain_chunks, content_hash))
+
+            if self.deduplicate:
+                self.add_deduplicated_entry(path or file_path, size, self.process_deduplicated_chunks(plain_chunks))
+            else:
+                codec, content_chunks = self.process_chunks(path or file_path, plain_chunks)
+                self.add_entry(path or file_path, size, content_chunks, codec)
+
+    def delete(self, path: str) -> None:
+        """
+        Records that a file of the base archive was deleted, it is removed when this archive is layered over the base
+
+        :param path: The path of the file in the base archive
+        """
+
+        self.deleted_paths.append(path)
+
+    def close(self) -> None:
+        "Finishes the archive with the index of all entries, the output file itself is not closed"
+
+        self.output_file.write(struct.pack(">H", 0))
+
+        index_offset = self.output_file.tell()
+        index = {
+            "archive": self.archive_id,
+            "base": self.base_archive_id,
+            "deleted": self.deleted_paths,
+            "chunks": self.chunk_index,
+            "blocks": self.block_index,
+            "recipients": self.recipients,
+            "entries": self.index
+        }
+        self.output_file.write(_time_call(self.instrumentation, "index", compress_dict_or_list, index))
+        self.output_file.write(_index_tag(_index_hash(self.header, index), self.index_key))
+        self.output_file.write(_ARCHIVE_FOOTER.pack(index_offset, ARCHIVE_MAGIC))
+        self.output_file.flush()
+
+class ArchiveReader:
+    """
+    Reads a PyVault archive with random access: the index at the end of the archive is loaded once,
+    listing needs no decryption and extracting a file costs one seek and the decryption of that file only.
+    The index of an encrypted archive is authenticated when it is unlocked, until then list shows unchecked paths.
+    """
+
+    def __init__(self, input_file: BinaryIO, instrumentation: Optional[Instrumentation] = None):
+        """
+        :param input_file: Readable and seekable file-like object
+        :param instrumentation: Instrumentation that measures the stages of reading and extracting
+        """
+
+        self.input_file = input_file
+        self.instrumentation = instrumentation
+
+        input_file.seek(0)
+        self.version, self.layers, self.key_block, self.kdfs = _read_archive_header(lambda length: self._read_at(input_file.tell(), length))
+        header = self._read_at(0, input_file.tell())
+        self.data_key = None
+
+        archive_size = input_file.seek(0, os.SEEK_END)
+        self.index_offset, footer_magic = _ARCHIVE_FOOTER.unpack(self._read_at(archive_size - _ARCHIVE_FOOTER.size, _ARCHIVE_FOOTER.size))
+        if footer_magic != ARCHIVE_MAGIC:
+            raise ValueError("The archive has no index, it is incomplete.")
+
+        # Archives before version 3 have no index tag
+        index_end = archive_size - _ARCHIVE_FOOTER.size - (INDEX_TAG_SIZE if self.version >= 3 else 0)
+        if index_end < self.index_offset:
+            raise ValueError("The index of the archive is damaged.")
+        self.index_tag = self._read_at(index_end, archive_size - _ARCHIVE_FOOTER.size - index_end) if self.version >= 3 else None
+        index = _time_call(instrumentation, "index", decompress_bytes_to_dict_or_list, self._read_at(self.index_offset, index_end - self.index_offset))
+        self.index_hash = _index_hash(header, index)
+        if not self.is_encrypted:
+            self._check_index(None)
+        self.archive_id, self.base_archive_id, self.deleted_paths = index["archive"], index["base"], index["deleted"]
+        # Fingerprint: wrapped key for each public key layer, older archives store the wrapped key in the key block
+        self.recipients = index.get("recipients") or None
+        # Archives without deduplication may have been written without chunk IDs, only files in solid blocks have a block
+        self.entries = {
+            path: {
+                "size": size, "offset": offset, "length": length, "codec": codec,
+                "chunks": references[0] if references else None,
+                "block": references[1] if len(references) > 1 else None
+            }
+            for path, size, offset, length, codec, *references in index["entries"]
+        }
+        self.chunks = {
+            chunk_id: {"offset": offset, "length": length, "codec": codec}
+            for chunk_id, (offset, length, codec) in index.get("chunks", {}).items()
+        }
+        self.blocks = {
+            block_id: {"offset": offset, "length": length, "codec": codec}
+            for block_id, (offset, length, codec) in index.get("blocks", {}).items()
+        }
+
+        # The last decoded block, files of a block are usually read one after another
+        self.cached_block = (None, b"")
+
+        # Readers of base archives that hold chunks referenced by this archive, set by restore_archives
+        self.chunk_sources = {}
+
+    def _read_at(self, offset: int, length: int) -> bytes:
+        """
+        Reads exactly length bytes at the given offset
+
+        :param offset: Position in the archive
+        :param length: Number of bytes
+        """
+
+        self.input_file.seek(offset)
+        data = self.input_file.read(length)
+        if len(data) != length:
+            raise ValueError("The archive is incomplete.")
+        return data
+
+    @property
+    def is_encrypted(self) -> bool:
+        "Whether the archive has a key block"
+
+        return len(self.key_block) > 0
+
+    def unlock(self, encryptions: List[Union[SymmetricEncryption, AsymmetricEncryption]]) -> "ArchiveReader":
+        """
+        Decrypts the data key of the archive, required before encrypted files can be read
+
+        :param encryptions: The encryption layers in the order in which they were applied
+        """
+
+        if self.is_encrypted:
+            self._use_data_key(_time_call(self.instrumentation, "key_unwrap", _unwrap_data_key, self.key_block, encryptions, self.kdfs, self.recipients))
+        return self
+
+    def _check_index(self, index_key: Optional[bytes]) -> None:
+        """
+        Compares the index tag of archives from version 3 on with the tag of the loaded index
+
+        :param index_key: Key derived from the data key with INDEX_KEY_INFO, None without encryption
+        """
+
+        if not self.index_tag is None and not hmac.compare_digest(_index_tag(self.index_hash, index_key), self.index_tag):
+            raise ValueError("The index of the archive was modified or is damaged.")
+
+    def _use_data_key(self, data_key: bytes) -> None:
+        """
+        Checks the index with the unwrapped data key and keeps the key, so that no entry is used before the check
+
+        :param data_key: The data key from the key block
+        """
+
+        if len(data_key) != DATA_KEY_SIZES[self.version]:
+            raise ValueError("The data key does not match the archive version, the header was modified.")
+        self._check_index(derive_subkey(data_key, b"", INDEX_KEY_INFO) if self.version >= 3 else None)
+        self.data_key = data_key
+
+    def list(self) -> List[Tuple[str, int]]:
+        "Returns the path and size of all files in the archive"
+
+        return [(path, entry["size"]) for path, entry in self.entries.items()]
+
+    def read_chunks(self, path: str) -> Iterator[bytes]:
+        """
+        Returns the plain content of a file chunk by chunk, each chunk is verified before it is returned
+
+        :param path: The path of the file in the archive
+        """
+
+        entry = self.entries.get(path)
+        if entry is None:
+            raise KeyError(f"The file {path} is not in the archive.")
+
+        if not entry["chunks"] is None:
+            return (self.read_chunk(chunk_id) for chunk_id in entry["chunks"])
+        if not entry["block"] is None:
+            block_id, block_offset = entry["block"]
+            return iter([self.read_block(block_id)[block_offset:block_offset + entry["size"]]])
+        return self._read_record(entry, _encode_path(path), ENTRY_KEY_INFO)
+
+    def read_chunk(self, chunk_id: str) -> bytes:
+        """
+        Returns a plain deduplicated chunk from this archive or from the base archive that stores it
+
+        :param chunk_id: The ID of the chunk
+        """
+
+        chunk = self.chunks.get(chunk_id)
+        if chunk is None:
+            chunk_source = self.chunk_sources.get(chunk_id)
+            if chunk_source is None:
+                raise KeyError(f"The chunk {chunk_id} is stored in a base archive, restore the archives together with restore_archives.")
+            return chunk_source.read_chunk(chunk_id)
+
+        return b"".join(self._read_record(chunk, chunk_id.encode("utf-8"), CHUNK_KEY_INFO))
+
+    def read_block(self, block_id: str) -> bytes:
+        """
+        Returns a plain solid block, the last block is cached so that its files are decoded only once
+
+        :param block_id: The ID of the block
+        """
+
+        cached_block_id, cached_block = self.cached_block
+        if cached_block_id == block_id:
+            return cached_block
+
+        block = self.blocks.get(block_id)
+        if block is None:
+            raise KeyError(f"The block {block_id} is not in the archive.")
+
+        plain_block = b"".join(self._read_record(block, block_id.encode("utf-8"), BLOCK_KEY_INFO))
+        self.cached_block = (block_id, plain_block)
+        return plain_block
+
+    def unlock_with_agent(self, agent_client: "AgentClient") -> "ArchiveReader":
+        """
+        Gets the data key of the archive from a key agent that holds the credentials, instead of deriving it here
+
+        :param agent_client: Client of a running KeyAgent
+        """
+
+        if self.is_encrypted:
+            self._use_data_key(_time_call(self.instrumentation, "key_unwrap", agent_client.unwrap_data_key, self.key_block, self.layers, self.kdfs, self.recipients))
+        return self
+
+    def _read_record(self, record: dict, key_nonce: bytes, key_info: bytes) -> Iterator[bytes]:
+        """
+        Reads, decrypts and decompresses the content of a record chunk by chunk
+
+        :param record: Entry, chunk or block with offset, length and codec
+        :param key_nonce: The path of a file or the ID of a chunk or block
+        :param key_info: ENTRY_KEY_INFO, CHUNK_KEY_INFO or BLOCK_KEY_INFO
+        """
+
+        if self.is_encrypted and self.data_key is None:
+            raise ValueError("The archive is encrypted, it has to be unlocked first.")
+
+        def read_content() -> Iterator[bytes]:
+            self.input_file.seek(record["offset"])
+            remaining = record["length"]
+            while remaining > 0:
+                chunk = self.input_file.read(min(remaining, STREAM_CHUNK_SIZE + StreamEncryption.TAG_LENGTH))
+                if not chunk:
+                    raise ValueError("The archive is incomplete.")
+                remaining -= len(chunk)
+                yield chunk
+
+        chunks = _time_items(self.instrumentation, "read", read_content())
+        if self.is_encrypted:
+            chunks = _time_items(self.instrumentation, "decrypt", StreamEncryption(derive_subkey(self.data_key, key_nonce, key_info)).decrypt_chunks(chunks))
+        return _time_items(self.instrumentation, "decompress", decompress_chunks(chunks, record["codec"]))
+
+    def extract(self, path: str, output_directory: str) -> str:
+        """
+        Restores a single file into a directory and returns its new path
+
+        :param path: The path of the file in the archive
+        :param output_directory: The directory into which the file is restored
+        """
+
+        path_parts = path.split("/")
+        if path.startswith("/") or ".." in path_parts:
+            raise ValueError(f"The path {path} would be restored outside of the output directory.")
+
+        output_path = os.path.join(output_directory, *path_parts)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        with open(output_path, "wb") as writeable_file:
+            for chunk in self.read_chunks(path):
+                _time_call(self.instrumentation, "write", writeable_file.write, chunk, byte_count = len(chunk))
+
+        if not self.instrumentation is None:
+            self.instrumentation.file_done(path, self.entries[path]["size"], self.entries[path]["size"])
+        return output_path
+
+    def extract_all(self, output_directory: str) -> int:
+        """
+        Restores all files into a directory in the order in which they are stored, returns the number of files
+
+        :param output_directory: The directory into which the files are restored
+        """
+
+        def record_offset(path: str) -> int:
+            entry = self.entries[path]
+            if not entry["block"] is None:
+                return self.blocks[entry["block"][0]]["offset"]
+            return entry["offset"] or 0
+
+        for path in sorted(self.entries, key = record_offset):
+            self.extract(path, output_directory)
+        return len(self.entries)
+
+def restore_archives(archive_readers: List[ArchiveReader], output_directory: str, paths: Optional[Iterable[str]] = None) -> int:
+    """
+    Restores a full archive followed by its delta archives: each file is taken from the newest archive
+    that contains it and files deleted in a later archive are skipped. Returns the number of restored files.
+
+    :param archive_readers: Unlocked readers, starting with the full archive, each delta directly follows its base
+    :param output_directory: The directory into which the files are restored
+    :param paths: Paths of the files that are restored, defaults to all files
+    """
+
+    file_readers = {}
+    chunk_sources = {}
+    for i, archive_reader in enumerate(archive_readers):
+        if i > 0 and archive_reader.base_archive_id != archive_readers[i - 1].archive_id:
+            raise ValueError("The archives do not form a chain, every delta archive has to follow its base archive.")
+
+        for path in archive_reader.deleted_paths:
+            file_readers.pop(path, None)
+        for path in archive_reader.entries:
+            file_readers[path] = archive_reader
+        for chunk_id in archive_reader.chunks:
+            chunk_sources[chunk_id] = archive_reader
+
+    for archive_reader in archive_readers:
+        archive_reader.chunk_sources = chunk_sources
+
+    if not paths is None:
+        missing_paths = [path for path in paths if not path in file_readers]
+        if missing_paths:
+            raise KeyError(f"The files {', '.join(missing_paths)} are not in the archives.")
+        file_readers = {path: file_readers[path] for path in paths}
+
+    for path, archive_reader in file_readers.items():
+        archive_reader.extract(path, output_directory)
+    return len(file_readers)
+
+def add_recipients(archive_file: BinaryIO, encryption: AsymmetricEncryption, public_keys: List[str]) -> int:
+    """
+    Gives further public keys access to an archive without re-encrypting it: the key of the public key layer is
+    unwrapped with the private key of an existing recipient and wrapped once per new public key, only the index
+    at the end of the archive is rewritten. Returns the number of added recipients.
+
+    :param archive_file: Readable, writeable and seekable archive file
+    :param encryption: AsymmetricEncryption with the private key of a recipient
+    :param public_keys: The public keys of the new recipients, e.g. from KeyRing.public_keys
+    """
+
+    archive_reader = ArchiveReader(archive_file)
+    if archive_reader.recipients is None or all(recipient_keys is None for recipient_keys in archive_reader.recipients):
+        raise ValueError("The archive has no recipients, it has no public key layer or was written by an older version.")
+
+    archive_size = archive_file.seek(0, os.SEEK_END)
+    archive_file.seek(archive_reader.index_offset)
+    index_bytes = archive_file.read(archive_size - archive_reader.index_offset)
+    # The recipients are not covered by the index tag, it stays valid and is written again unchanged
+    index_tag = archive_reader.index_tag or b""
+    index = decompress_bytes_to_dict_or_list(index_bytes[:-_ARCHIVE_FOOTER.size - len(index_tag)])
+
+    added_count = 0
+    for recipient_keys in index["recipients"]:
+        if recipient_keys is None:
+            continue
+
+        layer_key = encryption.unwrap_recipient_key(recipient_keys)
+        for public_key in public_keys:
+            fingerprint = KeyRing.fingerprint(public_key)
+            if not fingerprint in recipient_keys:
+                recipient_keys[fingerprint] = AsymmetricEncryption.wrap_key(layer_key, public_key)
+                added_count += 1
+
+    if added_count == 0:
+        return 0
+
+    archive_file.seek(archive_reader.index_offset)
+    archive_file.truncate()
+    try:
+        archive_file.write(compress_dict_or_list(index) + index_tag + _ARCHIVE_FOOTER.pack(archive_reader.index_offset, ARCHIVE_MAGIC))
+        archive_file.flush()
+    except BaseException:
+        # The previous index is restored so that the archive stays readable
+        archive_file.seek(archive_reader.index_offset)
+        archive_file.truncate()
+        archive_file.write(index_bytes)
+        archive_file.flush()
+        raise
+
+    return added_count
+
+AGENT_SOCKET_VARIABLE = "PYVAULT_AGENT_SOCKET"
+AGENT_TTL = 15 * 60
+AGENT_MEMORY_SIZE = 256 * 1024
+LOCKED_BLOCK_SIZE = 64
+
+def default_agent_socket() -> str:
+    "Returns the socket path of the key agent, PYVAULT_AGENT_SOCKET or a file in the private runtime directory of the user"
+
+    socket_path = os.environ.get(AGENT_SOCKET_VARIABLE)
+    if socket_path:
+        return socket_path
+
+    runtime_directory = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(), f"pyvault-{os.getuid()}")
+    return os.path.join(runtime_directory, "pyvault-agent.sock")
+
+class LockedMemory:
+    """
+    Storage for secrets in an anonymous memory mapping that is locked into RAM with mlock, so that it is never
+    written to swap, and excluded from core dumps where the platform supports it. Every secret has an expiry time,
+    removed and expired secrets are overwritten with zeros.
+    """
+
+    def __init__(self, size: int = AGENT_MEMORY_SIZE):
+        """
+        :param size: Size of the mapping in bytes, it has to fit into the RLIMIT_MEMLOCK limit to be locked
+        """
+
+        self.buffer = mmap.mmap(-1, size)
+        self.used_blocks = bytearray(size // LOCKED_BLOCK_SIZE)
+        self.secrets = {} # Name: [offset, length, expiry]
+        self.lock = threading.Lock()
+
+        self.locked = self._lock_pages()
+        if hasattr(mmap, "MADV_DONTDUMP"):
+            try:
+                self.buffer.madvise(mmap.MADV_DONTDUMP)
+            except OSError:
+                pass
+
+    def _lock_pages(self) -> bool:
+        "Locks the mapping into RAM, returns False if the platform or the RLIMIT_MEMLOCK limit does not allow it"
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            address = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+            return libc.mlock(ctypes.c_void_p(address), ctypes.c_size_t(len(self.buffer))) == 0
+        except (OSError, AttributeError, TypeError):
+            return False
+
+    def _remove(self, name: str) -> None:
+        "Zeroes and frees a secret, the lock has to be held"
+
+        secret = self.secrets.pop(name, None)
+        if not secret is None:
+            offset, length, _ = secret
+            self.buffer[offset:offset + length] = bytes(length)
+            first_block, block_count = offset // LOCKED_BLOCK_SIZE, max(1, -(-length // LOCKED_BLOCK_SIZE))
+            self.used_blocks[first_block:first_block + block_count] = bytes(block_count)
+
+    def put(self, name: str, secret: bytes, expiry: float) -> None:
+        """
+        Stores a secret, a secret with the same name is replaced
+
+        :param name: Name of the secret
+        :param secret: The secret bytes
+        :param expiry: time.monotonic() at which the secret is removed
+        """
+
+        block_count = max(1, -(-len(secret) // LOCKED_BLOCK_SIZE))
+        with self.lock:
+            self._remove(name)
+            first_block = self.used_blocks.find(bytes(block_count))
+            if first_block < 0:
+                raise ValueError("The locked memory is full.")
+
+            self.used_blocks[first_block:first_block + block_count] = b"\x01" * block_count
+            offset = first_block * LOCKED_BLOCK_SIZE
+            self.buffer[offset:offset + len(secret)] = secret
+            self.secrets[name] = [offset, len(secret), expiry]
+
+    def get(self, name: str) -> Optional[bytes]:
+        """
+        Returns a copy of a secret, None if it does not exist or expired
+
+        :param name: Name of the secret
+        """
+
+        with self.lock:
+            secret = self.secrets.get(name)
+            if secret is None:
+                return None
+            offset, length, expiry = secret
+            if expiry <= time.monotonic():
+                self._remove(name)
+                return None
+            return self.buffer[offset:offset + length]
+
+    def expiry(self, name: str) -> Optional[float]:
+        """
+        Returns the expiry time of a secret, None if it does not exist
+
+        :param name: Name of the secret
+        """
+
+        with self.lock:
+            secret = self.secrets.get(name)
+            return None if secret is None else secret[2]
+
+    def remove(self, name: str) -> None:
+        """
+        Zeroes and removes a secret
+
+        :param name: Name of the secret
+        """
+
+        with self.lock:
+            self._remove(name)
+
+    def evict_expired(self) -> List[str]:
+        "Zeroes and removes all expired secrets, returns their names"
+
+        now = time.monotonic()
+        with self.lock:
+            expired_names = [name for name, (_, _, expiry) in self.secrets.items() if expiry <= now]
+            for name in expired_names:
+                self._remove(name)
+        return expired_names
+
+    def names(self) -> dict:
+        "Returns the names of all secrets and their expiry times"
+
+        with self.lock:
+            return {name: expiry for name, (_, _, expiry) in self.secrets.items()}
+
+    def close(self) -> None:
+        "Zeroes all secrets and releases the mapping"
+
+        with self.lock:
+            self.secrets = {}
+            self.buffer[:] = bytes(len(self.buffer))
+            self.buffer.close()
+
+class KeyAgent:
+    """
+    Key agent similar to ssh-agent: holds passwords, key files and private keys and unwraps the data keys of archives
+    for clients (AgentClient) on a Unix socket, so repeated operations skip the password KDF and the parsing of keys.
+
+    Passwords, key files, derived master keys and unwrapped data keys are kept in LockedMemory. Parsed private keys
+    live in the memory of the cryptography backend, which cannot be locked, core dumps of the agent are disabled instead.
+    Everything is removed after its TTL, derived and unwrapped keys expire with the credentials they came from.
+    """
+
+    # The layers are applied in the same order as by the interactive mode and the command line interface
+    LAYER_KINDS = ((LAYER_PASSWORD, "password"), (LAYER_PUBLIC_KEY, "private_key"), (LAYER_KEY_FILE, "key_file"))
+
+    def __init__(self, ttl: float = AGENT_TTL, memory_size: int = AGENT_MEMORY_SIZE):
+        """
+        :param ttl: Default lifetime of added credentials in seconds
+        :param memory_size: Size of the locked memory in bytes
+        """
+
+        self.ttl = ttl
+        self.memory = LockedMemory(memory_size)
+        self.private_keys = {} # Fingerprint: [AsymmetricEncryption, expiry]
+        self.master_key_names = {} # Name in the memory: [kind, salt, key derivation parameters as JSON]
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def add(self, kind: str, secret: bytes, ttl: Optional[float] = None) -> str:
+        """
+        Adds a credential and returns its name, a password or key file replaces the previous one
+
+        :param kind: "password", "key_file" or "private_key"
+        :param secret: The password, the content of the key file or the base64 encoded private key
+        :param ttl: Lifetime in seconds, defaults to the TTL of the agent
+        """
+
+        expiry = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        if kind in ("password", "key_file"):
+            self.memory.put(kind, secret, expiry)
+            with self.lock:
+                for name in [name for name, (master_kind, _, _) in self.master_key_names.items() if master_kind == kind]:
+                    del self.master_key_names[name]
+                    self.memory.remove(name)
+            return kind
+
+        if kind == "private_key":
+            encryption = AsymmetricEncryption(private_key=secret.decode("utf-8"))
+            encryption.private_key = None # Only the parsed key is kept
+            fingerprint = encryption.fingerprint()
+            with self.lock:
+                self.private_keys[fingerprint] = [encryption, expiry]
+            return fingerprint
+
+        raise ValueError(f"The kind {kind} is not supported, use password, key_file or private_key.")
+
+    def evict_expired(self) -> None:
+        "Removes expired credentials and keys"
+
+        now = time.monotonic()
+        with self.lock:
+            for fingerprint in [fingerprint for fingerprint, (_, expiry) in self.private_keys.items() if expiry <= now]:
+                del self.private_keys[fingerprint]
+            for name in self.memory.evict_expired():
+                self.master_key_names.pop(name, None)
+
+    def clear(self) -> None:
+        "Removes all credentials and keys"
+
+        with self.lock:
+            self.private_keys = {}
+            for name in self.memory.names():
+                self.memory.remove(name)
+            self.master_key_names = {}
+
+    def _symmetric_encryption(self, kind: str) -> Tuple[SymmetricEncryption, float]:
+        """
+        Returns a SymmetricEncryption for a password or key file with the master keys that were derived before,
+        and the expiry time of the credential
+
+        :param kind: "password" or "key_file"
+        """
+
+        secret, expiry = self.memory.get(kind), self.memory.expiry(kind)
+        if secret is None:
+            raise ValueError(f"The agent holds no {kind.replace('_', ' ')}.")
+
+        encryption = SymmetricEncryption(secret)
+        with self.lock:
+            master_key_names = [(name, salt, kdf_json) for name, (master_kind, salt, kdf_json) in self.master_key_names.items() if master_kind == kind]
+        for name, salt, kdf_json in master_key_names:
+            master_key = self.memory.get(name)
+            if not master_key is None:
+                encryption.master_keys[(salt, kdf_json)] = master_key
+        return encryption, expiry
+
+    def _keep_master_keys(self, kind: str, encryption: SymmetricEncryption, expiry: float) -> None:
+        "Moves the master keys that a SymmetricEncryption derived into the locked memory"
+
+        for (salt, kdf_json), master_key in encryption.master_keys.items():
+            name = "master_key:" + hashlib.sha256(kind.encode("utf-8") + salt + kdf_json.encode("utf-8")).hexdigest()
+            self.memory.put(name, master_key, expiry)
+            with self.lock:
+                self.master_key_names[name] = [kind, salt, kdf_json]
+        encryption.master_keys.clear()
+
+    def unwrap_data_key(self, key_block: bytes, layers: int, kdfs: Optional[List[Optional[dict]]] = None,
+                        recipients: Optional[List[Optional[dict]]] = None) -> bytes:
+        """
+        Returns the data key of an archive, unwrapped with the credentials of the agent or taken from the cache
+
+        :param key_block: The key block of the archive
+        :param layers: The layers of the archive
+        :param kdfs: The key derivation parameters of the archive
+        :param recipients: The recipient keys of the archive
+        """
+
+        self.evict_expired()
+
+        data_key_name = "data_key:" + hashlib.sha256(key_block).hexdigest()
+        data_key = self.memory.get(data_key_name)
+        if not data_key is None:
+            return data_key
+
+        kinds = [kind for layer, kind in self.LAYER_KINDS if layers & layer]
+        symmetric_encryptions = {kind: self._symmetric_encryption(kind) for kind in kinds if kind != "private_key"}
+
+        candidates = [(None, None)]
+        if "private_key" in kinds:
+            with self.lock:
+                candidates = [(encryption, expiry) for encryption, expiry in self.private_keys.values()]
+            if len(candidates) == 0:
+                raise ValueError("The agent holds no private key.")
+
+            recipient_keys = None if recipients is None else recipients[kinds.index("private_key")]
+            if not recipient_keys is None:
+                candidates = [(encryption, expiry) for encryption, expiry in candidates if encryption.fingerprint() in recipient_keys]
+                if len(candidates) == 0:
+                    raise ValueError("None of the private keys of the agent is a recipient of the archive.")
+
+        try:
+            # Archives that store the wrapped key in the key block do not tell which private key fits
+            for candidate_number, (private_encryption, private_expiry) in enumerate(candidates):
+                encryptions = [private_encryption if kind == "private_key" else symmetric_encryptions[kind][0] for kind in kinds]
+                try:
+                    data_key = _unwrap_data_key(key_block, encryptions, kdfs, recipients)
+                except ValueError:
+                    if candidate_number == len(candidates) - 1:
+                        raise
+                    continue
+
+                expiry = min([expiry for _, expiry in symmetric_encryptions.values()] + ([private_expiry] if not private_expiry is None else []))
+                self.memory.put(data_key_name, data_key, expiry)
+                return data_key
+        finally:
+            for kind, (encryption, expiry) in symmetric_encryptions.items():
+                self._keep_master_keys(kind, encryption, expiry)
+            for private_encryption, _ in candidates:
+                if not private_encryption is None:
+                    private_encryption.unwrapped_data_keys.clear()
+
+    def status(self) -> dict:
+        "Returns what the agent holds without any secrets"
+
+        self.evict_expired()
+        now = time.monotonic()
+        memory_names = self.memory.names()
+        with self.lock:
+            private_keys = {fingerprint: round(expiry - now) for fingerprint, (_, expiry) in self.private_keys.items()}
+
+        return {
+            "locked_memory": self.memory.locked,
+            "credentials": {name: round(expiry - now) for name, expiry in memory_names.items() if name in ("password", "key_file")},
+            "private_keys": private_keys,
+            "master_keys": sum(1 for name in memory_names if name.startswith("master_key:")),
+            "data_keys": sum(1 for name in memory_names if name.startswith("data_key:"))
+        }
+
+    def handle_request(self, request: dict) -> dict:
+        """
+        Handles a request of an AgentClient, binary values are base64 encoded
+
+        :param request: Dict with "command" and its arguments
+        """
+
+        command = request.get("command")
+        try:
+            if command == "add":
+                return {"ok": True, "name": self.add(request["kind"], base64.b64decode(request["secret"]), request.get("ttl"))}
+            if command == "unwrap":
+                data_key = self.unwrap_data_key(base64.b64decode(request["key_block"]), request["layers"], request.get("kdfs"), request.get("recipients"))
+                return {"ok": True, "data_key": base64.b64encode(data_key).decode("utf-8")}
+            if command == "status":
+                return {"ok": True, **self.status()}
+            if command == "clear":
+                self.clear()
+                return {"ok": True}
+            if command == "stop":
+                self.stop_event.set()
+                return {"ok": True}
+            raise ValueError(f"The command {command} is not supported.")
+        except (ValueError, KeyError, TypeError) as request_error:
+            return {"ok": False, "error": str(request_error)}
+
+    def serve(self, socket_path: Optional[str] = None, on_ready: Optional[Callable[[str], None]] = None) -> None:
+        """
+        Serves clients on a Unix socket that only the user can access until a client sends stop,
+        all secrets are zeroed afterwards
+
+        :param socket_path: Path of the socket, defaults to default_agent_socket()
+        :param on_ready: Function that is called with the socket path once the agent accepts connections
+        """
+
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("The key agent needs Unix domain sockets.")
+
+        socket_path = socket_path or default_agent_socket()
+        socket_directory = os.path.dirname(os.path.abspath(socket_path))
+        os.makedirs(socket_directory, mode=0o700, exist_ok=True)
+        if os.stat(socket_directory).st_uid != os.getuid():
+            raise ValueError(f"The directory {socket_directory} belongs to another user.")
+
+        if os.path.exists(socket_path):
+            try:
+                AgentClient(socket_path).status()
+            except ValueError:
+                os.remove(socket_path) # Left behind by an agent that did not stop cleanly
+            else:
+                raise ValueError(f"A key agent is already running on {socket_path}.")
+
+        if not resource is None:
+            resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        previous_umask = os.umask(0o177)
+        try:
+            server_socket.bind(socket_path)
+        finally:
+            os.umask(previous_umask)
+        server_socket.listen()
+        server_socket.settimeout(1.0)
+
+        if not on_ready is None:
+            on_ready(socket_path)
+
+        def handle_connection(connection: socket.socket) -> None:
+            with connection:
+                if hasattr(socket, "SO_PEERCRED"):
+                    _, peer_uid, _ = struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+                    if peer_uid != os.getuid():
+                        return
+
+                with connection.makefile("rwb") as connection_file:
+                    for line in connection_file:
+                        try:
+                            response = self.handle_request(json.loads(line))
+                        except ValueError:
+                            response = {"ok": False, "error": "The request is not valid JSON."}
+                        connection_file.write(json.dumps(response).encode("utf-8") + b"\n")
+                        connection_file.flush()
+                        if self.stop_event.is_set():
+                            server_socket.shutdown(socket.SHUT_RDWR) # Wakes up accept
+                            return
+
+        try:
+            with ThreadPoolExecutor() as executor:
+                while not self.stop_event.is_set():
+                    self.evict_expired()
+                    try:
+                        connection, _ = server_socket.accept()
+                    except socket.timeout:
+                        continue
+                    except OSError:
+                        if self.stop_event.is_set():
+                            break
+                        raise
+                    connection.settimeout(None)
+                    executor.submit(handle_connection, connection)
+        finally:
+            server_socket.close()
+            os.remove(socket_path)
+            self.clear()
+            self.memory.close()
+
+class AgentClient:
+    "Client of a KeyAgent, every request opens a short connection to the socket of the agent"
+
+    def __init__(self, socket_path: Optional[str] = None, timeout: float = 30.0):
+        """
+        :param socket_path: Path of the socket, defaults to default_agent_socket()
+        :param timeout: Timeout of a request in seconds, unwrapping may run a password KDF
+        """
+
+        self.socket_path = socket_path or default_agent_socket()
+        self.timeout = timeout
+
+    def request(self, command: str, **arguments: Any) -> dict:
+        """
+        Sends a request to the agent and returns its response, errors of the agent are raised as ValueError
+
+        :param command: "add", "unwrap", "status", "clear" or "stop"
+        :param arguments: Arguments of the command
+        """
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+            client_socket.settimeout(self.timeout)
+            try:
+                client_socket.connect(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                raise ValueError(f"No key agent is running on {self.socket_path}.") from None
+            with client_socket.makefile("rwb") as connection_file:
+                connection_file.write(json.dumps({"command": command, **arguments}).encode("utf-8") + b"\n")
+                connection_file.flush()
+                response_line = connection_file.readline()
+
+        if not response_line:
+            raise ValueError("The key agent closed the connection.")
+        response = json.loads(response_line)
+        if not response.pop("ok"):
+            raise ValueError(response["error"])
+        return response
+
+    def add(self, kind: str, secret: Union[str, bytes], ttl: Optional[float] = None) -> str:
+        """
+        Adds a credential to the agent and returns its name
+
+        :param kind: "password", "key_file" or "private_key"
+        :param secret: The password, the content of the key file or the base64 encoded private key
+        :param ttl: Lifetime in seconds, defaults to the TTL of the agent
+        """
+
+        if isinstance(secret, str):
+            secret = secret.encode("utf-8")
+        return self.request("add", kind=kind, secret=base64.b64encode(secret).decode("utf-8"), ttl=ttl)["name"]
+
+    def unwrap_data_key(self, key_block: bytes, layers: int, kdfs: Optional[List[Optional[dict]]] = None,
+                        recipients: Optional[List[Optional[dict]]] = None) -> bytes:
+        """
+        Returns the data key of an archive from the agent, see ArchiveReader.unlock_with_agent
+
+        :param key_block: The key block of the archive
+        :param layers: The layers of the archive
+        :param kdfs: The key derivation parameters of the archive
+        :param recipients: The recipient keys of the archive
+        """
+
+        response = self.request("unwrap", key_block=base64.b64encode(key_block).decode("utf-8"), layers=layers, kdfs=kdfs, recipients=recipients)
+        return base64.b64decode(response["data_key"])
+
+    def status(self) -> dict:
+        "Returns what the agent holds without any secrets"
+
+        return self.request("status")
+
+    def clear(self) -> None:
+        "Removes all credentials and keys from the agent"
+
+        self.request("clear")
+
+    def stop(self) -> None:
+        "Stops the agent, it zeroes all secrets"
+
+        self.request("stop")
+
+MANIFEST_VERSION = 1
+CHUNK_ID_LENGTH = 16
+CHUNK_ID_FILE_SUFFIX = ".chunks"
+
+class KnownChunkIds:
+    """
+    The IDs of all chunks stored in an incremental chain, kept as a sorted file of raw 16 byte IDs next to the manifest.
+    The file is memory-mapped and searched with bisection, so tens of millions of IDs are neither parsed nor held in a set.
+    IDs added by a run are kept in memory until save merges them into the file.
+    """
+
+    def __init__(self, file_path: Optional[str] = None):
+        """
+        :param file_path: Path to the file of IDs, None or a missing file for an empty set
+        """
+
+        self.added_ids = set()
+        self.file_map, self.count = None, 0
+        if not file_path is None:
+            self._open(file_path)
+
+    def _open(self, file_path: str) -> None:
+        "Maps the file of IDs, a missing file is empty"
+
+        if os.path.isfile(file_path):
+            with open(file_path, "rb") as readable_file:
+                file_size = os.fstat(readable_file.fileno()).st_size
+                if file_size % CHUNK_ID_LENGTH != 0:
+                    raise ValueError(f"The chunk ID file {file_path} is damaged.")
+                if file_size > 0:
+                    self.file_map = mmap.mmap(readable_file.fileno(), 0, access = mmap.ACCESS_READ)
+            self.count = file_size // CHUNK_ID_LENGTH
+
+    def _stored_id(self, position: int) -> bytes:
+        return self.file_map[position * CHUNK_ID_LENGTH:(position + 1) * CHUNK_ID_LENGTH]
+
+    def _position(self, raw_id: bytes) -> int:
+        "Returns the position of the first stored ID that is not smaller than raw_id"
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._stored_id(middle) < raw_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, chunk_id: str) -> bool:
+        if chunk_id in self.added_ids:
+            return True
+        if self.count == 0:
+            return False
+
+        raw_id = bytes.fromhex(chunk_id)
+        position = self._position(raw_id)
+        return position < self.count and self._stored_id(position) == raw_id
+
+    def __len__(self) -> int:
+        return self.count + len(self.added_ids)
+
+    def update(self, chunk_ids: Iterable[str]) -> None:
+        """
+        Adds chunk IDs, they are written by save
+
+        :param chunk_ids: Chunk IDs as hex
+        """
+
+        self.added_ids.update(chunk_id for chunk_id in chunk_ids if not chunk_id in self)
+
+    def save(self, file_path: str) -> None:
+        """
+        Merges the added IDs into the sorted file atomically, runs of stored IDs between them are copied in bulk
+
+        :param file_path: Path to the file of IDs
+        """
+
+        temporary_path = file_path + ".tmp"
+        with open(temporary_path, "wb") as writeable_file:
+            position = 0
+            for raw_id in sorted(bytes.fromhex(chunk_id) for chunk_id in self.added_ids):
+                next_position = self._position(raw_id)
+                if next_position > position:
+                    writeable_file.write(self.file_map[position * CHUNK_ID_LENGTH:next_position * CHUNK_ID_LENGTH])
+                writeable_file.write(raw_id)
+                position = next_position
+            if self.count > position:
+                writeable_file.write(self.file_map[position * CHUNK_ID_LENGTH:self.count * CHUNK_ID_LENGTH])
+            writeable_file.flush()
+            os.fsync(writeable_file.fileno())
+
+        self.close()
+        os.replace(temporary_path, file_path)
+        self.added_ids = set()
+        self._open(file_path)
+
+    def close(self) -> None:
+        "Releases the mapping of the file"
+
+        if not self.file_map is None:
+            self.file_map.close()
+        self.file_map, self.count = None, 0
+
+def load_manifest(manifest_path: str) -> dict:
+    """
+    Loads the manifest of the previous run of an incremental archive, an empty manifest is returned if it does not exist.
+    The IDs of deduplicated chunks are opened from the file next to the manifest as KnownChunkIds under "chunks".
+
+    :param manifest_path: Path to the manifest file
+    """
+
+    if not os.path.isfile(manifest_path):
+        return {"version": MANIFEST_VERSION, "archive": None, "files": {}}
+
+    with open(manifest_path, "rb") as readable_file:
+        manifest = decompress_bytes_to_dict_or_list(readable_file.read())
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"The manifest version {manifest.get('version')} is not supported.")
+
+    if "chunk_key" in manifest:
+        known_chunk_ids = KnownChunkIds(manifest_path + CHUNK_ID_FILE_SUFFIX)
+        known_chunk_ids.update(manifest.get("chunks", [])) # Manifests that stored the IDs inline
+        manifest["chunks"] = known_chunk_ids
+    return manifest
+
+def save_manifest(manifest: dict, manifest_path: str) -> None:
+    """
+    Saves a manifest atomically, so that an interrupted run never leaves a broken manifest behind.
+    The chunk IDs are saved afterwards, if that is interrupted the missing chunks are only stored again.
+
+    :param manifest: The manifest updated by write_archive
+    :param manifest_path: Path to the manifest file
+    """
+
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, "wb") as writeable_file:
+        writeable_file.write(compress_dict_or_list({key: value for key, value in manifest.items() if key != "chunks"}))
+        writeable_file.flush()
+        os.fsync(writeable_file.fileno())
+    os.replace(temporary_path, manifest_path)
+
+    if isinstance(manifest.get("chunks"), KnownChunkIds):
+        manifest["chunks"].save(manifest_path + CHUNK_ID_FILE_SUFFIX)
+
+def file_hash(file_path: str) -> str:
+    """
+    Returns the SHA-256 hash of a file as hex, the file is read in chunks
+
+    :param file_path: Path to file
+    """
+
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as readable_file:
+        for chunk in readinto_file_chunks(readable_file, SMALL_FILE_SIZE):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def write_archive(source_path: str, output_file: BinaryIO, encryptions: Optional[List[Union[SymmetricEncryption, AsymmetricEncryption]]] = None,
+                  layers: int = 0, workers: Optional[int] = None, buffer_size: int = ARCHIVE_BUFFER_SIZE,
+                  on_error: Optional[Callable[[str, OSError], None]] = None, codec: str = "gzip",
+                  compression_level: int = 9, detect_incompressible: bool = True, manifest: Optional[dict] = None,
+                  deduplicate: bool = False, instrumentation: Optional[Instrumentation] = None, io_workers: Optional[int] = None,
+                  solid_file_size: int = 0, solid_block_size: int = SOLID_BLOCK_SIZE) -> Tuple[int, int]:
+    """
+    Streams a file or directory into an archive: walk, read, compress, encrypt and append one entry at a time.
+    Files up to SMALL_FILE_SIZE are processed in parallel, larger files are streamed in chunks, so the memory
+    usage is limited by buffer_size and not by the size of the tree. Returns the number of files and their total size.
+
+    With a manifest the archive is incremental: files whose size, mtime and inode did not change since the run
+    that wrote the manifest are skipped, as are files with the same size and content hash. The result is a delta
+    archive with the new and changed files and the deleted paths, it is restored over its base with restore_archives.
+    The manifest is updated in place and has to be saved with save_manifest afterwards.
+
+    With io_workers the I/O runs in its own thread pool: the walk lists and stats directories concurrently, small files
+    are read by the I/O workers and handed to the compression and encryption workers, large files are read ahead.
+    This keeps the pipeline busy on network file systems where every call waits for a round trip.
+
+    With deduplicate repeated content is stored only once, also across the archives of an incremental chain.
+    The manifest then holds the secret chunk key and has to be kept as private as the archives.
+
+    With solid_file_size files up to that size are packed into solid blocks of about solid_block_size bytes that are
+    compressed and encrypted as one unit, for trees of many small files. Single files can still be extracted,
+    this decodes their block.
+
+    :param source_path: Path to the file or directory, paths in the archive are relative to its parent directory
+    :param output_file: Writeable and seekable file-like object
+    :param encryptions: The encryption layers in the order in which they are applied
+    :param layers: Combination of LAYER_PASSWORD, LAYER_PUBLIC_KEY and LAYER_KEY_FILE
+    :param workers: Number of files that are processed in parallel, defaults to the number of CPUs
+    :param buffer_size: Maximum number of bytes held by small files in flight
+    :param on_error: Function that is called with the path and the OSError of files that cannot be read,
+                     if None the error is raised
+    :param codec: The compression codec, "raw", "gzip", "lzma" or "fast"
+    :param compression_level: The compression level from 1 (fast) to 9 (small)
+    :param detect_incompressible: Whether files that look incompressible are stored raw
+    :param manifest: A manifest from load_manifest for an incremental archive
+    :param deduplicate: Whether files are split into content-defined chunks that are stored only once
+    :param instrumentation: Instrumentation that measures the stages and reports every file to its callback
+    :param io_workers: Number of concurrent listings, stat calls and reads, e.g. 32 for network file systems,
+                       by default files are read by the compression workers and the walk is sequential
+    :param solid_file_size: Files up to this size are packed into solid blocks, e.g. SOLID_FILE_SIZE, 0 disables solid blocks
+    :param solid_block_size: Plain size at which a solid block is closed
+    """
+
+    if deduplicate and solid_file_size > 0:
+        raise ValueError("Deduplication and solid blocks cannot be combined.")
+
+    def handle_error(path: str, os_error: OSError) -> None:
+        if on_error is None:
+            raise os_error
+        on_error(path, os_error)
+
+    source_path = os.path.abspath(source_path)
+    base_path = os.path.dirname(source_path)
+
+    def archive_path(file_path: str) -> str:
+        return os.path.relpath(file_path, base_path).replace(os.sep, "/")
+
+    # Paths that the walk could not list or stat, files below them were not seen and are not deleted
+    unreadable_paths = []
+
+    def handle_walk_error(path: str, os_error: OSError) -> None:
+        unreadable_paths.append(archive_path(path))
+        handle_error(path, os_error)
+
+    if os.path.isdir(source_path):
+        file_entries = walk_directory(source_path, on_error=handle_walk_error, io_workers=io_workers or 1)
+    else:
+        file_entries = []
+        try:
+            source_stat = os.stat(source_path)
+            file_entries.append(FileEntry(source_path, source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_ino, source_stat.st_dev, False))
+        except OSError as os_error:
+            handle_walk_error(source_path, os_error)
+
+    previous_files = {} if manifest is None else manifest["files"]
+    current_files = {}
+
+    chunk_key, known_chunk_ids = None, None
+    if deduplicate and not manifest is None:
+        if not "chunk_key" in manifest:
+            manifest["chunk_key"] = secrets.token_hex(32)
+        chunk_key, known_chunk_ids = bytes.fromhex(manifest["chunk_key"]), manifest.get("chunks")
+        if not isinstance(known_chunk_ids, KnownChunkIds):
+            known_chunk_ids, chunk_ids = KnownChunkIds(), known_chunk_ids or []
+            known_chunk_ids.update(chunk_ids)
+
+    writer = ArchiveWriter(
+        output_file, encryptions, layers, codec, compression_level, detect_incompressible,
+        None if manifest is None else manifest["archive"], deduplicate, chunk_key, known_chunk_ids, instrumentation
+    )
+
+    def load_small_file(file_entry: FileEntry) -> Tuple[FileEntry, Union[bytes, str, OSError, None]]:
+        """
+        Returns the plain content of a small file, the content hash of an unchanged file or an OSError,
+        large files are returned without content, only I/O is done here
+        """
+
+        previous_file = previous_files.get(archive_path(file_entry.path))
+        if not previous_file is None and previous_file[0] == file_entry.size:
+            if previous_file[1:3] == [file_entry.mtime_ns, file_entry.inode]:
+                return file_entry, previous_file[3]
+
+            # Only the metadata changed (e.g. touch or copy), the content hash decides
+            try:
+                if file_hash(file_entry.path) == previous_file[3]:
+                    return file_entry, previous_file[3]
+            except OSError as os_error:
+                return file_entry, os_error
+
+        if file_entry.size > SMALL_FILE_SIZE:
+            return file_entry, None
+
+        try:
+            with open(file_entry.path, "rb") as readable_file:
+                return file_entry, _time_call(instrumentation, "read", readable_file.read)
+        except OSError as os_error:
+            return file_entry, os_error
+
+    def encode_small_file(loaded_file: Tuple[FileEntry, Union[bytes, str, OSError, None]]) -> Tuple[FileEntry, Optional[str], Union[bytes, list, str, OSError, None]]:
+        """
+        Returns the codec and the content of a loaded small file (with deduplication the list of processed chunks),
+        everything else is passed through, only CPU work is done here
+        """
+
+        file_entry, plain_data = loaded_file
+        if not isinstance(plain_data, bytes):
+            return file_entry, None, plain_data
+
+        content_hash = _time_call(instrumentation, "hash", lambda: hashlib.sha256(plain_data).hexdigest(), byte_count = len(plain_data))
+        current_files[archive_path(file_entry.path)] = [file_entry.size, file_entry.mtime_ns, file_entry.inode, content_hash]
+        if deduplicate:
+            return file_entry, None, list(writer.process_deduplicated_chunks([plain_data]))
+
+        entry_codec, content_chunks = writer.process_chunks(archive_path(file_entry.path), [plain_data])
+        return file_entry, entry_codec, b"".join(content_chunks)
+
+    def group_solid_files(loaded_files: Iterable[Tuple[FileEntry, Union[bytes, str, OSError, None]]]) -> Iterator[Any]:
+        "Collects loaded files up to solid_file_size into lists of about solid_block_size bytes, other files are passed through"
+
+        block, block_size = [], 0
+        for file_entry, plain_data in loaded_files:
+            if not isinstance(plain_data, bytes) or len(plain_data) > solid_file_size:
+                yield file_entry, plain_data
+                continue
+
+            block.append((file_entry, plain_data))
+            block_size += len(plain_data)
+            if block_size >= solid_block_size:
+                yield block
+                block, block_size = [], 0
+
+        if block:
+            yield block
+
+    def encode_solid_item(item: Any) -> Tuple[Union[FileEntry, List[FileEntry]], Optional[str], Any]:
+        """
+        Encodes a loaded file with encode_small_file or a list of loaded files as solid block,
+        a block is returned as the list of file entries, the codec and the ID, plain sizes and content of the block
+        """
+
+        if not isinstance(item, list):
+            return encode_small_file(item)
+
+        for file_entry, plain_data in item:
+            content_hash = _time_call(instrumentation, "hash", lambda: hashlib.sha256(plain_data).hexdigest(), byte_count = len(plain_data))
+            current_files[archive_path(file_entry.path)] = [file_entry.size, file_entry.mtime_ns, file_entry.inode, content_hash]
+
+        block_id, block_codec, block_content = writer.process_block([plain_data for _, plain_data in item])
+        return [file_entry for file_entry, _ in item], block_codec, (block_id, [len(plain_data) for _, plain_data in item], block_content)
+
+    file_count, full_size = 0, 0
+    max_in_flight = max(1, buffer_size // SMALL_FILE_SIZE)
+
+    file_entries = _time_items(instrumentation, "walk", file_entries, lambda file_entry: file_entry.size)
+    if io_workers is None and solid_file_size <= 0:
+        processed_files = parallel_map(lambda file_entry: encode_small_file(load_small_file(file_entry)), file_entries, workers, max_in_flight)
+    else:
+        # The buffer is shared by the files that are loaded and the files that are encoded
+        max_in_flight = max(1, max_in_flight // 2)
+        loaded_files = parallel_map(load_small_file, file_entries, io_workers or workers, max_in_flight)
+        if solid_file_size > 0:
+            block_in_flight = max(1, max_in_flight * SMALL_FILE_SIZE // max(SMALL_FILE_SIZE, solid_block_size))
+            processed_files = parallel_map(encode_solid_item, group_solid_files(loaded_files), workers, block_in_flight)
+        else:
+            processed_files = parallel_map(encode_small_file, loaded_files, workers, max_in_flight)
+
+    for file_entry, entry_codec, content in processed_files:
+        if isinstance(file_entry, list):
+            block_id, plain_sizes, block_content = content
+            writer.add_block(block_id, [(archive_path(block_entry.path), plain_size) for block_entry, plain_size in zip(file_entry, plain_sizes)], entry_codec, block_content)
+            file_count += len(file_entry)
+            full_size += sum(plain_sizes)
+            continue
+
+        path = archive_path(file_entry.path)
+
+        if isinstance(content, OSError):
+            if path in previous_files:
+                current_files[path] = previous_files[path]
+            handle_error(file_entry.path, content)
+            continue
+
+        if isinstance(content, str):
+            current_files[path] = [file_entry.size, file_entry.mtime_ns, file_entry.inode, content]
+            continue
+
+        try:
+            if content is None:
+                content_hash = hashlib.sha256()
+                writer.add_file(file_entry.path, path, content_hash, WRITE_READ_AHEAD if not io_workers is None else 0)
+                current_files[path] = [file_entry.size, file_entry.mtime_ns, file_entry.inode, content_hash.hexdigest()]
+            elif isinstance(content, list):
+                writer.add_deduplicated_entry(path, file_entry.size, content)
+            else:
+                writer.add_entry(path, file_entry.size, [content], entry_codec)
+        except OSError as os_error:
+            current_files.pop(path, None)
+            if path in previous_files:
+                current_files[path] = previous_files[path]
+            handle_error(file_entry.path, os_error)
+            continue
+
+        file_count += 1
+        full_size += file_entry.size
+
+    unreadable_prefixes = tuple(unreadable_path + "/" for unreadable_path in unreadable_paths)
+    unreadable_paths = set(unreadable_paths)
+    for path in previous_files:
+        if path in current_files:
+            continue
+        if path in unreadable_paths or path.startswith(unreadable_prefixes):
+            current_files[path] = previous_files[path]
+            continue
+        writer.delete(path)
+
+    writer.close()
+
+    if not manifest is None:
+        # IDs of all archives of the chain, manifests of older versions only know the last one
+        manifest["archives"] = manifest.get("archives", [] if manifest["archive"] is None else [manifest["archive"]]) + [writer.archive_id]
+        manifest["archive"] = writer.archive_id
+        manifest["files"] = current_files
+        if deduplicate:
+            known_chunk_ids.update(writer.chunk_index)
+            manifest["chunks"] = known_chunk_ids
+
+    return file_count, full_size
+
+def write_structure(structure: dict, output_file: BinaryIO, layers: int = 0) -> None:
+    """
+    Writes a file structure into the binary archive format, contents are stored as raw bytes without any encoding
+
+    :param structure: The file structure with compressed and encrypted contents
+    :param output_file: Writeable and seekable file-like object
+    :param layers: Combination of LAYER_PASSWORD, LAYER_PUBLIC_KEY and LAYER_KEY_FILE that were applied to the contents
+    """
+
+    writer = ArchiveWriter(output_file, layers=layers)
+    for path, information in iter_structure_files(structure):
+        if not information["content"] is None:
+            writer.add_entry(path, information["size"], [information["content"]], information.get("codec", "gzip"))
+    writer.close()
+
+def read_structure(input_file: BinaryIO, encryptions: Optional[List[Union[SymmetricEncryption, AsymmetricEncryption]]] = None) -> Tuple[dict, int]:
+    """
+    Reads a file structure from the binary archive format, returns the flat structure and the applied layers.
+    If the archive has a key block, the contents are decrypted with the data key and returned compressed,
+    the codec of each content is stored under "codec". The recipient keys of a public key layer are stored
+    in the index after the records, so the contents are decrypted once the whole archive has been read.
+
+    :param input_file: Readable file-like object
+    :param encryptions: The encryption layers in the order in which they were applied, required if the archive has a key block
+    """
+
+    def read_exact(length: int) -> bytes:
+        data = input_file.read(length)
+        if len(data) != length:
+            raise ValueError("The archive is incomplete.")
+        return data
+
+    header_parts = []
+    def read_header(length: int) -> bytes:
+        header_parts.append(read_exact(length))
+        return header_parts[-1]
+
+    version, layers, key_block, kdfs = _read_archive_header(read_header)
+    header = b"".join(header_parts)
+    if key_block and not encryptions:
+        raise ValueError("The archive is encrypted, the encryption layers are required to read it.")
+
+    structure = {}
+    while True:
+        path_length = struct.unpack(">H", read_exact(2))[0]
+        if path_length == 0:
+            break
+
+        path_bytes = read_exact(path_length)
+        codec_id, size, content_length = _ENTRY_HEADER.unpack(read_exact(_ENTRY_HEADER.size))
+        content = read_exact(content_length)
+
+        if path_bytes.startswith(b"\x00"):
+            raise ValueError("The archive is deduplicated, it can only be read with ArchiveReader.")
+        if path_bytes.startswith(b"\x01"):
+            raise ValueError("The archive has solid blocks, it can only be read with ArchiveReader.")
+
+        structure[_decode_path(path_bytes)] = {"size": size, "content": content, "codec": COMPRESSION_CODECS[codec_id]}
+
+    # Archives of version 1 have no recipients in the index and no index tag
+    index, index_tag, recipients = None, None, None
+    if version >= 2:
+        tag_size = INDEX_TAG_SIZE if version >= 3 else 0
+        index_bytes = input_file.read()
+        if len(index_bytes) < tag_size + _ARCHIVE_FOOTER.size:
+            raise ValueError("The archive has no index, it is incomplete.")
+        index = decompress_bytes_to_dict_or_list(index_bytes[:-tag_size - _ARCHIVE_FOOTER.size])
+        index_tag = index_bytes[-tag_size - _ARCHIVE_FOOTER.size:-_ARCHIVE_FOOTER.size] if version >= 3 else None
+        recipients = index.get("recipients") or None
+
+    data_key = None
+    if key_block:
+        data_key = _unwrap_data_key(key_block, encryptions, kdfs, recipients)
+        if len(data_key) != DATA_KEY_SIZES[version]:
+            raise ValueError("The data key does not match the archive version, the header was modified.")
+
+    if not index_tag is None:
+        index_key = None if data_key is None else derive_subkey(data_key, b"", INDEX_KEY_INFO)
+        if not hmac.compare_digest(_index_tag(_index_hash(header, index), index_key), index_tag):
+            raise ValueError("The index of the archive was modified or is damaged.")
+
+        # The record headers are not authenticated, they have to match the entries of the authenticated index
+        entries = {path: (size, length, codec) for path, size, _, length, codec, *_ in index["entries"]}
+        if len(entries) != len(structure) or any(
+            entries.get(path) != (information["size"], len(information["content"]), information["codec"]) for path, information in structure.items()
+        ):
+            raise ValueError("The records of the archive do not match its index.")
+
+    if not data_key is None:
+        for path, information in structure.items():
+            entry_key = derive_subkey(data_key, _encode_path(path), ENTRY_KEY_INFO)
+            information["content"] = b"".join(StreamEncryption(entry_key).decrypt_chunks([information["content"]]))
+
+    return structure, layers
+
+def pack_structure(structure: dict, layers: int = 0) -> bytes:
+    """
+    Converts a file structure to bytes in the binary archive format
+
+    :param structure: The file structure with compressed and encrypted contents
+    :param layers: Combination of LAYER_PASSWORD, LAYER_PUBLIC_KEY and LAYER_KEY_FILE that were applied to the contents
+    """
+
+    output_file = io.BytesIO()
+    write_structure(structure, output_file, layers)
+    return output_file.getvalue()
+
+def unpack_structure(archive_data: bytes) -> Tuple[dict, int]:
+    """
+    Converts bytes in the binary archive format back to a flat file structure and the applied layers
+
+    :param archive_data: The bytes created by pack_structure
+    """
+
+    return read_structure(io.BytesIO(archive_data))
+
+SHRED_BLOCK_SIZE = 1024 * 1024
+SHRED_ALIGNMENT = 4096
+SHRED_PASSES = ("random", "zeros")
+
+def _shred_pattern(pattern: str, block_size: int, random_key: bytes) -> Iterator[bytes]:
+    """
+    Returns an endless stream of blocks for one overwrite pass, random data comes from an AES-CTR keystream,
+    which is much faster than reading the OS random source for every block and can be repeated for verification
+
+    :param pattern: "zeros", "ones" or "random"
+    :param block_size: The size of the returned blocks
+    :param random_key: Random 32 bytes that seed the keystream of the "random" pattern
+    """
+
+    if pattern == "zeros":
+        block = bytes(block_size)
+    elif pattern == "ones":
+        block = b"\xff" * block_size
+    elif pattern == "random":
+        encryptor = Cipher(algorithms.AES(random_key), modes.CTR(bytes(16)), backend=default_backend()).encryptor()
+        zero_block = bytes(block_size)
+        while True:
+            yield encryptor.update(zero_block)
+    else:
+        raise ValueError(f"Unknown overwrite pattern {pattern}, use zeros, ones or random.")
+
+    while True:
+        yield block
+
+def shred_file(file_path: str, passes: Iterable[str] = SHRED_PASSES, verify: bool = True, block_size: int = SHRED_BLOCK_SIZE) -> int:
+    """
+    Overwrites a file in large aligned blocks, syncs it to disk after each pass and deletes it, returns the number of
+    bytes written. On SSDs and copy-on-write file systems old blocks may survive, encrypt such disks instead.
+
+    :param file_path: Path to file
+    :param passes: Overwrite patterns in the order in which they are written, each one of "zeros", "ones" or "random"
+    :param verify: Whether the last pass is read back and compared
+    :param block_size: Number of bytes per write, should be a multiple of SHRED_ALIGNMENT
+    """
+
+    passes = list(passes)
+    bytes_written = 0
+
+    file_descriptor = os.open(file_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        # The slack of the last file system block is overwritten too
+        file_size = os.fstat(file_descriptor).st_size
+        aligned_size = -(-file_size // SHRED_ALIGNMENT) * SHRED_ALIGNMENT
+
+        def write_at(data: memoryview, offset: int) -> None:
+            # A write may store fewer bytes than given (e.g. on a full disk or after a signal), the rest is written again
+            while len(data) > 0:
+                if hasattr(os, "pwrite"):
+                    written = os.pwrite(file_descriptor, data, offset)
+                else:
+                    os.lseek(file_descriptor, offset, os.SEEK_SET)
+                    written = os.write(file_descriptor, data)
+                if written <= 0:
+                    raise OSError(f"Overwriting {file_path} failed, no bytes were written at offset {offset}.")
+                data, offset = data[written:], offset + written
+
+        def read_at(length: int, offset: int) -> bytes:
+            if hasattr(os, "pread"):
+                return os.pread(file_descriptor, length, offset)
+            os.lseek(file_descriptor, offset, os.SEEK_SET)
+            return os.read(file_descriptor, length)
+
+        random_key = None
+        for pattern in passes:
+            random_key = secrets.token_bytes(32)
+            blocks = _shred_pattern(pattern, block_size, random_key)
+
+            for offset in range(0, aligned_size, block_size):
+                length = min(block_size, aligned_size - offset)
+                write_at(memoryview(next(blocks))[:length], offset)
+                bytes_written += length
+            os.fsync(file_descriptor)
+
+        if verify and passes:
+            # The keystream of the last pass is generated again instead of being kept in memory
+            blocks = _shred_pattern(passes[-1], block_size, random_key)
+            for offset in range(0, aligned_size, block_size):
+                length = min(block_size, aligned_size - offset)
+                if read_at(length, offset) != next(blocks)[:length]:
+                    raise OSError(f"Verification of {file_path} failed, the overwritten data could not be read back.")
+
+        os.ftruncate(file_descriptor, 0)
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+    # The name is overwritten as well before the file is removed
+    random_path = os.path.join(os.path.dirname(file_path), secrets.token_hex(16))
+    os.rename(file_path, random_path)
+    os.remove(random_path)
+
+    return bytes_written
+
+def shred_path(path: str, passes: Iterable[str] = SHRED_PASSES, verify: bool = True, workers_per_device: int = 1,
+               block_size: int = SHRED_BLOCK_SIZE, on_error: Optional[Callable[[str, OSError], None]] = None,
+               one_file_system: bool = True) -> dict:
+    """
+    Securely deletes a file or a directory with all its contents. Files on different devices are shredded in
+    parallel so that every disk is kept busy. Returns statistics: files, bytes written, seconds and bytes per second.
+
+    Only files that were shredded are removed. Directories are removed bottom-up once they are empty, a directory
+    that still holds a file that could not be shredded, could not be listed or is on a skipped file system stays.
+
+    :param path: Path to the file or directory
+    :param passes: Overwrite patterns in the order in which they are written, each one of "zeros", "ones" or "random"
+    :param verify: Whether the last pass is read back and compared
+    :param workers_per_device: Number of files that are shredded at once on the same device
+    :param block_size: Number of bytes per write
+    :param on_error: Function that is called with the path and the OSError of files that could not be shredded,
+                     it may be called from several threads, if None the first error is raised
+    :param one_file_system: Whether directories on other file systems (mount points) are left alone,
+                            otherwise they are shredded as well, in parallel with the other devices
+    """
+
+    passes = list(passes)
+    path = os.path.normpath(path)
+    start_time = time.perf_counter()
+
+    # Paths that could not be listed or shredded, the directories above them are not removed
+    kept_paths = []
+    kept_lock = threading.Lock()
+
+    def handle_error(error_path: str, os_error: OSError) -> None:
+        with kept_lock:
+            kept_paths.append(error_path)
+        if on_error is None:
+            raise os_error
+        on_error(error_path, os_error)
+
+    directory_paths = []
+    if os.path.islink(path):
+        # Only the link is removed, its target is not touched
+        os.remove(path)
+        file_entries = []
+    elif os.path.isdir(path):
+        file_entries = []
+        for file_entry in walk_directory(path, one_file_system=one_file_system, include_directories=True, on_error=handle_error):
+            if file_entry.is_directory:
+                directory_paths.append(file_entry.path)
+            else:
+                file_entries.append(file_entry)
+        directory_paths.append(path)
+    else:
+        path_stat = os.stat(path)
+        file_entries = [FileEntry(path, path_stat.st_size, path_stat.st_mtime_ns, path_stat.st_ino, path_stat.st_dev, False)]
+
+    device_files = {}
+    for file_entry in file_entries:
+        device_files.setdefault(file_entry.device, []).append(file_entry.path)
+
+    work_lists = []
+    for file_paths in device_files.values():
+        for worker_number in range(max(1, workers_per_device)):
+            work_lists.append(file_paths[worker_number::max(1, workers_per_device)])
+
+    def shred_files(file_paths: List[str]) -> Tuple[int, int]:
+        file_count, bytes_written = 0, 0
+        for file_path in file_paths:
+            try:
+                bytes_written += shred_file(file_path, passes, verify, block_size)
+                file_count += 1
+            except OSError as os_error:
+                handle_error(file_path, os_error)
+        return file_count, bytes_written
+
+    file_count, bytes_written = 0, 0
+    for worker_file_count, worker_bytes_written in parallel_map(shred_files, work_lists, workers = max(1, len(work_lists))):
+        file_count += worker_file_count
+        bytes_written += worker_bytes_written
+
+    kept_directories = set()
+
+    def keep_parents(kept_path: str) -> None:
+        kept_path = os.path.dirname(kept_path)
+        while len(kept_path) >= len(path) and not kept_path in kept_directories:
+            kept_directories.add(kept_path)
+            kept_path = os.path.dirname(kept_path)
+
+    for kept_path in kept_paths:
+        kept_directories.add(kept_path) # Directories that could not be listed
+        keep_parents(kept_path)
+
+    # Deepest directories first, links and special files hold no data and are removed without overwriting
+    for directory_path in sorted(directory_paths, key=lambda directory_path: directory_path.count(os.sep), reverse=True):
+        if directory_path in kept_directories:
+            continue
+        try:
+            with os.scandir(directory_path) as directory_entries:
+                for directory_entry in directory_entries:
+                    if directory_entry.is_symlink() or not (directory_entry.is_dir() or directory_entry.is_file()):
+                        os.remove(directory_entry.path)
+            os.rmdir(directory_path) # Fails if the directory still holds e.g. a skipped mount point
+        except OSError as os_error:
+            keep_parents(directory_path)
+            handle_error(directory_path, os_error)
+
+    seconds = time.perf_counter() - start_time
+    return {
+        "files": file_count,
+        "bytes": bytes_written,
+        "seconds": seconds,
+        "throughput": bytes_written / seconds if seconds > 0 else 0.0
+    }